@@ -0,0 +1,108 @@
+# allviewのグラフ描画（pyplot / Figure+Agg / キャッシュあり / 1枚にまとめる）を再実行の繰り返しで比較するベンチマーク
+#   python benchmarks/bench_charts.py --reruns 100
+import argparse
+import io
+import os
+import subprocess
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from chart_render import ChartCache, chart_data, render_chart_png
+
+MODES = ('pyplot', 'agg', 'agg-cached', 'grid-cached')
+CHARTS = 12  # allviewの4x6グリッドにあるグラフの数
+GRID_COLS = 3
+
+
+def rss_mb():
+    # 現在の常駐メモリ（Linux以外では最大値で代用する）
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def rerun_pyplot(seed, cache):
+    # 以前の方式。毎回新しいデータで図を作り、閉じない
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    warnings.filterwarnings('ignore', 'More than 20 figures')
+    for index in range(CHARTS):
+        fig, ax = plt.subplots()
+        x = np.linspace(0, 10, 100)
+        y = np.sin(x) + np.random.normal(0, 0.1, x.size)
+        ax.plot(x, y)
+        ax.set_title(f"Graph {index + 1}")
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format='png')
+
+
+def rerun_agg(seed, cache):
+    for index in range(CHARTS):
+        render_chart_png(*chart_data(seed, index), f"Graph {index + 1}")
+
+
+def rerun_agg_cached(seed, cache):
+    for index in range(CHARTS):
+        cache.chart(*chart_data(seed, index), f"Graph {index + 1}")
+
+
+def rerun_grid_cached(seed, cache):
+    cache.grid([(*chart_data(seed, index), f"Graph {index + 1}") for index in range(CHARTS)], GRID_COLS)
+
+
+RERUNS = {
+    'pyplot': rerun_pyplot,
+    'agg': rerun_agg,
+    'agg-cached': rerun_agg_cached,
+    'grid-cached': rerun_grid_cached,
+}
+
+
+def run_mode(mode, reruns):
+    rerun = RERUNS[mode]
+    cache = ChartCache()
+    seed = 1
+    rerun(seed, cache)  # importや初回描画の分は計測から外す
+    start_rss = rss_mb()
+    timings = []
+    for _ in range(reruns):
+        started = time.perf_counter()
+        rerun(seed, cache)
+        timings.append((time.perf_counter() - started) * 1000)
+    end_rss = rss_mb()
+    print(f"{mode:>12} {np.mean(timings):12.1f} {np.percentile(timings, 95):10.1f} "
+          f"{start_rss:12.1f} {end_rss:10.1f} {end_rss - start_rss:10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--reruns', type=int, default=100)
+    parser.add_argument('--mode', choices=MODES, help='1つの方式だけを実行する（通常は方式ごとに別プロセスで実行する）')
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args.mode, args.reruns)
+        return
+
+    print(f"reruns: {args.reruns}, charts per rerun: {CHARTS}")
+    print(f"{'mode':>12} {'ms/rerun':>12} {'p95 ms':>10} {'start RSS MB':>12} {'end RSS MB':>10} {'growth MB':>10}")
+    sys.stdout.flush()
+    # メモリの増え方を比べるため、方式ごとに新しいプロセスで実行する
+    for mode in MODES:
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--mode', mode, '--reruns', str(args.reruns)], check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# box_files への大量書き込みの速度を比較するマイクロベンチマーク
+#   python benchmarks/bench_index_db.py --rows 100000
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import index_db
+
+
+def make_rows(count, offset=0):
+    for i in range(offset, offset + count):
+        yield (
+            f'{i:012d}',
+            f'IMG_{i:08d}.jpg',
+            f'{i // 500:08d}',
+            f'2024-01-{i % 28 + 1:02d}T12:00:00-08:00',
+            f'https://app.box.com/s/{i:032x}',
+            f'{i:012d}1',
+        )
+
+
+def ingest_row_by_row(db_file_path, rows):
+    # 従来の書き込み方法（既定のジャーナル、1行ずつ INSERT OR REPLACE）
+    with sqlite3.connect(db_file_path) as conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS box_files (
+                id TEXT PRIMARY KEY,
+                name TEXT,
+                folder_id TEXT,
+                created_at TEXT,
+                shared_link TEXT,
+                file_version TEXT
+            )
+        ''')
+        cursor = conn.cursor()
+        for row in rows:
+            cursor.execute('''
+                INSERT OR REPLACE INTO box_files (id, name, folder_id, created_at, shared_link, file_version)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', row)
+        conn.commit()
+
+
+def ingest_batched(db_file_path, rows, chunk_size):
+    with index_db.open_db(db_file_path) as conn:
+        index_db.ensure_schema(conn)
+        index_db.upsert_rows(conn, rows, chunk_size)
+    index_db.finalize(db_file_path)
+
+
+def measure(label, func, rows_count):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<44} {elapsed:8.2f} s  {rows_count / elapsed:12,.0f} rows/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--chunk-size', type=int, default=index_db.DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        legacy_path = os.path.join(temp_dir, 'legacy.db')
+        batched_path = os.path.join(temp_dir, 'batched.db')
+
+        measure("row-by-row INSERT OR REPLACE (new)",
+                lambda: ingest_row_by_row(legacy_path, make_rows(args.rows)), args.rows)
+        measure("index_db.upsert_rows + 3 indexes (new)",
+                lambda: ingest_batched(batched_path, make_rows(args.rows), args.chunk_size), args.rows)
+        # 2回目以降の実行を想定し、同じ行を既存DBへ書き直す
+        measure("row-by-row INSERT OR REPLACE (rewrite)",
+                lambda: ingest_row_by_row(legacy_path, make_rows(args.rows)), args.rows)
+        measure("index_db.upsert_rows + 3 indexes (rewrite)",
+                lambda: ingest_batched(batched_path, make_rows(args.rows), args.chunk_size), args.rows)
+
+
+if __name__ == '__main__':
+    main()
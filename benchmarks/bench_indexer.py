@@ -0,0 +1,110 @@
+# インデックス作成（get_all_files から最後のアップロードまで）を、本番のBoxを使わずに計測するベンチマーク。
+# 合成したフォルダ階層を持つモックサーバー（mock_box.py）を別プロセスで起動し、indexer.run_index を実行する
+#   python benchmarks/bench_indexer.py --depth 3 --fanout 5 --files 50 --latency-ms 20 --error-rate 0.02
+# --listing-mode に複数のモードを指定すると、モードごとに同じ階層のサーバーを起動し直して比較する
+#   python benchmarks/bench_indexer.py --image-ratio 0.1 --listing-mode fields search
+import argparse
+import multiprocessing
+import os
+import resource
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import closing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import indexer
+from box_client import BoxClient
+from box_crawler import DEFAULT_MAX_WORKERS, LISTING_MODES
+from mock_box import MockBox, build_tree, serve, tree_size
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_server(args, queue):
+    # 階層とサーバーのメモリが計測に入らないよう、別プロセスで動かす
+    tree = build_tree(args.depth, args.fanout, args.files, args.image_ratio, args.shared_ratio, args.seed)
+    box = MockBox(tree, args.latency_ms / 1000, args.jitter_ms / 1000, args.error_rate, args.retry_after, args.seed)
+    _, base_url = serve(box)
+    queue.put(base_url)
+    threading.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--depth', type=int, default=3, help='ルートからの階層の深さ')
+    parser.add_argument('--fanout', type=int, default=5, help='各フォルダのサブフォルダ数')
+    parser.add_argument('--files', type=int, default=50, help='各フォルダのファイル数')
+    parser.add_argument('--image-ratio', type=float, default=0.8, help='画像ファイルの割合')
+    parser.add_argument('--shared-ratio', type=float, default=0.5, help='共有リンクが作成済みのファイルの割合')
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='1リクエストあたりの応答遅延')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='応答遅延に加える揺らぎの最大値')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='429を返す確率')
+    parser.add_argument('--retry-after', type=float, default=0.05, help='429で返すRetry-After（秒）')
+    parser.add_argument('--workers', type=int, default=DEFAULT_MAX_WORKERS)
+    parser.add_argument('--listing-mode', choices=LISTING_MODES, nargs='+', default=['fields'])
+    parser.add_argument('--rate', type=float, default=0, help='クライアントの流量制限（1秒あたり、0で無制限）')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    folders, files = tree_size(args.depth, args.fanout, args.files)
+    print(f'階層: フォルダ {folders:,} 件、ファイル {files:,} 件（深さ {args.depth}、'
+          f'サブフォルダ {args.fanout}、ファイル {args.files}/フォルダ）')
+
+    summaries = [run_mode(args, listing_mode) for listing_mode in args.listing_mode]
+    if len(summaries) > 1:
+        print(f'{"mode":<12}{"seconds":>9}{"rows":>9}{"calls":>9}{"received_kb":>13}')
+        for summary in summaries:
+            print(f'{summary["mode"]:<12}{summary["seconds"]:>9.2f}{summary["rows"]:>9,}'
+                  f'{summary["calls"]:>9,}{summary["received_kb"]:>13,.0f}')
+
+
+def run_mode(args, listing_mode):
+    # 共有リンクの作成やアップロードでサーバーの状態が変わるので、モードごとにサーバーを起動し直す
+    print(f'--- {listing_mode} ---')
+    queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=run_server, args=(args, queue), daemon=True)
+    server.start()
+    base_url = queue.get(timeout=600)
+
+    client = BoxClient(access_token='bench', api_base=f'{base_url}/2.0', upload_base=f'{base_url}/api/2.0',
+                       rate=args.rate or None, backoff=0.05)
+    rss_before = peak_rss_mb()
+    started = time.perf_counter()
+    try:
+        result = indexer.run_index(client, max_workers=args.workers, listing_mode=listing_mode,
+                                   log=lambda *messages: None)
+    finally:
+        server.terminate()
+    elapsed = time.perf_counter() - started
+
+    with closing(sqlite3.connect(result['db_file_path'])) as conn:
+        rows = conn.execute('SELECT COUNT(*) FROM box_files').fetchone()[0]
+    db_size = os.path.getsize(result['db_file_path'])
+    os.remove(result['db_file_path'])
+
+    stats = sorted(client.stats.snapshot().items())
+    received_kb = sum(row['bytes_received'] for _, row in stats) / 1024
+    print(f'経過時間: {elapsed:.2f} 秒')
+    print(f'行数: {rows:,}（{rows / elapsed:,.0f} 行/秒）、DB {db_size / 1024 / 1024:.1f} MB')
+    print(f'APIコール: {sum(row["calls"] for _, row in stats):,} 件'
+          f'（再試行 {sum(row["retries"] for _, row in stats):,} 件、エラー {sum(row["errors"] for _, row in stats):,} 件）、'
+          f'受信 {received_kb:,.0f} KB')
+    print(f'ピークRSS: {peak_rss_mb():.0f} MB（開始時 {rss_before:.0f} MB）')
+    print(f'{"endpoint":<48}{"calls":>8}{"retries":>9}{"errors":>8}{"avg_ms":>9}{"max_ms":>9}{"recv_kb":>10}')
+    for endpoint, row in stats:
+        print(f'{endpoint:<48}{row["calls"]:>8}{row["retries"]:>9}{row["errors"]:>8}'
+              f'{row["avg_ms"]:>9.1f}{row["max_ms"]:>9.1f}{row["bytes_received"] / 1024:>10.0f}')
+    print(f'{"stage":<16}{"seconds":>9}{"items":>9}')
+    for stage in result['metrics'].stages():
+        print(f'{stage["stage"]:<16}{stage["seconds"]:>9.3f}{stage["items"]:>9}')
+    return {'mode': listing_mode, 'seconds': elapsed, 'rows': rows,
+            'calls': sum(row['calls'] for _, row in stats), 'received_kb': received_kb}
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# ズーム表示の2方式（拡大してから切り出す / 範囲を求めてから縮小する）を比較するベンチマーク
+#   python benchmarks/bench_viewport.py --width 6000 --height 4000
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+from image_render import render_viewport, render_viewport_resize_first, zoomed_size
+
+ZOOM_LEVELS = (0.5, 1.0, 1.5, 2.0, 4.0, 6.0, 10.0)
+
+
+def make_image(width, height):
+    # 単色だと速すぎるので、グラデーションのある画像を作る
+    gradient = Image.linear_gradient('L').resize((width, height))
+    return Image.merge('RGB', (gradient, gradient.rotate(90, expand=False), gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+
+
+def measure(func, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=6000)
+    parser.add_argument('--height', type=int, default=4000)
+    parser.add_argument('--repeat', type=int, default=3)
+    # 拡大後の画像がこれより大きくなる場合、従来方式は実行しない（メモリ不足で落ちるため）
+    parser.add_argument('--max-legacy-mb', type=float, default=2048)
+    args = parser.parse_args()
+
+    img = make_image(args.width, args.height)
+    bands = len(img.getbands())
+    print(f"image: {args.width}x{args.height} ({args.width * args.height / 1e6:.1f} MP)")
+    print(f"{'zoom':>6} {'resize-first ms':>16} {'intermediate MB':>16} {'crop-first ms':>14} {'output MB':>10}")
+
+    for zoom in ZOOM_LEVELS:
+        new_width, new_height = zoomed_size(img.size, zoom)
+        # 表示範囲は拡大後の画像の中央
+        x_offset = max(0, (new_width - args.width) // 2)
+        y_offset = max(0, (new_height - args.height) // 2)
+        intermediate_mb = new_width * new_height * bands / 1e6
+
+        if intermediate_mb <= args.max_legacy_mb:
+            legacy_ms = f"{measure(lambda: render_viewport_resize_first(img, zoom, x_offset, y_offset), args.repeat):16.1f}"
+        else:
+            legacy_ms = f"{'skipped':>16}"
+        output = render_viewport(img, zoom, x_offset, y_offset)
+        output_mb = output.width * output.height * bands / 1e6
+        viewport_ms = measure(lambda: render_viewport(img, zoom, x_offset, y_offset), args.repeat)
+        print(f"{zoom:6.1f} {legacy_ms} {intermediate_mb:16.1f} {viewport_ms:14.1f} {output_mb:10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,423 @@
+# ベンチマーク用の、ローカルで動くBox APIの代用サーバー
+# indexer（start.py）が使うエンドポイントだけを、合成したフォルダ階層に対して実装する。
+# 応答の遅延と429（流量制限）の発生率を指定できる。単独でも起動できる（index_cli.py の動作確認用）
+#   python benchmarks/mock_box.py --port 8765 --depth 3 --fanout 5 --files 50
+#   python index_cli.py run --auth ccg --token-url http://127.0.0.1:8765/oauth2/token \
+#       --api-base http://127.0.0.1:8765/2.0 --upload-base http://127.0.0.1:8765/api/2.0
+import argparse
+import base64
+import datetime
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from email import message_from_bytes
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+FOLDER_ID_START = 1000000
+FILE_ID_START = 5000000000
+UPLOAD_PART_SIZE = 8 * 1024 * 1024  # Boxの分割アップロードのパートサイズ（最小値）
+SEARCH_MAX_LIMIT = 200  # Boxの検索の上限（1ページの件数とoffset）
+SEARCH_MAX_OFFSET = 10000
+IMAGE_EXTENSIONS = ('jpg', 'jpeg', 'png', 'gif')
+OTHER_EXTENSIONS = ('txt', 'pdf', 'xlsx')
+
+
+def build_tree(depth=3, fanout=5, files_per_folder=50, image_ratio=0.8, shared_ratio=0.0, seed=0):
+    # ルート（ID "0"）から depth 階層、各フォルダに fanout 個のサブフォルダと files_per_folder 個のファイルを持つ階層を作る。
+    # 同じ引数なら同じ階層になる
+    rng = random.Random(seed)
+    folders = {'0': {'name': 'All Files', 'parent': None, 'children': [], 'files': []}}
+    files = {}
+    next_folder = FOLDER_ID_START
+    next_file = FILE_ID_START
+    level = ['0']
+    for current_depth in range(depth + 1):
+        next_level = []
+        for folder_id in level:
+            for index in range(files_per_folder):
+                extension = rng.choice(IMAGE_EXTENSIONS) if rng.random() < image_ratio else rng.choice(OTHER_EXTENSIONS)
+                file_id = str(next_file)
+                next_file += 1
+                files[file_id] = {
+                    'id': file_id,
+                    'name': f'file_{file_id}_{index}.{extension}',
+                    'parent': folder_id,
+                    'created_at': f'2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T00:00:00-00:00',
+                    'shared': rng.random() < shared_ratio,
+                    'version': '1',
+                    'content': None,
+                }
+                folders[folder_id]['files'].append(file_id)
+            if current_depth == depth:
+                continue
+            for index in range(fanout):
+                child_id = str(next_folder)
+                next_folder += 1
+                folders[child_id] = {'name': f'folder_{child_id}', 'parent': folder_id, 'children': [], 'files': []}
+                folders[folder_id]['children'].append(child_id)
+                next_level.append(child_id)
+        level = next_level
+    return {'folders': folders, 'files': files, 'next_file': next_file}
+
+
+def in_range(created_at, created_range):
+    # created_at_range は「開始,終了」（どちらも省略可）
+    created = datetime.datetime.fromisoformat(created_at)
+    start, end = created_range
+    return (start is None or start <= created) and (end is None or created <= end)
+
+
+def tree_size(depth, fanout, files_per_folder):
+    folders = sum(fanout ** level for level in range(depth + 1))
+    return folders, folders * files_per_folder
+
+
+# 一覧・検索で返す、どのファイルにも共通の小さなPNG（サムネイル作成などのダウンロード用）
+PLACEHOLDER_PNG = base64.b64decode(
+    'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=='
+)
+
+
+class MockBox:
+    def __init__(self, tree, latency=0.0, jitter=0.0, error_rate=0.0, retry_after=0.05, seed=0):
+        self.folders = tree['folders']
+        self.files = tree['files']
+        self.next_file = tree['next_file']
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.sessions = {}
+        self.search_cache = {}  # 検索条件ごとの一致したファイルID（ページごとに全件を調べ直さないように）
+        self.stream_position = 1
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def inject(self):
+        # 指定した遅延で待ち、指定した確率で429を返す
+        delay = self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        with self.lock:
+            throttled = self.error_rate and self.rng.random() < self.error_rate
+        if throttled:
+            self.count('429')
+        return throttled
+
+    def file_info(self, file_id, fields=None):
+        file = self.files[file_id]
+        content = file['content']
+        info = {
+            'type': 'file',
+            'id': file_id,
+            'name': file['name'],
+            'etag': file['version'],
+            'parent': {'type': 'folder', 'id': file['parent']},
+            'created_at': file['created_at'],
+            'size': len(content) if content is not None else len(PLACEHOLDER_PNG),
+            'sha1': hashlib.sha1(content if content is not None else PLACEHOLDER_PNG).hexdigest(),
+            'file_version': {'type': 'file_version', 'id': f"{file_id}{file['version']}"},
+            'shared_link': self.shared_link(file_id) if file['shared'] else None,
+            'path_collection': self.path_collection(file['parent']),
+        }
+        if fields:
+            return {key: value for key, value in info.items() if key in fields or key in ('type', 'id')}
+        return info
+
+    def path_collection(self, folder_id):
+        path = []
+        while folder_id is not None:
+            path.append({'type': 'folder', 'id': folder_id, 'name': self.folders[folder_id]['name']})
+            folder_id = self.folders[folder_id]['parent']
+        return {'total_count': len(path), 'entries': path[::-1]}
+
+    def shared_link(self, file_id):
+        return {'url': f'https://app.box.com/s/{file_id}', 'access': 'open'}
+
+    def folder_items(self, folder_id, limit, marker, fields):
+        folder = self.folders[folder_id]
+        items = [('folder', child_id) for child_id in folder['children']] + [('file', file_id) for file_id in folder['files']]
+        start = int(marker or 0)
+        page = items[start:start + limit]
+        entries = []
+        for item_type, item_id in page:
+            if item_type == 'folder':
+                entries.append({'type': 'folder', 'id': item_id, 'name': self.folders[item_id]['name']})
+            elif fields:
+                entries.append(self.file_info(item_id, fields))
+            else:
+                entries.append({'type': 'file', 'id': item_id, 'name': self.files[item_id]['name'], 'etag': '1'})
+        next_marker = str(start + limit) if start + limit < len(items) else None
+        return {'entries': entries, 'limit': limit, 'next_marker': next_marker}
+
+    def search(self, query, extensions, item_type, ancestor_ids, limit, offset, created_range=None, fields=None):
+        key = (query, frozenset(extensions or ()), item_type, frozenset(ancestor_ids or ()), tuple(created_range or ()))
+        with self.lock:
+            matches = self.search_cache.get(key)
+        if matches is None:
+            matches = self.search_matches(query, extensions, item_type, ancestor_ids, created_range)
+            with self.lock:
+                self.search_cache[key] = matches
+        page = matches[offset:offset + limit]
+        return {
+            'entries': [self.file_info(file_id, fields) for file_id in page],
+            'total_count': len(matches),
+            'limit': limit,
+            'offset': offset,
+        }
+
+    def search_matches(self, query, extensions, item_type, ancestor_ids, created_range):
+        if created_range:
+            created_range = [datetime.datetime.fromisoformat(value) if value else None for value in created_range]
+        matches = []
+        for file_id, file in list(self.files.items()):
+            name = file['name'].lower()
+            if query and query.lower() not in name:
+                continue
+            if extensions and name.rsplit('.', 1)[-1] not in extensions:
+                continue
+            if ancestor_ids and not self.is_under(file['parent'], ancestor_ids):
+                continue
+            if created_range and not in_range(file['created_at'], created_range):
+                continue
+            matches.append(file_id)
+        if item_type and item_type != 'file':
+            return []
+        return matches
+
+    def is_under(self, folder_id, ancestor_ids):
+        while folder_id is not None:
+            if folder_id in ancestor_ids:
+                return True
+            folder_id = self.folders[folder_id]['parent']
+        return False
+
+    def store_file(self, name, folder_id, content, file_id=None):
+        with self.lock:
+            self.search_cache.clear()
+            if file_id is None:
+                file_id = str(self.next_file)
+                self.next_file += 1
+                self.files[file_id] = {
+                    'id': file_id, 'name': name, 'parent': folder_id, 'shared': False, 'version': '0',
+                    'created_at': time.strftime('%Y-%m-%dT%H:%M:%S-00:00', time.gmtime()), 'content': None,
+                }
+                self.folders[folder_id]['files'].append(file_id)
+            file = self.files[file_id]
+            file['content'] = content
+            file['version'] = str(int(file['version']) + 1)
+        return self.file_info(file_id)
+
+    def delete_file(self, file_id):
+        with self.lock:
+            self.search_cache.clear()
+            file = self.files.pop(file_id)
+            self.folders[file['parent']]['files'].remove(file_id)
+
+
+class MockBoxHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # ヘッダーと本文を別々に書くので、遅延ACKで応答が40ms遅れないようにする
+    box = None  # serve() で MockBox を設定する
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body=None, headers=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_bytes(self, data):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def base_url(self):
+        return f'http://{self.headers["Host"]}'
+
+    def handle_request(self, method):
+        body = self.read_body()
+        url = urlsplit(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        parts = [part for part in url.path.split('/') if part]
+        box = self.box
+        box.count(f'{method} {url.path}')
+        if box.inject():
+            return self.send_json(429, {'type': 'error', 'status': 429, 'code': 'rate_limit_exceeded'},
+                                  {'Retry-After': str(box.retry_after)})
+        try:
+            if parts[:2] == ['api', '2.0']:
+                return self.handle_upload(method, parts[2:], params, body)
+            if parts[:1] == ['2.0']:
+                return self.handle_api(method, parts[1:], params, body)
+            if method == 'POST' and parts == ['oauth2', 'token']:
+                # どの認証方式でも同じトークンを返す
+                return self.send_json(200, {'access_token': 'mock', 'expires_in': 3600, 'token_type': 'bearer'})
+        except KeyError:
+            return self.send_json(404, {'type': 'error', 'status': 404, 'code': 'not_found'})
+        return self.send_json(404, {'type': 'error', 'status': 404})
+
+    def handle_api(self, method, parts, params, body):
+        box = self.box
+        if method == 'GET' and parts[:1] == ['folders'] and parts[2:] == ['items']:
+            fields = params.get('fields', '').split(',') if params.get('fields') else None
+            return self.send_json(200, box.folder_items(parts[1], int(params.get('limit', 100)), params.get('marker'), fields))
+        if parts[:1] == ['files'] and len(parts) == 2:
+            file_id = parts[1]
+            if method == 'GET':
+                fields = params.get('fields', '').split(',') if params.get('fields') else None
+                return self.send_json(200, box.file_info(file_id, fields))
+            if method == 'PUT':
+                request = json.loads(body or b'{}')
+                if 'shared_link' in request:
+                    box.files[file_id]['shared'] = True
+                return self.send_json(200, box.file_info(file_id))
+            if method == 'DELETE':
+                box.delete_file(file_id)
+                return self.send_json(204)
+        if method == 'GET' and parts[:1] == ['files'] and parts[2:] == ['content']:
+            content = box.files[parts[1]]['content']
+            return self.send_bytes(content if content is not None else PLACEHOLDER_PNG)
+        if method == 'GET' and parts == ['users', 'me']:
+            return self.send_json(200, {'type': 'user', 'id': '1', 'name': 'Mock User', 'login': 'mock@example.com'})
+        if method == 'GET' and parts == ['search']:
+            # Boxと同じく、queryは必須・limitとoffsetには上限がある
+            limit, offset = int(params.get('limit', 30)), int(params.get('offset', 0))
+            if not params.get('query') or limit > SEARCH_MAX_LIMIT or offset > SEARCH_MAX_OFFSET:
+                return self.send_json(400, {'type': 'error', 'status': 400, 'code': 'bad_request'})
+            extensions = set(params['file_extensions'].split(',')) if params.get('file_extensions') else None
+            ancestors = set(params['ancestor_folder_ids'].split(',')) if params.get('ancestor_folder_ids') else None
+            created_range = params['created_at_range'].split(',') if params.get('created_at_range') else None
+            fields = params['fields'].split(',') if params.get('fields') else None
+            return self.send_json(200, box.search(
+                params['query'], extensions, params.get('type'), ancestors, limit, offset, created_range, fields
+            ))
+        if method == 'GET' and parts == ['events']:
+            if params.get('stream_position') == 'now':
+                return self.send_json(200, {'entries': [], 'next_stream_position': box.stream_position})
+            return self.send_json(200, {'entries': [], 'next_stream_position': params.get('stream_position')})
+        return self.send_json(404, {'type': 'error', 'status': 404})
+
+    def handle_upload(self, method, parts, params, body):
+        box = self.box
+        if method == 'POST' and parts == ['files', 'content']:
+            attributes, content = self.parse_multipart(body)
+            return self.send_json(201, {'entries': [box.store_file(attributes['name'], attributes['parent']['id'], content)]})
+        if method == 'POST' and parts[:1] == ['files'] and parts[2:] == ['content']:
+            _, content = self.parse_multipart(body)
+            return self.send_json(201, {'entries': [box.store_file(None, None, content, parts[1])]})
+        if method == 'POST' and parts[-1:] == ['upload_sessions']:
+            request = json.loads(body)
+            session_id = uuid.uuid4().hex
+            file_id = parts[1] if len(parts) == 3 else None
+            box.sessions[session_id] = {'request': request, 'file_id': file_id, 'parts': {}}
+            endpoint = f'{self.base_url()}/api/2.0/files/upload_sessions/{session_id}'
+            return self.send_json(201, {
+                'id': session_id,
+                'part_size': UPLOAD_PART_SIZE,
+                'total_parts': -(-request['file_size'] // UPLOAD_PART_SIZE),
+                'session_endpoints': {
+                    'upload_part': endpoint,
+                    'commit': f'{endpoint}/commit',
+                    'list_parts': f'{endpoint}/parts',
+                    'abort': endpoint,
+                },
+            })
+        if parts[:2] == ['files', 'upload_sessions']:
+            session = box.sessions[parts[2]]
+            if method == 'PUT':
+                offset = int(self.headers['Content-Range'].split()[1].split('-')[0])
+                part = {'part_id': uuid.uuid4().hex[:8].upper(), 'offset': offset, 'size': len(body),
+                        'sha1': hashlib.sha1(body).hexdigest()}
+                session['parts'][offset] = (part, body)
+                return self.send_json(200, {'part': part})
+            if method == 'GET' and parts[3:] == ['parts']:
+                entries = [part for part, _ in sorted(session['parts'].values(), key=lambda item: item[0]['offset'])]
+                return self.send_json(200, {'entries': entries, 'total_count': len(entries)})
+            if method == 'POST' and parts[3:] == ['commit']:
+                content = b''.join(data for _, data in sorted(session['parts'].values(), key=lambda item: item[0]['offset']))
+                request = session['request']
+                info = box.store_file(request.get('file_name'), request.get('folder_id'), content, session['file_id'])
+                del box.sessions[parts[2]]
+                return self.send_json(201, {'entries': [info]})
+        return self.send_json(404, {'type': 'error', 'status': 404})
+
+    def parse_multipart(self, body):
+        message = message_from_bytes(
+            f'Content-Type: {self.headers["Content-Type"]}\r\n\r\n'.encode('latin-1') + body, policy=HTTP
+        )
+        attributes = {}
+        content = b''
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if name == 'attributes':
+                attributes = json.loads(part.get_content())
+            elif name == 'file':
+                content = part.get_payload(decode=True)
+        return attributes, content
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+
+def serve(box, host='127.0.0.1', port=0):
+    # 別スレッドでサーバーを起動し、(サーバー, ベースURL) を返す
+    handler = type('Handler', (MockBoxHandler,), {'box': box})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://{host}:{server.server_address[1]}'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=5)
+    parser.add_argument('--files', type=int, default=50)
+    parser.add_argument('--image-ratio', type=float, default=0.8)
+    parser.add_argument('--shared-ratio', type=float, default=0.0)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    tree = build_tree(args.depth, args.fanout, args.files, args.image_ratio, args.shared_ratio, args.seed)
+    box = MockBox(tree, args.latency_ms / 1000, error_rate=args.error_rate, seed=args.seed)
+    server, base_url = serve(box, port=args.port)
+    print(f'{base_url} で待ち受けています。（フォルダ {len(tree["folders"]):,} 件、ファイル {len(tree["files"]):,} 件）', flush=True)
+    threading.Event().wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import os
+
+from box_client import BoxClient
+
+# 画面を使わない実行（コマンドライン・バッチ）のための認証。
+# 'ccg': Client Credentials Grant（サーバー認証のアプリ。クライアントIDとシークレットだけで取得できる）
+# 'jwt': JWT（Box開発者コンソールからダウンロードした設定ファイル。boxsdk[jwt] が必要）
+# 'token': 取得済みのアクセストークンをそのまま使う（開発者トークンやモックサーバー向け）
+# 設定はすべて辞書で持つので、ワーカープロセスへそのまま渡してプロセスごとにトークンを取得できる
+
+TOKEN_URL = 'https://api.box.com/oauth2/token'
+AUTH_MODES = ('ccg', 'jwt', 'token')
+SUBJECT_TYPES = ('enterprise', 'user')
+
+
+class AuthError(Exception):
+    pass
+
+
+def auth_settings_from_env(mode, **overrides):
+    # 指定のない値は環境変数から読む（シークレットをコマンドラインの引数に書かずに済むように）
+    settings = {
+        'mode': mode,
+        'client_id': os.environ.get('BOX_CLIENT_ID'),
+        'client_secret': os.environ.get('BOX_CLIENT_SECRET'),
+        'subject_type': os.environ.get('BOX_SUBJECT_TYPE', 'enterprise'),
+        'subject_id': os.environ.get('BOX_SUBJECT_ID'),
+        'config': os.environ.get('BOX_JWT_CONFIG'),
+        'token': os.environ.get('BOX_ACCESS_TOKEN'),
+        'token_url': TOKEN_URL,
+    }
+    settings.update({key: value for key, value in overrides.items() if value is not None})
+    return settings
+
+
+def ccg_token(client, settings):
+    data = {
+        'grant_type': 'client_credentials',
+        'client_id': settings['client_id'],
+        'client_secret': settings['client_secret'],
+        'box_subject_type': settings['subject_type'],
+        'box_subject_id': settings['subject_id'],
+    }
+    response = client.post(settings['token_url'], data=data, headers={'Authorization': None})
+    if response.status_code != 200:
+        raise AuthError(f"アクセストークンの取得に失敗しました。"
+                        f"エラーメッセージ: {response.json().get('error_description')}")
+    return response.json()['access_token']
+
+
+def jwt_token(settings):
+    try:
+        from boxsdk import JWTAuth
+    except ImportError as e:
+        raise AuthError("JWT認証には boxsdk[jwt] が必要です。") from e
+    auth = JWTAuth.from_settings_file(settings['config'])
+    if settings['subject_type'] == 'user':
+        return auth.authenticate_user(settings['subject_id'])
+    return auth.authenticate_instance(settings['subject_id'])
+
+
+def fetch_token(client, settings):
+    if settings['mode'] == 'ccg':
+        return ccg_token(client, settings)
+    if settings['mode'] == 'jwt':
+        return jwt_token(settings)
+    if settings['mode'] == 'token':
+        if not settings['token']:
+            raise AuthError("アクセストークンが指定されていません。")
+        return settings['token']
+    raise AuthError(f"不明な認証方式です: {settings['mode']}")
+
+
+def make_client(settings, **client_options):
+    # トークンを取得したクライアントを返す。期限が切れたら同じ設定で取り直す
+    client = BoxClient(**client_options)
+    if settings['mode'] != 'token':
+        client.token_provider = lambda: fetch_token(client, settings)
+    client.access_token = fetch_token(client, settings)
+    return client
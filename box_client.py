@@ -0,0 +1,243 @@
+import random
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+
+API_BASE = 'https://api.box.com/2.0'
+UPLOAD_BASE = 'https://upload.box.com/api/2.0'
+
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF = 0.5  # 再試行までの待ち時間の初期値（秒）。再試行ごとに2倍になる
+MAX_BACKOFF = 60.0
+DEFAULT_RATE = 15.0  # 1秒あたりのリクエスト数の上限（Boxの上限はユーザーあたり毎分1000件）
+DEFAULT_BURST = 30
+DEFAULT_POOL_SIZE = 32
+DEFAULT_TIMEOUT = 60
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}  # 同じリクエストを送り直しても結果が変わらないメソッド
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)  # レイテンシのヒストグラムの上限値
+
+
+def endpoint_name(method, url):
+    # 集計用にURLのIDを {id} に置き換える（例: GET /folders/{id}/items）
+    path = urlsplit(url).path
+    path = re.sub(r'^/(api/)?2\.0', '', path)
+    path = re.sub(r'/\d+(?=/|$)', '/{id}', path)
+    path = re.sub(r'/upload_sessions/[0-9A-Fa-f]+', '/upload_sessions/{id}', path)
+    return f'{method.upper()} {path}'
+
+
+def retry_after_seconds(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def request_not_sent(error):
+    # 接続を確立できずにリクエストを送らなかった失敗か（名前解決・接続の拒否・接続のタイムアウト）。
+    # urllib3の NewConnectionError は ConnectTimeoutError の派生クラス
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, ConnectTimeoutError)
+
+
+def request_bytes(response):
+    # 送信した本文の大きさ（ストリームを送った場合もContent-Lengthが付く）
+    return int(response.request.headers.get('Content-Length') or 0)
+
+
+def response_bytes(response, stream=False):
+    # 受信した本文の大きさ。stream=True の応答は本文を読まずにContent-Lengthで数える
+    length = response.headers.get('Content-Length')
+    if length:
+        return int(length)
+    return 0 if stream else len(response.content)
+
+
+class TokenBucket:
+    # 一定の速度でトークンが補充され、1リクエストごとに1つ消費する
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class ApiStats:
+    # エンドポイントごとの呼び出し回数・再試行・エラー・レイテンシ・転送量（ワーカースレッドから更新される）。
+    # buckets は LATENCY_BUCKETS_MS の区間ごとの件数で、最後の要素はそれより遅かった件数
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {
+            'calls': 0, 'retries': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+            'bytes_sent': 0, 'bytes_received': 0, 'buckets': [0] * (len(LATENCY_BUCKETS_MS) + 1),
+        })
+
+    def record(self, endpoint, elapsed, status_code=None, retried=False, bytes_sent=0, bytes_received=0):
+        elapsed_ms = elapsed * 1000
+        bucket = bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)
+        with self._lock:
+            stats = self._stats[endpoint]
+            stats['calls'] += 1
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            stats['bytes_sent'] += bytes_sent
+            stats['bytes_received'] += bytes_received
+            stats['buckets'][bucket] += 1
+            if retried:
+                stats['retries'] += 1
+            if status_code is None or status_code >= 400:
+                stats['errors'] += 1
+
+    @property
+    def total(self):
+        with self._lock:
+            return sum(stats['calls'] for stats in self._stats.values())
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                endpoint: dict(stats, buckets=list(stats['buckets']),
+                               avg_ms=stats['total_ms'] / stats['calls'] if stats['calls'] else 0.0)
+                for endpoint, stats in self._stats.items()
+            }
+
+
+class BoxClient:
+    # すべてのBox API呼び出しで共有するクライアント。
+    # 接続の再利用、429/5xxの再試行（Retry-Afterを優先）、流量制限、エンドポイント別の集計を行う。
+    # api_base / upload_base を差し替えればローカルのモックサーバーに対しても動かせる。
+    # token_provider を渡すと、トークンの期限が切れた（401）ときに1回だけ取り直して再送する。
+    # POSTは送り直すと二重に処理される（アップロードが名前の衝突になる、認可コードを2回使う）ので、
+    # 429と、リクエストを送る前の接続の失敗だけを再試行する。送り直してよいPOSTは idempotent=True を指定する
+    def __init__(self, access_token=None, api_base=API_BASE, upload_base=UPLOAD_BASE,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF, rate=DEFAULT_RATE,
+                 burst=DEFAULT_BURST, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, token_provider=None):
+        self.access_token = access_token
+        self.token_provider = token_provider
+        self._token_lock = threading.Lock()
+        self.api_base = api_base.rstrip('/')
+        self.upload_base = upload_base.rstrip('/')
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.rate_limiter = TokenBucket(rate, burst) if rate else None
+        self.stats = ApiStats()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def api_url(self, path):
+        return f'{self.api_base}{path}'
+
+    def upload_url(self, path):
+        return f'{self.upload_base}{path}'
+
+    def _backoff_delay(self, attempt):
+        # 指数バックオフ（同時に再試行が集中しないよう揺らぎを加える）
+        delay = min(MAX_BACKOFF, self.backoff * (2 ** attempt))
+        return delay * random.uniform(0.5, 1.0)
+
+    def request(self, method, url, headers=None, max_retries=None, idempotent=None, **kwargs):
+        headers = dict(headers or {})
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        use_token = 'Authorization' not in headers
+        if self.access_token and use_token:
+            headers['Authorization'] = f'Bearer {self.access_token}'
+        kwargs.setdefault('timeout', self.timeout)
+        max_retries = self.max_retries if max_retries is None else max_retries
+        endpoint = endpoint_name(method, url)
+        # 再試行時にアップロードするストリームを先頭から送り直せるよう、位置を覚えておく
+        streams = [
+            (value[1], value[1].tell()) for value in (kwargs.get('files') or {}).values()
+            if isinstance(value, tuple) and len(value) > 1 and hasattr(value[1], 'seek')
+        ]
+        if hasattr(kwargs.get('data'), 'seek'):
+            streams.append((kwargs['data'], kwargs['data'].tell()))
+
+        attempt = 0
+        refreshed = False
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            for stream, position in streams:
+                stream.seek(position)
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, headers=headers, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.stats.record(endpoint, time.perf_counter() - started, retried=attempt > 0)
+                if attempt >= max_retries or not (idempotent or request_not_sent(e)):
+                    raise
+                time.sleep(self._backoff_delay(attempt))
+                attempt += 1
+                continue
+
+            self.stats.record(endpoint, time.perf_counter() - started, response.status_code, retried=attempt > 0,
+                              bytes_sent=request_bytes(response), bytes_received=response_bytes(response, kwargs.get('stream')))
+            if response.status_code == 401 and use_token and self.token_provider and not refreshed:
+                response.close()
+                headers['Authorization'] = f'Bearer {self.refresh_token(headers.get("Authorization"))}'
+                refreshed = True
+                continue
+            retryable = response.status_code == 429 or (idempotent and response.status_code in RETRY_STATUSES)
+            if not retryable or attempt >= max_retries:
+                return response
+            delay = retry_after_seconds(response)
+            if delay is None:
+                delay = self._backoff_delay(attempt)
+            response.close()
+            time.sleep(min(delay, MAX_BACKOFF))
+            attempt += 1
+
+    def refresh_token(self, used_header=None):
+        # 複数のスレッドが同時に401を受け取っても、取り直すのは1回だけにする
+        with self._token_lock:
+            if used_header == f'Bearer {self.access_token}':
+                self.access_token = self.token_provider()
+            return self.access_token
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
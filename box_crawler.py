@@ -0,0 +1,248 @@
+import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+DEFAULT_MAX_WORKERS = 8  # 同時に実行するAPI呼び出しの上限
+PAGE_LIMIT = 1000  # 一覧取得1回あたりの最大件数（Boxの上限）
+
+# 一覧取得のモード
+# 'fields': 一覧のfieldsで必要な項目だけを取得し、ファイルごとのAPI呼び出しを行わない
+# 'file_info': 従来どおりファイルごとに GET /files/{id} を呼び出す
+# 'search': フォルダをたどらず、検索APIで指定の拡張子のファイルだけを取得する（search_files）
+TREE_LISTING_MODES = ('fields', 'file_info')
+LISTING_MODES = TREE_LISTING_MODES + ('search',)
+LISTING_FIELDS = 'type,id,name,parent,created_at,shared_link,file_version'
+
+SEARCH_PAGE_LIMIT = 200  # 検索1回あたりの最大件数（Boxの上限）
+SEARCH_MAX_OFFSET = 10000  # 検索のoffsetの上限。これを超える件数は作成日時の範囲を分けて取得する
+SEARCH_FIELDS = LISTING_FIELDS + ',path_collection'
+SEARCH_EPOCH = datetime.datetime(2005, 1, 1, tzinfo=datetime.timezone.utc)  # 作成日時の範囲を分けるときの下限
+
+
+def get_folder_page(client, folder_id, marker=None, fields=None):
+    # フォルダ一覧を1ページ分取得し、(エントリ一覧, 次ページのマーカー) を返す
+    url = client.api_url(f'/folders/{folder_id}/items')
+    params = {'limit': PAGE_LIMIT, 'usemarker': 'true'}
+    if marker:
+        params['marker'] = marker
+    if fields:
+        params['fields'] = fields
+    response = client.get(url, params=params)
+
+    if response.status_code == 200:
+        body = response.json()
+        return body.get('entries', []), body.get('next_marker') or None
+    return None
+
+
+def iter_folder_pages(client, folder_id, fields=None, on_error=None):
+    # マーカー方式のページングで、フォルダ一覧をページが届くたびに返すジェネレータ
+    marker = None
+    while True:
+        page = get_folder_page(client, folder_id, marker, fields)
+        if page is None:
+            if on_error:
+                on_error("ファイルの取得に失敗しました。")
+            return
+        entries, marker = page
+        yield entries
+        if not marker:
+            return
+
+
+def iter_folder_items(client, folder_id, fields=None, on_error=None):
+    for entries in iter_folder_pages(client, folder_id, fields, on_error):
+        yield from entries
+
+
+def get_file_info(client, file_id):
+    url = client.api_url(f'/files/{file_id}')
+    response = client.get(url)
+
+    if response.status_code == 200:
+        return response.json()
+    return None
+
+
+def crawl_files(client, folder_id='0', max_workers=DEFAULT_MAX_WORKERS, on_progress=None, on_error=None,
+                listing_mode='fields', on_folder=None, frontier=None, on_page=None):
+    # フォルダ一覧とファイル情報の取得をスレッドプールで並列に実行し、
+    # 取得できたファイル情報を完了順に返すジェネレータ。
+    # コールバックはすべて呼び出し元のスレッドで実行されるので、Streamlitの描画を行ってもよい。
+    # on_folder(フォルダID, 親フォルダID) は見つかったサブフォルダごとに呼ばれる。
+    # frontier に [(フォルダID, マーカー), ...] を渡すと、folder_id ではなくそのページから再開する。
+    # on_page(フォルダID, 次ページのマーカー, サブフォルダIDの一覧) は、そのページのファイルを
+    # すべて返し終えたあとに呼ばれる（途中経過の保存に使う）
+    if listing_mode not in TREE_LISTING_MODES:
+        raise ValueError(f"不明な一覧取得モードです: {listing_mode}")
+    fields = LISTING_FIELDS if listing_mode == 'fields' else None
+    if frontier is None:
+        frontier = [(folder_id, None)]
+    progress = {'folders_total': len(frontier), 'folders_done': 0, 'pages': 0, 'files_total': 0, 'files_done': 0}
+    executor = ThreadPoolExecutor(max_workers=max(1, int(max_workers)))
+    pending = {}
+
+    def submit_folder(target_id, marker=None):
+        # フォルダ一覧はページ単位で取得し、次のページは前のページが届いてから依頼する
+        future = executor.submit(get_folder_page, client, target_id, marker, fields)
+        pending[future] = ('folder', target_id, None)
+
+    def submit_file(file_id, page):
+        future = executor.submit(get_file_info, client, file_id)
+        pending[future] = ('file', file_id, page)
+        page['remaining'] += 1
+
+    def finish_page(page):
+        page['remaining'] -= 1
+        if page['remaining'] == 0 and on_page:
+            on_page(page['folder_id'], page['next_marker'], page['folders'])
+
+    try:
+        for target_id, marker in frontier:
+            submit_folder(target_id, marker)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, item_id, page = pending.pop(future)
+                result = future.result()
+
+                if kind == 'folder':
+                    if result is None:
+                        progress['folders_done'] += 1
+                        if on_error:
+                            on_error("ファイルの取得に失敗しました。")
+                        continue
+                    entries, next_marker = result
+                    progress['pages'] += 1
+                    if next_marker:
+                        submit_folder(item_id, next_marker)
+                    else:
+                        progress['folders_done'] += 1
+                    page = {'folder_id': item_id, 'next_marker': next_marker, 'folders': [], 'remaining': 1}
+                    for item in entries:
+                        if item['type'] == 'file':
+                            progress['files_total'] += 1
+                            if fields:
+                                # 一覧に必要な項目が含まれているのでそのまま返す
+                                progress['files_done'] += 1
+                                yield item
+                            else:
+                                submit_file(item['id'], page)
+                        elif item['type'] == 'folder':
+                            progress['folders_total'] += 1
+                            page['folders'].append(item['id'])
+                            if on_folder:
+                                on_folder(item['id'], item_id)
+                            submit_folder(item['id'])
+                    finish_page(page)
+                else:
+                    progress['files_done'] += 1
+                    if result is None:
+                        if on_error:
+                            on_error(f"ファイル情報の取得に失敗しました。ファイルID: {item_id}")
+                    else:
+                        yield result
+                    finish_page(page)
+
+            if on_progress:
+                on_progress(dict(progress))
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def get_search_page(client, extension, offset=0, folder_id='0', created_range=None):
+    # 名前が拡張子 extension のファイルの検索結果を1ページ取得し、(エントリ一覧, 全件数) を返す。
+    # 検索APIはqueryが必須なので、拡張子そのものを名前だけから探す
+    params = {
+        'query': extension,
+        'content_types': 'name',
+        'file_extensions': extension,
+        'type': 'file',
+        'limit': SEARCH_PAGE_LIMIT,
+        'offset': offset,
+        'fields': SEARCH_FIELDS,
+    }
+    if folder_id != '0':
+        params['ancestor_folder_ids'] = folder_id
+    if created_range:
+        params['created_at_range'] = ','.join(f'{value:%Y-%m-%dT%H:%M:%SZ}' for value in created_range)
+    response = client.get(client.api_url('/search'), params=params)
+
+    if response.status_code == 200:
+        body = response.json()
+        return body.get('entries', []), body.get('total_count', 0)
+    return None
+
+
+def split_range(created_range):
+    # 作成日時の範囲 (開始, 終了) を重ならない2つに分ける。1秒より細かくは分けられないので None
+    start, end = created_range or (SEARCH_EPOCH, datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0))
+    if end <= start:
+        return None
+    middle = start + datetime.timedelta(seconds=(end - start).total_seconds() // 2)
+    return (start, middle), (middle + datetime.timedelta(seconds=1), end)
+
+
+def search_files(client, extensions, folder_id='0', max_workers=DEFAULT_MAX_WORKERS, on_progress=None, on_error=None,
+                 on_folder=None, max_offset=SEARCH_MAX_OFFSET):
+    # フォルダをたどらずに、検索APIで拡張子が extensions のファイルだけを取得して届いた順に返すジェネレータ。
+    # 拡張子ごとに検索し、最初のページで全件数が分かったら残りのページはまとめて並列に依頼する。
+    # 全件数がoffsetの上限を超える検索は、作成日時の範囲を半分ずつに分けて検索し直す。
+    # フォルダ一覧は読まないので、on_folder は結果の path_collection（ルートから親までのフォルダ）から呼ぶ。
+    # 検索のインデックスは更新が数分遅れるため、直前に追加・移動したファイルは含まれないことがある
+    progress = {'folders_total': 0, 'folders_done': 0, 'searches': 0, 'pages': 0, 'files_total': 0, 'files_done': 0}
+    executor = ThreadPoolExecutor(max_workers=max(1, int(max_workers)))
+    pending = {}
+    folders = set()
+
+    def submit_page(extension, offset=0, created_range=None):
+        future = executor.submit(get_search_page, client, extension, offset, folder_id, created_range)
+        pending[future] = (extension, offset, created_range)
+
+    def add_folders(item):
+        path = [entry['id'] for entry in item.get('path_collection', {}).get('entries', [])]
+        for parent_id, child_id in zip(path, path[1:]):
+            if child_id not in folders:
+                folders.add(child_id)
+                progress['folders_total'] += 1
+                progress['folders_done'] += 1
+                if on_folder:
+                    on_folder(child_id, parent_id)
+
+    try:
+        for extension in extensions:
+            submit_page(extension)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                extension, offset, created_range = pending.pop(future)
+                result = future.result()
+                if result is None:
+                    if on_error:
+                        on_error(f"ファイルの検索に失敗しました。拡張子: {extension}、offset: {offset}")
+                    continue
+                entries, total_count = result
+
+                if offset == 0:
+                    halves = split_range(created_range) if total_count > max_offset else None
+                    if halves:
+                        # このページは捨て、範囲を分けた検索で取り直す
+                        for half in halves:
+                            submit_page(extension, 0, half)
+                        continue
+                    if total_count > max_offset and on_error:
+                        on_error(f"検索結果が多すぎるため、先頭の {max_offset} 件だけを取得します。拡張子: {extension}")
+                    progress['searches'] += 1
+                    progress['files_total'] += min(total_count, max_offset)
+                    for next_offset in range(SEARCH_PAGE_LIMIT, min(total_count, max_offset), SEARCH_PAGE_LIMIT):
+                        submit_page(extension, next_offset, created_range)
+
+                progress['pages'] += 1
+                for item in entries:
+                    add_folders(item)
+                    progress['files_done'] += 1
+                    yield item
+
+            if on_progress:
+                on_progress(dict(progress))
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,124 @@
+import datetime
+import json
+import uuid
+
+UPLOAD_MODES = ('full', 'delta')
+BASE_DB_NAME = 'box_files_base.db'
+DELTA_PREFIX = 'box_files_delta_'
+DELTA_EXTENSION = 'ndjson'
+COMPACT_AFTER = 30  # 差分ファイルがこの数を超えたらベースを作り直す
+
+# 差分として記録するテーブル（テーブル名 → (主キー, 列)）
+DELTA_TABLES = {
+    'box_files': ('id', ('id', 'name', 'folder_id', 'created_at', 'shared_link', 'file_version')),
+    'box_folders': ('id', ('id', 'parent_id')),
+    'sync_state': ('key', ('key', 'value')),
+}
+
+
+def delta_file_name():
+    # 日時（マイクロ秒まで）で名前順が作成順になり、同時に作っても末尾の乱数で名前が重ならない
+    return f"{DELTA_PREFIX}{datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')}_{uuid.uuid4().hex[:8]}.{DELTA_EXTENSION}"
+
+
+def is_delta_file_name(name):
+    return name.startswith(DELTA_PREFIX) and name.endswith(f'.{DELTA_EXTENSION}')
+
+
+def install_change_log(conn):
+    # 変更をdelta_logへ記録するトリガーを作る（差分を書き出したあとはremove_change_logで外す）
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS delta_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            tbl TEXT,
+            op TEXT,
+            row TEXT
+        )
+    ''')
+    for table, (key, columns) in DELTA_TABLES.items():
+        new_row = ', '.join(f"'{column}', NEW.{column}" for column in columns)
+        for event in ('INSERT', 'UPDATE'):
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS delta_{table}_{event.lower()} AFTER {event} ON {table}
+                BEGIN
+                    INSERT INTO delta_log (tbl, op, row) VALUES ('{table}', 'upsert', json_object({new_row}));
+                END
+            ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS delta_{table}_delete AFTER DELETE ON {table}
+            BEGIN
+                INSERT INTO delta_log (tbl, op, row) VALUES ('{table}', 'delete', json_object('{key}', OLD.{key}));
+            END
+        ''')
+    conn.commit()
+
+
+def remove_change_log(conn):
+    for table in DELTA_TABLES:
+        for event in ('insert', 'update', 'delete'):
+            conn.execute(f'DROP TRIGGER IF EXISTS delta_{table}_{event}')
+    conn.execute('DROP TABLE IF EXISTS delta_log')
+    conn.commit()
+
+
+def export_changes(conn, stream):
+    # 記録された変更を1行1件のJSON（NDJSON）として書き出し、件数を返す
+    count = 0
+    for table, op, row in conn.execute('SELECT tbl, op, row FROM delta_log ORDER BY seq'):
+        line = json.dumps({'table': table, 'op': op, 'row': json.loads(row)}, ensure_ascii=False)
+        stream.write(line.encode('utf-8') + b'\n')
+        count += 1
+    return count
+
+
+def apply_delta(conn, lines):
+    # 差分ファイルの各行を順に適用する（同じ差分を2回適用しても結果は変わらない）
+    count = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        change = json.loads(line)
+        key, columns = DELTA_TABLES[change['table']]
+        row = change['row']
+        if change['op'] == 'delete':
+            conn.execute(f"DELETE FROM {change['table']} WHERE {key} = ?", (row[key],))
+        else:
+            conn.execute(
+                f"INSERT OR REPLACE INTO {change['table']} ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' for _ in columns)})",
+                tuple(row.get(column) for column in columns)
+            )
+        count += 1
+    conn.commit()
+    return count
+
+
+def get_last_delta(conn):
+    # 以前の形式のベースが持つ、取り込み済みの最後の差分ファイル名
+    row = conn.execute("SELECT value FROM sync_state WHERE key = 'last_delta'").fetchone()
+    return row[0] if row else None
+
+
+def get_applied_deltas(conn):
+    # ベースに取り込み済みの差分ファイル名の集合。記録がない（以前の形式の）ベースでは None
+    row = conn.execute("SELECT value FROM sync_state WHERE key = 'applied_deltas'").fetchone()
+    return set(json.loads(row[0])) if row else None
+
+
+def set_applied_deltas(conn, names):
+    # None を渡すと記録を消す（ベースの更新に失敗したときに元へ戻すため）
+    if names is None:
+        conn.execute("DELETE FROM sync_state WHERE key = 'applied_deltas'")
+    else:
+        conn.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES ('applied_deltas', ?)",
+                     (json.dumps(sorted(names)),))
+    conn.commit()
+
+
+def pending_deltas(delta_files, applied=None, last_delta=None):
+    # まだベースに取り込まれていない差分を作成順（名前順）に返す。
+    # 取り込み済みかどうかは名前の集合で判定する（名前の大小で判定すると、同じ日時の差分を飛ばしてしまう）
+    files = sorted((file for file in delta_files if is_delta_file_name(file['name'])), key=lambda file: file['name'])
+    if applied is not None:
+        return [file for file in files if file['name'] not in applied]
+    return [file for file in files if not last_delta or file['name'] > last_delta]
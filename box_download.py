@@ -0,0 +1,79 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+DB_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'box_db_cache')
+CHUNK_SIZE = 1024 * 1024  # ダウンロード時に一度に読み書きするバイト数
+DOWNLOAD_FIELDS = 'id,name,size,sha1,file_version'
+
+
+class DownloadError(Exception):
+    pass
+
+
+def get_download_info(client, file_info):
+    # 検証とキャッシュに使う size / sha1 / file_version が揃っていなければ取り直す
+    if all(file_info.get(field) for field in ('size', 'sha1', 'file_version')):
+        return file_info
+    url = client.api_url(f"/files/{file_info['id']}")
+    response = client.get(url, params={'fields': DOWNLOAD_FIELDS})
+    if response.status_code != 200:
+        raise DownloadError(f"ファイル情報の取得に失敗しました。ファイルID: {file_info['id']}")
+    return response.json()
+
+
+def download_to_file(client, file_info, dest_path):
+    # チャンク単位でファイルへ直接書き込み、サイズとSHA1をBoxのメタデータと照合する
+    url = client.api_url(f"/files/{file_info['id']}/content")
+    part_path = dest_path + '.part'
+    sha1 = hashlib.sha1()
+    size = 0
+    with client.get(url, stream=True) as response:
+        if response.status_code != 200:
+            raise DownloadError(f"ファイルのダウンロードに失敗しました。ステータスコード: {response.status_code}")
+        with open(part_path, 'wb') as part_file:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                sha1.update(chunk)
+                size += len(chunk)
+                part_file.write(chunk)
+
+    expected_size = file_info.get('size')
+    expected_sha1 = file_info.get('sha1')
+    if (expected_size is not None and size != expected_size) or (expected_sha1 and sha1.hexdigest() != expected_sha1):
+        os.remove(part_path)
+        raise DownloadError(
+            f"ダウンロードしたファイルが一致しません。サイズ: {size}/{expected_size}, "
+            f"SHA1: {sha1.hexdigest()}/{expected_sha1}"
+        )
+    os.replace(part_path, dest_path)
+
+
+def cache_path_for(file_info, cache_dir=DB_CACHE_DIR):
+    version = (file_info.get('file_version') or {}).get('id') or file_info['sha1']
+    return os.path.join(cache_dir, f"{file_info['id']}_{version}.db")
+
+
+def prune_cache(file_id, keep_path, cache_dir=DB_CACHE_DIR):
+    # 同じファイルの古いバージョンはもう使わないので消す
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith(f'{file_id}_') and path != keep_path:
+            os.remove(path)
+
+
+def fetch_db_file(client, file_info, cache_dir=DB_CACHE_DIR):
+    # バージョンごとにローカルへキャッシュし、変わっていなければダウンロードしない。
+    # キャッシュは書き換えないよう、作業用の一時ファイルへコピーしてそのパスを返す。
+    file_info = get_download_info(client, file_info)
+    os.makedirs(cache_dir, exist_ok=True)
+    cached_path = cache_path_for(file_info, cache_dir)
+    cache_hit = os.path.exists(cached_path) and os.path.getsize(cached_path) == file_info['size']
+    if not cache_hit:
+        download_to_file(client, file_info, cached_path)
+        prune_cache(file_info['id'], cached_path, cache_dir)
+
+    with tempfile.NamedTemporaryFile(delete=False, suffix='.db') as temp_db:
+        with open(cached_path, 'rb') as cached_file:
+            shutil.copyfileobj(cached_file, temp_db, CHUNK_SIZE)
+        return temp_db.name, cache_hit
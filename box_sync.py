@@ -0,0 +1,192 @@
+SYNC_MODES = ('full', 'incremental')
+EVENTS_LIMIT = 500  # イベント取得1回あたりの最大件数
+
+# ファイル・フォルダが新しく現れた、または内容が変わったことを示すイベント
+UPSERT_EVENTS = {'ITEM_CREATE', 'ITEM_UPLOAD', 'ITEM_MOVE', 'ITEM_RENAME', 'ITEM_COPY', 'ITEM_UNDELETE_VIA_TRASH'}
+# ファイル・フォルダが消えたことを示すイベント
+DELETE_EVENTS = {'ITEM_TRASH'}
+# フォルダ配下を改めてクロールする必要があるイベント（移動・名前変更は配下の行に影響しない）
+FOLDER_CRAWL_EVENTS = {'ITEM_CREATE', 'ITEM_COPY', 'ITEM_UNDELETE_VIA_TRASH'}
+
+
+def ensure_sync_tables(conn):
+    # 同期位置とフォルダ階層を保存するテーブル（既存のDBにも後から追加できる）
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sync_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS box_folders (
+            id TEXT PRIMARY KEY,
+            parent_id TEXT
+        )
+    ''')
+    # 全件クロールの途中経過。root_id から始めたクロールで、まだ読み終えていないフォルダと次ページのマーカー
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS crawl_frontier (
+            root_id TEXT,
+            folder_id TEXT,
+            marker TEXT,
+            done INTEGER DEFAULT 0,
+            PRIMARY KEY (root_id, folder_id)
+        )
+    ''')
+
+
+def get_watermark(conn):
+    row = conn.execute("SELECT value FROM sync_state WHERE key = 'stream_position'").fetchone()
+    return row[0] if row else None
+
+
+def set_watermark(conn, stream_position):
+    conn.execute(
+        "INSERT OR REPLACE INTO sync_state (key, value) VALUES ('stream_position', ?)",
+        (str(stream_position),)
+    )
+
+
+def get_crawl_position(conn):
+    # 中断した全件クロールを始める前に取得した同期位置（再開しても、この位置から差分を拾う）
+    row = conn.execute("SELECT value FROM sync_state WHERE key = 'crawl_stream_position'").fetchone()
+    return row[0] if row else None
+
+
+def set_crawl_position(conn, stream_position):
+    if stream_position is None:
+        conn.execute("DELETE FROM sync_state WHERE key = 'crawl_stream_position'")
+    else:
+        conn.execute(
+            "INSERT OR REPLACE INTO sync_state (key, value) VALUES ('crawl_stream_position', ?)",
+            (str(stream_position),)
+        )
+
+
+def load_frontier(conn, root_id):
+    # 中断したクロールの残り [(フォルダID, マーカー), ...]。root_id のクロールが始まっていなければ None
+    rows = conn.execute(
+        'SELECT folder_id, marker, done FROM crawl_frontier WHERE root_id = ?', (root_id,)
+    ).fetchall()
+    if not rows:
+        return None
+    return [(folder_id, marker) for folder_id, marker, done in rows if not done]
+
+
+def start_frontier(conn, root_id):
+    conn.execute('INSERT OR IGNORE INTO crawl_frontier (root_id, folder_id) VALUES (?, ?)', (root_id, root_id))
+
+
+def checkpoint_pages(conn, root_id, pages):
+    # 書き込み済みになったページ [(フォルダID, 次ページのマーカー, サブフォルダIDの一覧), ...] を記録する
+    for folder_id, next_marker, subfolders in pages:
+        conn.execute(
+            'UPDATE crawl_frontier SET marker = ?, done = ? WHERE root_id = ? AND folder_id = ?',
+            (next_marker, 0 if next_marker else 1, root_id, folder_id)
+        )
+        conn.executemany(
+            'INSERT OR IGNORE INTO crawl_frontier (root_id, folder_id) VALUES (?, ?)',
+            ((root_id, child_id) for child_id in subfolders)
+        )
+        save_folders(conn, ((child_id, folder_id) for child_id in subfolders))
+
+
+def clear_frontier(conn, root_id):
+    conn.execute('DELETE FROM crawl_frontier WHERE root_id = ?', (root_id,))
+
+
+def save_folders(conn, folders):
+    conn.executemany('INSERT OR REPLACE INTO box_folders (id, parent_id) VALUES (?, ?)', folders)
+
+
+def delete_files(conn, file_ids):
+    conn.executemany('DELETE FROM box_files WHERE id = ?', ((file_id,) for file_id in file_ids))
+
+
+def delete_folder_subtree(conn, folder_id):
+    # box_foldersをたどって、削除されたフォルダ配下のファイルとフォルダをまとめて消す
+    subtree = '''
+        WITH RECURSIVE subtree(id) AS (
+            SELECT ?
+            UNION
+            SELECT box_folders.id FROM box_folders JOIN subtree ON box_folders.parent_id = subtree.id
+        )
+    '''
+    conn.execute(subtree + 'DELETE FROM box_files WHERE folder_id IN subtree', (folder_id,))
+    conn.execute(subtree + 'DELETE FROM box_folders WHERE id IN subtree', (folder_id,))
+
+
+def get_stream_position(client):
+    # 現在の同期位置を取得する（全件クロールの前に取得し、クロール中の変更も次回拾えるようにする）
+    url = client.api_url('/events')
+    params = {'stream_type': 'changes', 'stream_position': 'now'}
+    response = client.get(url, params=params)
+
+    if response.status_code == 200:
+        return response.json().get('next_stream_position')
+    return None
+
+
+def iter_event_pages(client, stream_position):
+    # 同期位置以降のイベントをページ単位で返す。各ページは (イベント一覧, 次の同期位置)
+    url = client.api_url('/events')
+    while True:
+        params = {'stream_type': 'changes', 'stream_position': stream_position, 'limit': EVENTS_LIMIT}
+        response = client.get(url, params=params)
+        if response.status_code != 200:
+            raise RuntimeError(f"イベントの取得に失敗しました。ステータスコード: {response.status_code}")
+
+        body = response.json()
+        entries = body.get('entries', [])
+        stream_position = body.get('next_stream_position', stream_position)
+        yield entries, stream_position
+        if not entries:
+            return
+
+
+def collect_changes(client, stream_position):
+    # イベントを項目ごとにまとめ、最後の状態だけを残す
+    changes = {
+        'files': {},           # 追加・更新されたファイル（ID → ファイル情報）
+        'deleted_files': set(),
+        'folders': {},         # 追加・移動されたフォルダ（ID → 親フォルダID）
+        'crawl_folders': set(),  # 配下をクロールし直すフォルダ
+        'deleted_folders': set(),
+        'stream_position': stream_position,
+    }
+    seen_events = set()
+
+    for entries, next_position in iter_event_pages(client, stream_position):
+        for event in entries:
+            # 同じイベントが複数回届くことがあるので重複を除く
+            if event.get('event_id') in seen_events:
+                continue
+            seen_events.add(event.get('event_id'))
+
+            source = event.get('source') or {}
+            event_type = event.get('event_type')
+            item_id = source.get('id')
+            if not item_id or source.get('type') not in ('file', 'folder'):
+                continue
+
+            if source['type'] == 'file':
+                if event_type in UPSERT_EVENTS:
+                    changes['files'][item_id] = source
+                    changes['deleted_files'].discard(item_id)
+                elif event_type in DELETE_EVENTS:
+                    changes['files'].pop(item_id, None)
+                    changes['deleted_files'].add(item_id)
+            else:
+                if event_type in UPSERT_EVENTS:
+                    parent = source.get('parent') or {}
+                    changes['folders'][item_id] = parent.get('id')
+                    changes['deleted_folders'].discard(item_id)
+                    if event_type in FOLDER_CRAWL_EVENTS:
+                        changes['crawl_folders'].add(item_id)
+                elif event_type in DELETE_EVENTS:
+                    changes['folders'].pop(item_id, None)
+                    changes['crawl_folders'].discard(item_id)
+                    changes['deleted_folders'].add(item_id)
+        changes['stream_position'] = next_position
+
+    return changes
@@ -0,0 +1,175 @@
+import base64
+import hashlib
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+CHUNKED_UPLOAD_THRESHOLD = 50 * 1024 * 1024  # これより大きいファイルは分割アップロードを使う（Boxの上限は50MB）
+DEFAULT_UPLOAD_WORKERS = 4
+SESSION_DIR = os.path.join(tempfile.gettempdir(), 'box_upload_sessions')
+COMMIT_RETRIES = 10
+
+
+class UploadError(Exception):
+    pass
+
+
+def sha1_digest(data):
+    return 'sha=' + base64.b64encode(hashlib.sha1(data).digest()).decode('ascii')
+
+
+def file_sha1_digest(file_path, chunk_size=1024 * 1024):
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as file_stream:
+        for chunk in iter(lambda: file_stream.read(chunk_size), b''):
+            sha1.update(chunk)
+    return 'sha=' + base64.b64encode(sha1.digest()).decode('ascii')
+
+
+def session_state_path(file_digest, file_size, target):
+    # 同じ内容（SHA1とサイズ）のファイルを同じアップロード先へ送るなら、前回のセッションを再開する。
+    # 作業用のDBは実行ごとに別の一時ファイルになるので、パスや更新時刻は使わない
+    key = f'{file_digest}:{file_size}:{target}'
+    return os.path.join(SESSION_DIR, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+
+def load_session_state(state_path):
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path, encoding='utf-8') as state_file:
+        state = json.load(state_file)
+    # 期限切れのセッションは使わない
+    if state.get('expires_at') and state['expires_at'] < time.time():
+        return None
+    return state
+
+
+def save_session_state(state_path, state):
+    os.makedirs(SESSION_DIR, exist_ok=True)
+    with open(state_path, 'w', encoding='utf-8') as state_file:
+        json.dump(state, state_file)
+
+
+def create_upload_session(client, file_size, file_name=None, folder_id=None, file_id=None):
+    # file_idがあれば既存ファイルの新しいバージョン、なければfolder_idに新規ファイルとして作る
+    if file_id:
+        url = client.upload_url(f'/files/{file_id}/upload_sessions')
+        body = {'file_size': file_size}
+    else:
+        url = client.upload_url('/files/upload_sessions')
+        body = {'file_size': file_size, 'file_name': file_name, 'folder_id': folder_id}
+    response = client.post(url, json=body)
+    if response.status_code != 201:
+        raise UploadError(f"アップロードセッションの作成に失敗しました。ステータスコード: {response.status_code}, レスポンス: {response.text}")
+    session = response.json()
+    return {
+        'id': session['id'],
+        'part_size': session['part_size'],
+        'total_parts': session['total_parts'],
+        'endpoints': session['session_endpoints'],
+        'expires_at': time.time() + 23 * 60 * 60,  # セッションの有効期限は作成から1日
+        'parts': {},
+    }
+
+
+def list_uploaded_parts(client, session):
+    # 再開時は、Box側で受け付け済みのパートをセッションから取り直す
+    parts = {}
+    offset = 0
+    while True:
+        response = client.get(session['endpoints']['list_parts'], params={'offset': offset, 'limit': 1000})
+        if response.status_code != 200:
+            return None
+        body = response.json()
+        for part in body.get('entries', []):
+            parts[str(part['offset'])] = part
+        offset += len(body.get('entries', []))
+        if not body.get('entries') or offset >= body.get('total_count', 0):
+            return parts
+
+
+def upload_part(client, session, file_path, offset, file_size):
+    length = min(session['part_size'], file_size - offset)
+    with open(file_path, 'rb') as file_stream:
+        file_stream.seek(offset)
+        data = file_stream.read(length)
+    headers = {
+        'Content-Type': 'application/octet-stream',
+        'Digest': sha1_digest(data),
+        'Content-Range': f'bytes {offset}-{offset + length - 1}/{file_size}',
+    }
+    response = client.put(session['endpoints']['upload_part'], headers=headers, data=data)
+    if response.status_code != 200:
+        raise UploadError(f"パートのアップロードに失敗しました。オフセット: {offset}, ステータスコード: {response.status_code}")
+    return response.json()['part']
+
+
+def commit_session(client, session, file_digest):
+    parts = sorted(session['parts'].values(), key=lambda part: part['offset'])
+    headers = {'Digest': file_digest}
+    for _ in range(COMMIT_RETRIES):
+        # コミットは同じパートの一覧で送り直してよい（Boxの仕様）ので、5xxや接続の失敗も再試行する
+        response = client.post(session['endpoints']['commit'], headers=headers, json={'parts': parts}, idempotent=True)
+        # 202 はBox側でパートを結合中なので、Retry-Afterだけ待ってからもう一度コミットする
+        if response.status_code == 202:
+            time.sleep(float(response.headers.get('Retry-After', 1)))
+            continue
+        if response.status_code != 201:
+            raise UploadError(f"アップロードのコミットに失敗しました。ステータスコード: {response.status_code}, レスポンス: {response.text}")
+        entries = response.json().get('entries', [])
+        return entries[0] if entries else None
+    raise UploadError("アップロードのコミットが完了しませんでした。")
+
+
+def chunked_upload(client, file_path, file_name=None, folder_id=None, file_id=None,
+                   max_workers=DEFAULT_UPLOAD_WORKERS, on_progress=None):
+    # アップロードセッションでパートを並列に送り、途中で失敗しても次回は残りのパートだけを送る。
+    # 再試行しても通信できなかった場合も UploadError にする（受け付け済みのパートはセッションに残る）
+    try:
+        return upload_session_parts(client, file_path, file_name, folder_id, file_id, max_workers, on_progress)
+    except requests.RequestException as e:
+        raise UploadError(f"アップロード中に通信エラーが発生しました。{e!r}") from e
+
+
+def upload_session_parts(client, file_path, file_name, folder_id, file_id, max_workers, on_progress):
+    file_size = os.path.getsize(file_path)
+    file_digest = file_sha1_digest(file_path)
+    state_path = session_state_path(file_digest, file_size, file_id or f'{folder_id}/{file_name}')
+    session = load_session_state(state_path)
+    if session:
+        uploaded = list_uploaded_parts(client, session)
+        if uploaded is None:
+            session = None
+        else:
+            session['parts'] = uploaded
+    if not session:
+        session = create_upload_session(client, file_size, file_name, folder_id, file_id)
+    save_session_state(state_path, session)
+
+    offsets = [offset for offset in range(0, file_size, session['part_size'])
+               if str(offset) not in session['parts']]
+    if on_progress:
+        on_progress(len(session['parts']), session['total_parts'])
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(upload_part, client, session, file_path, offset, file_size) for offset in offsets]
+        try:
+            for future in futures:
+                part = future.result()
+                session['parts'][str(part['offset'])] = part
+                save_session_state(state_path, session)
+                if on_progress:
+                    on_progress(len(session['parts']), session['total_parts'])
+        except Exception:
+            # 受け付け済みのパートは保存されているので、残りは次回の実行で送る
+            for future in futures:
+                future.cancel()
+            raise
+
+    uploaded_file = commit_session(client, session, file_digest)
+    os.remove(state_path)
+    return uploaded_file
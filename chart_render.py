@@ -0,0 +1,79 @@
+import hashlib
+import io
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from render_cache import LRUCache
+
+CHART_SIZE = (4, 3)  # 1つのグラフの大きさ（インチ）
+CHART_DPI = 72
+CHART_CACHE_BYTES = 32 * 1024 * 1024  # 描画済みPNGのキャッシュ上限
+
+
+def chart_data(seed, index, points=100):
+    # 同じシードと番号からは常に同じデータを作る（再実行のたびに変わるとキャッシュが効かない）
+    rng = np.random.default_rng([seed, index])
+    x = np.linspace(0, 10, points)
+    y = np.sin(x) + rng.normal(0, 0.1, x.size)
+    return x, y
+
+
+def data_hash(*parts):
+    sha1 = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            sha1.update(part.tobytes())
+        else:
+            sha1.update(repr(part).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+def figure_to_png(fig, dpi=CHART_DPI):
+    FigureCanvasAgg(fig)
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', dpi=dpi)
+    return buffer.getvalue()
+
+
+def render_chart_png(x, y, title, figsize=CHART_SIZE, dpi=CHART_DPI):
+    # pyplotを通さずFigureを直接作るので、グローバルな図の一覧に残らず、参照がなくなれば解放される
+    fig = Figure(figsize=figsize)
+    ax = fig.add_subplot()
+    ax.plot(x, y)
+    ax.set_title(title)
+    png = figure_to_png(fig, dpi)
+    fig.clear()
+    return png
+
+
+def render_grid_png(charts, cols, figsize=CHART_SIZE, dpi=CHART_DPI):
+    # 全グラフを1つのFigureのサブプロットとして描き、PNGを1枚だけ作る
+    rows = -(-len(charts) // cols)
+    fig = Figure(figsize=(figsize[0] * cols, figsize[1] * rows), layout='tight')
+    axes = fig.subplots(rows, cols, squeeze=False)
+    for ax, (x, y, title) in zip(axes.flat, charts):
+        ax.plot(x, y)
+        ax.set_title(title)
+    for ax in axes.flat[len(charts):]:
+        ax.set_axis_off()
+    png = figure_to_png(fig, dpi)
+    fig.clear()
+    return png
+
+
+class ChartCache:
+    # データのハッシュ → 描画済みPNG。同じデータのグラフは描き直さない
+    def __init__(self, max_bytes=CHART_CACHE_BYTES):
+        self.pngs = LRUCache(max_bytes)
+
+    def chart(self, x, y, title):
+        return self.pngs.get_or_create(data_hash(x, y, title), lambda: render_chart_png(x, y, title), len)
+
+    def grid(self, charts, cols):
+        key = data_hash(cols, *(part for chart in charts for part in chart))
+        return self.pngs.get_or_create(key, lambda: render_grid_png(charts, cols), len)
+
+    def stats(self):
+        return self.pngs.stats()
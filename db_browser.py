@@ -0,0 +1,307 @@
+import glob
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import urllib.parse
+import uuid
+import weakref
+
+import pandas as pd
+
+PAGE_SIZES = (50, 100, 500, 1000)
+DEFAULT_PAGE_SIZE = 100
+KEY_ALIAS = '_browse_key_'  # ページ位置の取得用に先頭へ付ける列の名前
+FILTER_OPERATORS = ('=', '!=', '>', '>=', '<', '<=', 'contains', 'starts with', 'is null', 'is not null')
+FTS_SCHEMA = 'fts'
+FTS_MIN_TERM = 3  # trigramトークナイザで検索できる最短の文字数
+UPLOAD_DIR = os.path.join(tempfile.gettempdir(), 'sqlite_viewer_uploads')
+SPILL_CHUNK = 1024 * 1024  # アップロードをディスクへ書き出すときの単位
+MMAP_SIZE = 1024 * 1024 * 1024  # 読み取り専用の接続でメモリマップする上限
+
+
+def quote_identifier(name):
+    # テーブル名・列名はパラメータにできないので、二重引用符でくくってから埋め込む
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def readonly_uri(path):
+    # immutable=1 はファイルが変わらない前提でロックや変更検知を省く（アップロードしたファイルは書き換えない）
+    return f'file:{urllib.parse.quote(os.path.abspath(path))}?mode=ro&immutable=1'
+
+
+def open_readonly(path):
+    conn = sqlite3.connect(readonly_uri(path), uri=True, check_same_thread=False, isolation_level=None)
+    conn.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+    return conn
+
+
+def _close_session(resources):
+    for conn in resources['connections'].values():
+        conn.close()
+    resources['connections'].clear()
+    shutil.rmtree(resources['dir'], ignore_errors=True)
+
+
+class SessionDatabases:
+    # セッションごとのアップロード置き場。アップロードは内容のハッシュをファイル名にして1回だけディスクへ書き出し、
+    # 読み取り専用の接続をセッションの間使い回す。セッションが終わりこのオブジェクトが破棄されたら、接続を閉じてファイルを消す
+    def __init__(self, upload_dir=UPLOAD_DIR):
+        self._resources = {'dir': os.path.join(upload_dir, uuid.uuid4().hex), 'connections': {}}
+        self._uploads = {}  # アップロードのID → 内容のハッシュ
+        self._finalizer = weakref.finalize(self, _close_session, self._resources)
+
+    def path(self, db_hash):
+        return os.path.join(self._resources['dir'], f'{db_hash}.db')
+
+    def fts_path(self, db_hash, table, columns):
+        # 全文検索の索引もセッションの置き場に作り、アップロードと一緒に片付ける
+        name = '\0'.join([table, *columns]).encode('utf-8')
+        return os.path.join(self._resources['dir'], f'{db_hash}_fts_{hashlib.sha1(name).hexdigest()}.db')
+
+    def spill(self, uploaded_file):
+        # 同じアップロードなら書き出しもハッシュの計算もしない
+        upload_id = getattr(uploaded_file, 'file_id', None) or id(uploaded_file)
+        if upload_id in self._uploads and os.path.exists(self.path(self._uploads[upload_id])):
+            return self._uploads[upload_id]
+
+        os.makedirs(self._resources['dir'], exist_ok=True)
+        part_path = os.path.join(self._resources['dir'], f'{uuid.uuid4().hex}.part')
+        sha1 = hashlib.sha1()
+        uploaded_file.seek(0)
+        with open(part_path, 'wb') as part_file:
+            for chunk in iter(lambda: uploaded_file.read(SPILL_CHUNK), b''):
+                sha1.update(chunk)
+                part_file.write(chunk)
+        db_hash = sha1.hexdigest()
+        if os.path.exists(self.path(db_hash)):
+            os.remove(part_path)
+        else:
+            os.replace(part_path, self.path(db_hash))
+        self._uploads[upload_id] = db_hash
+        return db_hash
+
+    def connection(self, uploaded_file):
+        # (接続, 内容のハッシュ) を返す。ほかのアップロードの接続とファイルは片付ける
+        db_hash = self.spill(uploaded_file)
+        self.release(keep=db_hash)
+        connections = self._resources['connections']
+        if db_hash not in connections:
+            connections[db_hash] = open_readonly(self.path(db_hash))
+        return connections[db_hash], db_hash
+
+    def release(self, keep=None):
+        connections = self._resources['connections']
+        for db_hash in [db_hash for db_hash in connections if db_hash != keep]:
+            connections.pop(db_hash).close()
+        for upload_id, db_hash in list(self._uploads.items()):
+            if db_hash != keep:
+                del self._uploads[upload_id]
+                for path in [self.path(db_hash), *glob.glob(os.path.join(self._resources['dir'], f'{db_hash}_fts_*'))]:
+                    if os.path.exists(path):
+                        os.remove(path)
+
+    def close(self):
+        self._finalizer()
+
+
+def column_sql(name):
+    return name if name == 'rowid' else quote_identifier(name)
+
+
+def list_tables(conn):
+    return [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+    )]
+
+
+def table_columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({quote_identifier(table)})')]
+
+
+def text_columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({quote_identifier(table)})')
+            if 'CHAR' in row[2].upper() or 'TEXT' in row[2].upper() or 'CLOB' in row[2].upper()]
+
+
+def has_rowid(conn, table):
+    try:
+        conn.execute(f'SELECT rowid FROM {quote_identifier(table)} LIMIT 0')
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+def key_columns(conn, table):
+    # 通常のテーブルはrowid、WITHOUT ROWIDのテーブルは主キーの列で並べてページを区切る
+    if has_rowid(conn, table):
+        return ['rowid']
+    pk = sorted((row[5], row[1]) for row in conn.execute(f'PRAGMA table_info({quote_identifier(table)})') if row[5])
+    return [name for _, name in pk]
+
+
+def estimate_row_count(conn, table):
+    # 全件を数えずに件数の目安を返す（求められなければNone）
+    # ANALYZE済みならsqlite_stat1の値、rowidのテーブルなら最大のrowid（削除が無ければ正確）を使う
+    try:
+        row = conn.execute(
+            'SELECT stat FROM sqlite_stat1 WHERE tbl = ? AND stat IS NOT NULL LIMIT 1', (table,)
+        ).fetchone()
+        if row:
+            return int(row[0].split()[0])
+    except sqlite3.OperationalError:
+        pass
+    if has_rowid(conn, table):
+        max_rowid = conn.execute(f'SELECT MAX(rowid) FROM {quote_identifier(table)}').fetchone()[0]
+        return max_rowid or 0
+    return None
+
+
+def count_rows(conn, table, where='', params=()):
+    where_sql = f'WHERE {where}' if where else ''
+    return conn.execute(f'SELECT COUNT(*) FROM {quote_identifier(table)} {where_sql}', list(params)).fetchone()[0]
+
+
+def like_pattern(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def filter_clause(column, operator, value=None):
+    # 列フィルタ1つ分の条件式とパラメータ。列名は引用符でくくり、値はすべてパラメータで渡す
+    column = column_sql(column)
+    if operator == 'is null':
+        return f'{column} IS NULL', []
+    if operator == 'is not null':
+        return f'{column} IS NOT NULL', []
+    if operator == 'contains':
+        return f"{column} LIKE ? ESCAPE '\\'", [f'%{like_pattern(value)}%']
+    if operator == 'starts with':
+        return f"{column} LIKE ? ESCAPE '\\'", [f'{like_pattern(value)}%']
+    if operator not in FILTER_OPERATORS:
+        raise ValueError(f'unknown operator: {operator}')
+    return f'{column} {operator} ?', [value]
+
+
+def fts_query(text):
+    # 語ごとに二重引用符でくくり、FTS5の演算子として解釈されないようにする
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in text.split())
+
+
+def search_clause(text, columns, use_fts=False):
+    # 全文検索。FTS索引があれば3文字以上の語は索引から引き、それ以外の語は各列をLIKEで探す
+    terms = text.split()
+    clauses = []
+    params = []
+    if use_fts:
+        fts_terms = [term for term in terms if len(term) >= FTS_MIN_TERM]
+        if fts_terms:
+            clauses.append(f'rowid IN (SELECT rowid FROM {FTS_SCHEMA}.search WHERE search MATCH ?)')
+            params.append(fts_query(' '.join(fts_terms)))
+        terms = [term for term in terms if len(term) < FTS_MIN_TERM]
+    for term in terms:
+        clauses.append('(' + ' OR '.join(f"{column_sql(column)} LIKE ? ESCAPE '\\'" for column in columns) + ')')
+        params.extend(f'%{like_pattern(term)}%' for _ in columns)
+    return ' AND '.join(clauses), params
+
+
+def build_where(filters=(), search=None, search_columns=(), use_fts=False):
+    # (列, 演算子, 値) のフィルタと検索語をまとめて WHERE 句にする。(句, パラメータ) を返す
+    clauses = []
+    params = []
+    for column, operator, value in filters:
+        clause, clause_params = filter_clause(column, operator, value)
+        clauses.append(clause)
+        params.extend(clause_params)
+    if search and search.split() and (search_columns or use_fts):
+        clause, clause_params = search_clause(search, search_columns, use_fts)
+        clauses.append(clause)
+        params.extend(clause_params)
+    return ' AND '.join(f'({clause})' for clause in clauses), params
+
+
+def attach_fts(conn, path):
+    # 検索用の索引は元のDBを書き換えないよう別ファイルに置き、ATTACHして使う。
+    # 接続を使い回すので、別の索引が付いていれば付け替える
+    attached = {row[1]: row[2] for row in conn.execute('PRAGMA database_list')}
+    if attached.get(FTS_SCHEMA) == os.path.abspath(path):
+        return True
+    if FTS_SCHEMA in attached:
+        conn.execute(f'DETACH DATABASE {FTS_SCHEMA}')
+    if not os.path.exists(path):
+        return False
+    conn.execute(f'ATTACH DATABASE ? AS {FTS_SCHEMA}', (readonly_uri(path),))
+    return True
+
+
+def build_fts_index(db_path, table, columns, path):
+    # trigramトークナイザで部分一致（3文字以上）も索引から引けるようにする。rowidは元のテーブルと揃える。
+    # 表示用の接続は読み取り専用（ATTACHしたDBにも書けない）なので、索引用のファイルに別の接続で書き込み、
+    # 元のDBは読み取り専用でATTACHして読む
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    column_list = ', '.join(quote_identifier(column) for column in columns)
+    build_path = path + '.building'
+    if os.path.exists(build_path):
+        os.remove(build_path)
+    conn = sqlite3.connect(build_path, uri=True)
+    try:
+        conn.execute('ATTACH DATABASE ? AS source', (readonly_uri(db_path),))
+        with conn:
+            conn.execute(f"CREATE VIRTUAL TABLE search USING fts5({column_list}, tokenize='trigram')")
+            conn.execute(
+                f'INSERT INTO search (rowid, {column_list}) '
+                f'SELECT rowid, {column_list} FROM source.{quote_identifier(table)}'
+            )
+            conn.execute("INSERT INTO search (search) VALUES ('optimize')")
+        conn.execute('DETACH DATABASE source')
+    finally:
+        conn.close()
+    os.replace(build_path, path)
+
+
+def fetch_page(conn, table, keys, after=None, page_size=DEFAULT_PAGE_SIZE,
+               where='', params=(), sort_column=None, descending=False):
+    # 並び順で after より後ろの行を page_size 件だけ読む（OFFSETと違い、後ろのページでも読み飛ばしが発生しない）
+    # 並べ替える列があれば (列, キー) の組で区切る。(DataFrame, 次のページの開始位置) を返す。最後のページでは None。
+    # 列はそのまま並べ替えて索引を使えるようにし、行値の比較で扱えないNULLの行は別の区間として読む
+    # （SQLiteの並び順どおり、昇順では先頭・降順では末尾）
+    key_sql = [column_sql(key) for key in keys]
+    order = key_sql
+    segments = [('', key_sql, 0)]  # (区間の条件, 開始位置と比べる列, after のうち比べる値の開始位置)
+    if sort_column:
+        column = column_sql(sort_column)
+        order = [column] + key_sql
+        nulls = (f'{column} IS NULL', key_sql, 1)
+        values = (f'{column} IS NOT NULL', order, 0)
+        segments = [values, nulls] if descending else [nulls, values]
+        if after is not None:
+            # 前のページの最後の行がNULLの区間にあれば、その区間から続ける
+            segments = segments[segments.index(nulls if after[0] is None else values):]
+
+    selected = ', '.join(f'{expression} AS {KEY_ALIAS}{index}' for index, expression in enumerate(order))
+    direction = ' DESC' if descending else ''
+    order_sql = ', '.join(expression + direction for expression in order)
+    frames = []
+    remaining = page_size
+    for condition, compared, skip in segments:
+        clauses = [f'({where})'] if where else []
+        clauses += [condition] if condition else []
+        segment_params = list(params)
+        if after is not None:
+            clauses.append(f"({', '.join(compared)}) {'<' if descending else '>'} ({', '.join('?' for _ in compared)})")
+            segment_params.extend(after[skip:])
+        where_sql = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        query = f'SELECT {selected}, * FROM {quote_identifier(table)} {where_sql} ORDER BY {order_sql} LIMIT ?'
+        frames.append(pd.read_sql(query, conn, params=segment_params + [remaining]))
+        remaining -= len(frames[-1])
+        if not remaining:
+            break
+        after = None  # 次の区間は先頭から読む
+    df = pd.concat([frame for frame in frames if len(frame)] or frames[:1], ignore_index=True)
+
+    key_names = [f'{KEY_ALIAS}{index}' for index in range(len(order))]
+    next_after = None
+    if len(df) == page_size:
+        next_after = [None if pd.isna(value) else value.item() if hasattr(value, 'item') else value
+                      for value in df.iloc[-1][key_names]]
+    return df.drop(columns=key_names), next_after
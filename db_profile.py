@@ -0,0 +1,110 @@
+import random
+import re
+
+from db_browser import column_sql, estimate_row_count, has_rowid, quote_identifier
+
+DEFAULT_SAMPLE_ROWS = 100000
+TOP_K = 10
+HISTOGRAM_BINS = 20
+DATE_PATTERN = re.compile(r'^\d{4}-\d{2}')  # ISO形式の日時（created_atなど）は月ごとに数える
+
+
+def source_sql(conn, table, sample_rows=None):
+    # 集計の対象。サンプリングする場合、rowidのテーブルではrowidを等間隔に（開始位置はランダムに）
+    # 拾って主キーで直接読むので、テーブル全体は走査しない。(WITH句, パラメータ, サンプリングしたか) を返す
+    table_sql = quote_identifier(table)
+    if not sample_rows:
+        return f'WITH src AS (SELECT * FROM {table_sql})', [], False
+    if has_rowid(conn, table):
+        low, high = conn.execute(f'SELECT MIN(rowid), MAX(rowid) FROM {table_sql}').fetchone()
+        if low is None or high - low + 1 <= sample_rows:
+            return f'WITH src AS (SELECT * FROM {table_sql})', [], False
+        step = (high - low + 1) // sample_rows
+        start = low + random.randrange(step)
+        return f'''
+            WITH RECURSIVE ids(r) AS (SELECT ? UNION ALL SELECT r + ? FROM ids WHERE r + ? <= ?),
+            src AS (SELECT {table_sql}.* FROM ids JOIN {table_sql} ON {table_sql}.rowid = ids.r)
+        ''', [start, step, step, high], True
+    # rowidの無いテーブルは先頭から読む（偏りはあるが、件数の上限は守る）
+    return f'WITH src AS (SELECT * FROM {table_sql} LIMIT ?)', [sample_rows], True
+
+
+def is_numeric(minimum, maximum):
+    # 宣言された型ではなく、実際に入っている値で判断する（SQLiteは列の型を強制しないため）
+    return all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in (minimum, maximum))
+
+
+def numeric_histogram(conn, source, params, column, minimum, maximum, bins=HISTOGRAM_BINS):
+    column = column_sql(column)
+    if minimum == maximum:
+        count = conn.execute(f'{source} SELECT COUNT({column}) FROM src', params).fetchone()[0]
+        return [(f'{minimum}', count)]
+    width = (maximum - minimum) / bins
+    rows = conn.execute(f'''
+        {source}
+        SELECT MIN(CAST(({column} - ?) / ? AS INTEGER), ?) AS bin, COUNT(*)
+        FROM src WHERE {column} IS NOT NULL GROUP BY bin ORDER BY bin
+    ''', params + [minimum, width, bins - 1]).fetchall()
+    return [(f'{minimum + bin * width:.4g}〜{minimum + (bin + 1) * width:.4g}', count) for bin, count in rows]
+
+
+def date_histogram(conn, source, params, column):
+    column = column_sql(column)
+    return conn.execute(f'''
+        {source}
+        SELECT substr({column}, 1, 7) AS month, COUNT(*)
+        FROM src WHERE {column} IS NOT NULL GROUP BY month ORDER BY month
+    ''', params).fetchall()
+
+
+def top_values(conn, source, params, column, k=TOP_K):
+    column = column_sql(column)
+    return conn.execute(f'''
+        {source}
+        SELECT {column} AS value, COUNT(*) AS count FROM src
+        GROUP BY value ORDER BY count DESC LIMIT ?
+    ''', params + [k]).fetchall()
+
+
+def profile_table(conn, table, sample_rows=None, top_k=TOP_K, bins=HISTOGRAM_BINS):
+    # pandasへ行を読み込まず、集計のSQLだけで列ごとの統計を求める。
+    # 件数・NULL数・異なる値の数・最小・最大は1回の走査でまとめて数える
+    columns = [(row[1], row[2]) for row in conn.execute(f'PRAGMA table_info({quote_identifier(table)})')]
+    source, params, sampled = source_sql(conn, table, sample_rows)
+    aggregates = ', '.join(
+        f'COUNT({column_sql(name)}), COUNT(DISTINCT {column_sql(name)}), MIN({column_sql(name)}), MAX({column_sql(name)})'
+        for name, _ in columns
+    )
+    row = conn.execute(f'{source} SELECT COUNT(*), {aggregates} FROM src', params).fetchone()
+    rows = row[0]
+
+    profiles = []
+    for index, (name, declared_type) in enumerate(columns):
+        non_null, distinct, minimum, maximum = row[1 + index * 4: 5 + index * 4]
+        profile = {
+            'column': name,
+            'type': declared_type,
+            'non_null': non_null,
+            'nulls': rows - non_null,
+            'distinct': distinct,
+            'min': minimum,
+            'max': maximum,
+            'top': [],
+            'histogram': [],
+        }
+        # すべて異なる値の列（IDなど）は頻出値を数えても意味がないので省く
+        if non_null and distinct < non_null:
+            profile['top'] = top_values(conn, source, params, name, top_k)
+        if non_null and is_numeric(minimum, maximum):
+            profile['histogram'] = numeric_histogram(conn, source, params, name, minimum, maximum, bins)
+        elif non_null and isinstance(minimum, str) and DATE_PATTERN.match(minimum) and DATE_PATTERN.match(maximum):
+            profile['histogram'] = date_histogram(conn, source, params, name)
+        profiles.append(profile)
+
+    return {
+        'table': table,
+        'rows': rows,
+        'sampled': sampled,
+        'table_rows': estimate_row_count(conn, table) if sampled else rows,
+        'columns': profiles,
+    }
@@ -0,0 +1,51 @@
+import io
+
+ENCODE_FORMATS = ('WEBP', 'JPEG', 'PNG')
+DEFAULT_QUALITY = 80
+
+
+def zoomed_size(img_size, zoom):
+    width, height = img_size
+    return int(width * zoom), int(height * zoom)
+
+
+def viewport_box(img_size, zoom, x_offset=0, y_offset=0):
+    # ズーム後の画像上の表示範囲を、元画像上の範囲（浮動小数の矩形）と出力サイズに変換する
+    width, height = img_size
+    new_width, new_height = zoomed_size(img_size, zoom)
+    if zoom <= 1.0:
+        return (0, 0, width, height), (new_width, new_height)
+    right = min(new_width, x_offset + width)
+    bottom = min(new_height, y_offset + height)
+    scale_x = width / new_width
+    scale_y = height / new_height
+    box = (x_offset * scale_x, y_offset * scale_y, right * scale_x, bottom * scale_y)
+    return box, (right - x_offset, bottom - y_offset)
+
+
+def render_viewport(img, zoom, x_offset=0, y_offset=0):
+    # 先に元画像上の範囲を求め、その範囲だけを出力サイズへリサンプリングする。
+    # 拡大後の画像全体を作らないので、メモリと処理時間はズーム倍率ではなく表示サイズで決まる。
+    box, size = viewport_box(img.size, zoom, x_offset, y_offset)
+    return img.resize(size, box=box)
+
+
+def render_viewport_resize_first(img, zoom, x_offset=0, y_offset=0):
+    # 以前の方式（拡大後の画像全体を作ってから切り出す）。ベンチマークでの比較用
+    new_width, new_height = zoomed_size(img.size, zoom)
+    resized_img = img.resize((new_width, new_height))
+    if zoom <= 1.0:
+        return resized_img
+    width, height = img.size
+    right = min(new_width, x_offset + width)
+    bottom = min(new_height, y_offset + height)
+    return resized_img.crop((x_offset, y_offset, right, bottom))
+
+
+def encode_image(img, image_format='WEBP', quality=DEFAULT_QUALITY):
+    # 表示用に1回だけ圧縮する（PNGではqualityは使われない）
+    if image_format == 'JPEG' and img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    buffer = io.BytesIO()
+    img.save(buffer, format=image_format, quality=quality)
+    return buffer.getvalue()
@@ -0,0 +1,169 @@
+# 画面を使わずにインデックスを作成するコマンドライン。
+#   python index_cli.py run --auth ccg --subject-id <enterprise_id> --processes 4
+#   python index_cli.py crawl --auth jwt --config config.json --shard 0/3 --shard-dir shards   （マシンごとに i/N を変えて実行）
+#   python index_cli.py merge shards_a/20240101 shards_b/20240101 shards_c/20240101 --output box_files.db --remove-shards
+# シャードは --shard-dir の下の実行ID（--run-id、既定は日付）のディレクトリに作る。
+# 同じ実行IDで再実行すると作成済みのシャードは飛ばし、run は成功したらシャードを消す
+#   python index_cli.py upload box_files.db --auth ccg --subject-id <enterprise_id>
+# クライアントIDとシークレットは環境変数 BOX_CLIENT_ID / BOX_CLIENT_SECRET からも読む
+import argparse
+import os
+import sys
+import time
+
+import box_auth
+import indexer
+import shard_index
+from box_client import API_BASE, DEFAULT_RATE, UPLOAD_BASE
+from box_crawler import DEFAULT_MAX_WORKERS, LISTING_MODES
+
+
+def add_auth_arguments(parser):
+    parser.add_argument('--auth', choices=box_auth.AUTH_MODES, default='ccg')
+    parser.add_argument('--subject-type', choices=box_auth.SUBJECT_TYPES, help='ccg / jwt で認証する対象')
+    parser.add_argument('--subject-id', help='企業IDまたはユーザーID（環境変数 BOX_SUBJECT_ID）')
+    parser.add_argument('--config', help='JWTの設定ファイル（環境変数 BOX_JWT_CONFIG）')
+    parser.add_argument('--token', help='--auth token で使うアクセストークン（環境変数 BOX_ACCESS_TOKEN）')
+    parser.add_argument('--token-url', default=box_auth.TOKEN_URL)
+    parser.add_argument('--api-base', default=API_BASE)
+    parser.add_argument('--upload-base', default=UPLOAD_BASE)
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE,
+                        help='このマシン全体での1秒あたりのリクエスト数の上限（プロセス数で分ける。0で無制限）')
+
+
+def add_crawl_arguments(parser):
+    parser.add_argument('--shard-dir', default=shard_index.SHARD_DIR)
+    parser.add_argument('--run-id', default=shard_index.default_run_id(),
+                        help='シャードを作る実行ID（既定は当日の日付）。同じ実行IDなら作成済みのシャードを再利用する')
+    parser.add_argument('--shard', type=parse_shard, default='0/1', help='複数のマシンで分けるときの i/N（0から数える）')
+    parser.add_argument('--processes', type=int, default=shard_index.DEFAULT_PROCESSES)
+    parser.add_argument('--workers', type=int, default=DEFAULT_MAX_WORKERS, help='プロセスごとの同時接続数')
+    parser.add_argument('--listing-mode', choices=LISTING_MODES, default='fields',
+                        help='search: フォルダをたどらず検索APIで画像ファイルだけを取得する')
+
+
+def auth_settings(args):
+    return box_auth.auth_settings_from_env(
+        args.auth, subject_type=args.subject_type, subject_id=args.subject_id,
+        config=args.config, token=args.token, token_url=args.token_url
+    )
+
+
+def client_options(args, processes=1):
+    return {
+        'api_base': args.api_base,
+        'upload_base': args.upload_base,
+        'rate': args.rate / processes if args.rate else None,
+    }
+
+
+def parse_shard(value):
+    index, count = (int(part) for part in value.split('/'))
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"--shard は 0〜N-1 の i/N で指定してください: {value}")
+    return index, count
+
+
+def crawl(args):
+    settings = auth_settings(args)
+    client = box_auth.make_client(settings, **client_options(args))
+    index, count = args.shard
+    shard_ids = shard_index.assign_shards(shard_index.list_top_folders(client), index, count)
+    shard_dir = shard_index.run_dir(args.shard_dir, args.run_id)
+    print(f"シャード {len(shard_ids)} 件を {args.processes} プロセスで作成します。（{shard_dir}）")
+
+    started = time.time()
+
+    def report(result):
+        if result['skipped']:
+            print(f"[{result['shard']}] 作成済みのためスキップしました。")
+        else:
+            print(f"[{result['shard']}] ファイル {result['files']} 件、API呼び出し {result['api_calls']} 回、"
+                  f"{result['seconds']:.1f} 秒")
+
+    results, failed = shard_index.run_shards(
+        settings, client_options(args, args.processes), shard_ids, shard_dir,
+        args.processes, args.workers, args.listing_mode, on_result=report
+    )
+    print(f"完了: {len(results)} 件、失敗: {len(failed)} 件（{time.time() - started:.1f} 秒）")
+    return not failed
+
+
+def merge(args):
+    shards = shard_index.find_shards(args.paths)
+    output = args.output or os.path.join(os.getcwd(), indexer.generate_db_file_name())
+    started = time.time()
+    shard_index.merge_shards(shards, output)
+    print(f"{len(shards)} 件のシャードを {output} にまとめました。（{time.time() - started:.1f} 秒）")
+    if args.remove_shards:
+        shard_index.remove_shards(args.paths)
+    return output
+
+
+def upload(args, db_file_path=None):
+    # Streamlit版と同じく、当日のファイル名のDBがBoxにあれば新しいバージョンとして更新する
+    client = box_auth.make_client(auth_settings(args), **client_options(args))
+    db_file_path = db_file_path or args.db
+    db_file_name = args.name or indexer.generate_db_file_name()
+    db_file = indexer.box_db_exists(client, db_file_name)
+    with open(db_file_path, 'rb') as file_stream:
+        if db_file:
+            return bool(indexer.update_box_db_file(client, db_file['id'], file_stream))
+        return bool(indexer.upload_db_to_box(client, indexer.ROOT_FOLDER_ID, file_stream, db_file_name))
+
+
+def run(args):
+    # 1台のマシンでクロール → まとめる → アップロードまでを行う。
+    # シャードはアップロードまで成功したら消す（失敗したときは同じ実行IDで再実行すれば、まとめる所からやり直せる）
+    if not crawl(args):
+        return False
+    args.paths = [shard_index.run_dir(args.shard_dir, args.run_id)]
+    args.remove_shards = False
+    db_file_path = merge(args)
+    if not (args.no_upload or upload(args, db_file_path)):
+        return False
+    if not args.keep_shards:
+        shard_index.remove_shards(args.paths)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Box内の画像ファイルのインデックスを作成する')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    parser_run = commands.add_parser('run', help='クロール・まとめ・アップロードをまとめて実行する')
+    add_auth_arguments(parser_run)
+    add_crawl_arguments(parser_run)
+    parser_run.add_argument('--output')
+    parser_run.add_argument('--name', help='Boxに保存するファイル名（省略時は box_files_<日付>.db）')
+    parser_run.add_argument('--no-upload', action='store_true')
+    parser_run.add_argument('--keep-shards', action='store_true', help='成功したあともシャードを残す')
+
+    parser_crawl = commands.add_parser('crawl', help='担当するシャードを作成する')
+    add_auth_arguments(parser_crawl)
+    add_crawl_arguments(parser_crawl)
+
+    parser_merge = commands.add_parser('merge', help='シャードを1つのDBにまとめる')
+    parser_merge.add_argument('paths', nargs='+', help='シャードのファイルまたはディレクトリ')
+    parser_merge.add_argument('--output')
+    parser_merge.add_argument('--remove-shards', action='store_true', help='まとめ終わったらシャードを消す')
+
+    parser_upload = commands.add_parser('upload', help='DBをBoxへアップロードする')
+    parser_upload.add_argument('db')
+    parser_upload.add_argument('--name', help='Boxに保存するファイル名（省略時は box_files_<日付>.db）')
+    add_auth_arguments(parser_upload)
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        ok = run(args)
+    elif args.command == 'crawl':
+        ok = crawl(args)
+    elif args.command == 'merge':
+        ok = merge(args)
+    else:
+        ok = upload(args)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import sqlite3
+from contextlib import closing, contextmanager
+from itertools import islice
+
+from box_sync import ensure_sync_tables
+
+BOX_FILES_COLUMNS = ('id', 'name', 'folder_id', 'created_at', 'shared_link', 'file_version')
+DEFAULT_CHUNK_SIZE = 5000  # 1トランザクションで書き込む行数
+
+# 書き込み時の設定
+# WALにすると書き込み中も読み出しができ、synchronous=NORMALと組み合わせてコミットごとのfsyncを減らせる
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-65536',  # 64MB（負の値はKB単位）
+    'PRAGMA temp_store=MEMORY',
+)
+
+INDEXES = (
+    'CREATE INDEX IF NOT EXISTS idx_box_files_folder_id ON box_files (folder_id)',
+    'CREATE INDEX IF NOT EXISTS idx_box_files_name ON box_files (name)',
+    'CREATE INDEX IF NOT EXISTS idx_box_files_created_at ON box_files (created_at)',
+)
+
+# 内容が変わらない行は書き換えない（REPLACEのような削除＋挿入も行わない）
+UPSERT_SQL = f'''
+    INSERT INTO box_files ({', '.join(BOX_FILES_COLUMNS)})
+    VALUES ({', '.join('?' for _ in BOX_FILES_COLUMNS)})
+    ON CONFLICT(id) DO UPDATE SET
+        {', '.join(f'{column} = excluded.{column}' for column in BOX_FILES_COLUMNS[1:])}
+    WHERE {' OR '.join(f'box_files.{column} IS NOT excluded.{column}' for column in BOX_FILES_COLUMNS[1:])}
+'''
+
+
+def connect(db_file_path):
+    conn = sqlite3.connect(db_file_path)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+@contextmanager
+def open_db(db_file_path):
+    # 正常終了時はコミットし、いずれの場合も接続を閉じる（WALを解除する前に接続が残らないように）
+    conn = connect(db_file_path)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def ensure_schema(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS box_files (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            folder_id TEXT,
+            created_at TEXT,
+            shared_link TEXT,
+            file_version TEXT
+        )
+    ''')
+    # 以前のDBには無い列を追加する
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(box_files)')}
+    if 'file_version' not in columns:
+        conn.execute('ALTER TABLE box_files ADD COLUMN file_version TEXT')
+    ensure_sync_tables(conn)
+    conn.commit()
+
+
+def create_indexes(conn):
+    # 新しいDBでは全件書き込み後にまとめて作る方が、1行ごとに索引を更新するより速い
+    for index in INDEXES:
+        conn.execute(index)
+    conn.commit()
+
+
+def image_row(image):
+    return (
+        image['id'],
+        image['name'],
+        image['parent']['id'],
+        image['created_at'],
+        image['shared_link'],
+        (image.get('file_version') or {}).get('id')
+    )
+
+
+def iter_chunks(rows, chunk_size):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def upsert_rows(conn, rows, chunk_size=DEFAULT_CHUNK_SIZE, on_chunk=None):
+    # 行のイテレータをチャンクごとに1トランザクションでまとめて書き込み、書き込んだ行数を返す。
+    # on_chunk(conn) はチャンクと同じトランザクションの中で呼ばれる（途中経過を行と一緒に保存するため）
+    count = 0
+    for chunk in iter_chunks(rows, chunk_size):
+        with conn:
+            conn.executemany(UPSERT_SQL, chunk)
+            if on_chunk:
+                on_chunk(conn)
+        count += len(chunk)
+    return count
+
+
+def finalize(db_file_path):
+    # 索引を作成したうえで、WALの内容を本体へ書き戻し、DBファイル単体で完結する状態に戻す
+    with closing(sqlite3.connect(db_file_path)) as conn:
+        create_indexes(conn)
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        conn.execute('PRAGMA journal_mode=DELETE')
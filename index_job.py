@@ -0,0 +1,180 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import closing
+
+import indexer
+import run_metrics
+import thumbnails
+
+# インデックス作成をStreamlitの再実行から切り離し、バックグラウンドのスレッドで実行する。
+# 作業用DBの情報（indexer.prepare_db の結果）をファイルに保存しておき、中断した場合は
+# 同じDBと crawl_frontier の途中経過から再開する。保存した状態はジョブを開始したユーザーだけが再開できる
+
+JOB_STATE_DIR = tempfile.gettempdir()
+MAX_MESSAGES = 200  # 画面に表示するために残すメッセージの数
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def job_state_path(owner=None):
+    # ユーザー（BoxのユーザーID）ごとに別のファイルにする
+    name = f'box_index_job_{owner}.json' if owner else 'box_index_job.json'
+    return os.path.join(JOB_STATE_DIR, name)
+
+
+def load_job_state(owner=None, path=None):
+    # owner が中断したジョブの {owner, options, plan}。
+    # 別のユーザーのものや、作業用DBが残っていないものは再開できないので None
+    try:
+        with open(path or job_state_path(owner), encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get('owner') != owner or not os.path.exists(state['plan']['db_file_path']):
+        return None
+    return state
+
+
+def save_job_state(state, path):
+    # 書きかけのファイルを読まないよう、一時ファイルに書いてから置き換える
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(path + '.tmp', path)
+
+
+def clear_job_state(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class IndexJob:
+    # 1回のインデックス作成（とサムネイル作成）をスレッドで実行する。
+    # 画面からは status() で状態を読むだけにし、スレッドからStreamlitの描画は行わない。
+    # owner はジョブを開始したユーザーのIDで、中断したときの状態はそのユーザーの分として保存する
+    def __init__(self, client, options, make_thumbnails=False, owner=None, state_path=None):
+        self.client = client
+        self.options = dict(options)
+        self.make_thumbnails = make_thumbnails
+        self.owner = owner
+        self.state_path = state_path or job_state_path(owner)
+        self.metrics = run_metrics.RunMetrics(on_stage=self._check_cancel)
+        self._lock = threading.Lock()
+        self._cancel = threading.Event()
+        self._status = {
+            'state': 'running',
+            'started': time.time(),
+            'finished': None,
+            'resumed': False,
+            'messages': deque(maxlen=MAX_MESSAGES),
+            'crawl': {},
+            'upload': None,
+            'thumbnails': None,
+            'result': None,
+            'error': None,
+        }
+        self._thread = threading.Thread(target=self._run, name='index-job', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        # クロール・分割アップロードの進捗が届いた時点か、次の段階に入る時点で止める
+        # （途中経過は保存済みなので、次回はその続きから再開できる）
+        self._cancel.set()
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+    def status(self):
+        with self._lock:
+            status = dict(self._status)
+            status['messages'] = list(status['messages'])
+            return status
+
+    def _update(self, **values):
+        with self._lock:
+            self._status.update(values)
+
+    def log(self, *messages):
+        with self._lock:
+            self._status['messages'].append(' '.join(str(message) for message in messages))
+
+    def _check_cancel(self, stage=None):
+        if self._cancel.is_set():
+            raise JobCancelled("インデックス作成を中断しました。")
+
+    def _on_crawl_progress(self, progress):
+        self._update(crawl=dict(progress))
+        self._check_cancel()
+
+    def _on_upload_progress(self, done, total):
+        self._update(upload=(done, total))
+        self._check_cancel()
+
+    def _thumbnail_progress(self, total):
+        def on_progress(progress):
+            self._update(thumbnails=dict(progress, total=total))
+            self._check_cancel()
+        return on_progress
+
+    def _on_plan(self, plan):
+        save_job_state({'owner': self.owner, 'options': self.options, 'plan': plan}, self.state_path)
+
+    def _run(self):
+        saved = load_job_state(self.owner, self.state_path)
+        plan = saved['plan'] if saved and saved['options'] == self.options else None
+        self._update(resumed=plan is not None)
+        try:
+            result = indexer.run_index(
+                self.client, **self.options, log=self.log,
+                on_crawl_progress=self._on_crawl_progress, on_upload_progress=self._on_upload_progress,
+                metrics=self.metrics, plan=plan, on_plan=self._on_plan
+            )
+            # アップロードまで成功してから消す（失敗・中断したときは同じDBで再開できるよう残す）
+            clear_job_state(self.state_path)
+            if self.make_thumbnails:
+                # 索引はアップロード済みなので、サムネイルの失敗・中断はログに残すだけにして完了として報告する
+                try:
+                    with self.metrics.stage('thumbnails'):
+                        self._run_thumbnails(result['db_file_path'])
+                except JobCancelled:
+                    self.log("サムネイルの作成を中断しました（作成済みのものは保存されています）。")
+                except Exception as e:
+                    self.log(f"サムネイルの作成に失敗しました: {e!r}")
+            # 遅い実行を後から調べられるよう、実行ごとにJSONとPrometheus形式のレポートを残す
+            report = self.metrics.report(self.client.stats)
+            result = {key: value for key, value in result.items() if key != 'metrics'}
+            result.update(report=report, report_paths=run_metrics.write_report(report))
+            self._update(state='done', result=result)
+        except JobCancelled as e:
+            self.log(str(e))
+            self._update(state='cancelled')
+        except Exception as e:
+            self.log(f"インデックス作成に失敗しました: {e!r}")
+            self._update(state='failed', error=repr(e))
+        finally:
+            self._update(finished=time.time())
+
+    def _run_thumbnails(self, db_file_path):
+        # 索引DBの画像のうち、サムネイルが無いもの・バージョンが変わったものだけを作る
+        with closing(thumbnails.connect()) as conn:
+            files = thumbnails.pending_files(conn, db_file_path)
+            if not files:
+                self.log("サムネイルはすべて作成済みです。")
+                return
+            result = thumbnails.build_thumbnails(
+                self.client, conn, files, max_workers=self.options['max_workers'],
+                on_progress=self._thumbnail_progress(len(files))
+            )
+            self.log(f"サムネイルを {result['done']} 件作成しました（失敗 {result['failed']} 件、"
+                     f"{time.time() - result['started']:.1f} 秒）。保存済み: {thumbnails.count_thumbnails(conn)} 件")
@@ -0,0 +1,520 @@
+import datetime
+import os
+import re
+import sqlite3
+import tempfile
+from contextlib import closing
+
+from box_crawler import crawl_files, search_files, iter_folder_items, DEFAULT_MAX_WORKERS
+from box_sync import (get_watermark, set_watermark, save_folders,
+                      delete_files, delete_folder_subtree, get_stream_position, collect_changes,
+                      get_crawl_position, set_crawl_position, load_frontier, start_frontier,
+                      checkpoint_pages, clear_frontier)
+import index_db
+import box_delta
+from run_metrics import RunMetrics
+from box_download import fetch_db_file, DownloadError, DOWNLOAD_FIELDS
+from box_upload import chunked_upload, UploadError, CHUNKED_UPLOAD_THRESHOLD
+
+# Boxの画像をクロールしてSQLiteの索引を作り、Boxへアップロードするまでの処理。
+# Streamlitには依存しないので、画面（start.py）からもベンチマークやコマンドラインからも使える。
+# 画面への表示は log（メッセージ）と on_* （進捗）のコールバックで呼び出し側に任せる
+
+ROOT_FOLDER_ID = '0'  # ルートフォルダのID（「0」はルートフォルダを意味する）
+LINK_FAILED = 'リンク作成失敗'  # 共有リンクを作成できなかったファイルに保存する値
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif')
+
+
+def get_all_files(client, folder_id=ROOT_FOLDER_ID, max_workers=DEFAULT_MAX_WORKERS, on_progress=None,
+                  listing_mode='fields', on_folder=None, log=print, frontier=None, on_page=None):
+    # フォルダ一覧とファイル情報の取得はbox_crawlerで並列に実行する
+    # 一覧はページが届くたびに返されるので、呼び出し側も順に処理すること。
+    # 'search' ではフォルダをたどらず、検索APIで画像の拡張子のファイルだけを取得する（frontier / on_page は使わない）
+    if listing_mode == 'search':
+        return search_files(client, [extension.lstrip('.') for extension in IMAGE_EXTENSIONS], folder_id,
+                            max_workers=max_workers, on_progress=on_progress, on_error=log, on_folder=on_folder)
+    return crawl_files(client, folder_id, max_workers=max_workers,
+                       on_progress=on_progress, on_error=log,
+                       listing_mode=listing_mode, on_folder=on_folder,
+                       frontier=frontier, on_page=on_page)
+
+
+def is_image(file):
+    return file['name'].lower().endswith(IMAGE_EXTENSIONS)
+
+
+def filter_images(files):
+    return (file for file in files if is_image(file))
+
+
+def load_shared_links(db_file_path):
+    # DBに保存済みの共有リンク（ファイルID → URL）
+    with closing(sqlite3.connect(db_file_path)) as conn:
+        rows = conn.execute(
+            "SELECT id, shared_link FROM box_files WHERE shared_link IS NOT NULL AND shared_link != ?",
+            (LINK_FAILED,)
+        )
+        return dict(rows)
+
+
+def existing_shared_link(image, link_cache):
+    # 一覧に shared_link が含まれていればそれを正とする（Box側でリンクが削除されている場合があるため）
+    if 'shared_link' in image:
+        shared_link = image['shared_link']
+        if isinstance(shared_link, dict) and shared_link.get('access') == 'open' and shared_link.get('url'):
+            return shared_link['url'], 'listing'
+        return None, None
+    if link_cache and image['id'] in link_cache:
+        return link_cache[image['id']], 'db'
+    return None, None
+
+
+def attach_shared_links(client, images, link_cache=None, link_stats=None, log=print):
+    # 公開リンクが既にあるファイルはPUTを呼ばずに再利用する
+    if link_stats is None:
+        link_stats = {}
+    for image in images:
+        shared_link, source = existing_shared_link(image, link_cache)
+        if shared_link:
+            link_stats[f'reused_{source}'] = link_stats.get(f'reused_{source}', 0) + 1
+        else:
+            shared_link = create_shared_link(client, image['id'], log)
+            key = 'created' if shared_link else 'failed'
+            link_stats[key] = link_stats.get(key, 0) + 1
+        image['shared_link'] = shared_link or LINK_FAILED
+        yield image
+
+
+def create_shared_link(client, file_id, log=print):
+    url = client.api_url(f"/files/{file_id}")
+    headers = {
+        'Content-Type': 'application/json'
+    }
+    data = {
+        "shared_link": {
+            "access": "open"
+        }
+    }
+    response = client.put(url, headers=headers, json=data)
+
+    if response.status_code == 200:
+        return response.json()['shared_link']['url']
+    else:
+        log(f"共有リンクの作成に失敗しました。ファイルID: {file_id}")
+        return None
+
+
+def box_db_exists(client, db_file_name, log=print):
+    url = client.api_url('/search')
+    params = {'query': db_file_name, 'file_extensions': 'db'}
+    response = client.get(url, params=params)
+    if response.status_code == 200:
+        files = response.json().get('entries', [])
+        return files[0] if files else None
+    else:
+        log("Box内のデータベースファイルの検索に失敗しました。")
+        return None
+
+
+def find_latest_db(client, base_name="box_files", log=print):
+    # 差分同期の起点にする、最も新しい日付のDBファイルを探す
+    url = client.api_url('/search')
+    params = {'query': base_name, 'file_extensions': 'db', 'type': 'file', 'limit': 100}
+    response = client.get(url, params=params)
+    if response.status_code != 200:
+        log("Box内のデータベースファイルの検索に失敗しました。")
+        return None
+    pattern = re.compile(rf'^{re.escape(base_name)}_\d{{8}}\.db$')
+    files = [file for file in response.json().get('entries', []) if pattern.match(file['name'])]
+    return max(files, key=lambda file: file['name']) if files else None
+
+
+def download_db_file(client, file_info, log=print):
+    # ストリーミングでディスクへ保存し、同じバージョンはローカルのキャッシュを使う
+    try:
+        db_file_path, cache_hit = fetch_db_file(client, file_info)
+    except DownloadError as e:
+        log(str(e))
+        return None
+    if cache_hit:
+        log("変更がないため、キャッシュ済みのデータベースを使用します。")
+    return db_file_path
+
+
+def list_root_files(client, log=print):
+    # 直前にアップロードしたファイルも確実に見つけられるよう、検索ではなくフォルダ一覧を使う
+    items = iter_folder_items(client, ROOT_FOLDER_ID, fields=f'type,{DOWNLOAD_FIELDS}', on_error=log)
+    return [item for item in items if item['type'] == 'file']
+
+
+def delete_box_file(client, file_id, log=print):
+    url = client.api_url(f'/files/{file_id}')
+    response = client.delete(url)
+    if response.status_code != 204:
+        log(f"ファイルの削除に失敗しました。ファイルID: {file_id}")
+
+
+def open_delta_db(client, log=print):
+    # ベースのDBをダウンロードし、まだ取り込まれていない差分ファイルを順に適用する
+    root_files = list_root_files(client, log)
+    base_file = next((file for file in root_files if file['name'] == box_delta.BASE_DB_NAME), None)
+    delta_files = [file for file in root_files if box_delta.is_delta_file_name(file['name'])]
+    if not base_file:
+        log("ベースのデータベースがないため、新しく作成します。")
+        return create_new_db_file(), None, delta_files
+
+    log(f"ベースのデータベースと差分から最新の状態を復元します。（{base_file['name']}）")
+    db_file_path = download_db_file(client, base_file, log)
+    if not db_file_path:
+        raise RuntimeError("ベースのデータベースを取得できませんでした。")
+    with index_db.open_db(db_file_path) as conn:
+        index_db.ensure_schema(conn)
+        pending = box_delta.pending_deltas(delta_files, box_delta.get_applied_deltas(conn), box_delta.get_last_delta(conn))
+        for delta_file in pending:
+            url = client.api_url(f'/files/{delta_file["id"]}/content')
+            response = client.get(url, stream=True)
+            if response.status_code != 200:
+                raise RuntimeError(f"差分ファイルの取得に失敗しました。ファイル名: {delta_file['name']}")
+            box_delta.apply_delta(conn, response.iter_lines())
+    log(f"差分ファイルを {len(pending)} 件適用しました。")
+    return db_file_path, base_file, delta_files
+
+
+def publish_delta_db(client, db_file_path, base_file, delta_files, log=print, on_upload_progress=None):
+    # 今回の変更だけを差分ファイルとしてアップロードし、差分が溜まったらベースを作り直す
+    if not base_file:
+        with index_db.open_db(db_file_path) as conn:
+            box_delta.remove_change_log(conn)
+        index_db.finalize(db_file_path)
+        with open(db_file_path, 'rb') as file_stream:
+            if not upload_db_to_box(client, ROOT_FOLDER_ID, file_stream, box_delta.BASE_DB_NAME, log, on_upload_progress):
+                return None
+        return box_delta.BASE_DB_NAME
+
+    delta_name = box_delta.delta_file_name()
+    with tempfile.TemporaryFile() as delta_stream:
+        with index_db.open_db(db_file_path) as conn:
+            change_count = box_delta.export_changes(conn, delta_stream)
+        delta_size = delta_stream.tell()
+        delta_stream.seek(0)
+        uploaded = upload_db_to_box(client, ROOT_FOLDER_ID, delta_stream, delta_name, log, on_upload_progress)
+    if not uploaded:
+        # 変更の記録は残しておき、再開したときに同じ変更をもう一度アップロードする
+        return None
+    with index_db.open_db(db_file_path) as conn:
+        box_delta.remove_change_log(conn)
+    log(f"差分ファイルをアップロードしました。変更 {change_count} 件、{delta_size:,} バイト")
+    delta_files = delta_files + [uploaded]
+
+    with index_db.open_db(db_file_path) as conn:
+        applied = box_delta.get_applied_deltas(conn)
+        pending = box_delta.pending_deltas(delta_files, applied, box_delta.get_last_delta(conn))
+        if len(pending) <= box_delta.COMPACT_AFTER:
+            return delta_name
+        # Boxにある差分はすべてこのベースに取り込まれる（前回削除できずに残った取り込み済みの差分も含む）
+        box_delta.set_applied_deltas(conn, {file['name'] for file in delta_files})
+
+    log(f"差分ファイルが {len(pending)} 件になったため、ベースのデータベースを更新します。")
+    index_db.finalize(db_file_path)
+    with open(db_file_path, 'rb') as file_stream:
+        compacted = update_box_db_file(client, base_file['id'], file_stream, log, on_upload_progress)
+    if not compacted:
+        # Boxのベースは古いままなので、差分ファイルは消さずに残し、次回の実行でもう一度ベースを作り直す
+        # （今回の変更は差分ファイルとしてアップロード済み）
+        with index_db.open_db(db_file_path) as conn:
+            box_delta.set_applied_deltas(conn, applied)
+        log("ベースのデータベースを更新できなかったため、差分ファイルを残しました。")
+        return delta_name
+    for delta_file in pending:
+        delete_box_file(client, delta_file['id'], log)
+    return box_delta.BASE_DB_NAME
+
+
+def stream_file_path(file_stream):
+    # 分割アップロードはパートごとにファイルを読み直すので、パスのあるファイルだけが対象
+    name = getattr(file_stream, 'name', None)
+    if isinstance(name, str) and os.path.getsize(name) > CHUNKED_UPLOAD_THRESHOLD:
+        return name
+    return None
+
+
+def upload_in_chunks(client, file_path, log=print, on_upload_progress=None, **target):
+    try:
+        return chunked_upload(client, file_path, on_progress=on_upload_progress, **target)
+    except UploadError as e:
+        log(str(e))
+        log("送信済みのパートは保持されているので、もう一度実行すると続きからアップロードします。")
+        return None
+
+
+def upload_db_to_box(client, folder_id, file_stream, db_file_name, log=print, on_upload_progress=None):
+    large_file_path = stream_file_path(file_stream)
+    if large_file_path:
+        uploaded = upload_in_chunks(client, large_file_path, log, on_upload_progress,
+                                    file_name=db_file_name, folder_id=folder_id)
+        if uploaded:
+            log("データベースファイルがBoxにアップロードされました。（分割アップロード）")
+        return uploaded
+
+    url = client.upload_url('/files/content')
+    files = {
+        'attributes': (None, '{"name":"' + db_file_name + '","parent":{"id":"' + folder_id + '"}}'),
+        'file': (db_file_name, file_stream)
+    }
+    response = client.post(url, files=files)
+    if response.status_code == 201:
+        log("データベースファイルがBoxにアップロードされました。")
+        entries = response.json().get('entries', [])
+        return entries[0] if entries else None
+    else:
+        log(f"データベースファイルのアップロードに失敗しました。ステータスコード: {response.status_code}, レスポンス: {response.text}")
+        return None
+
+
+def update_box_db_file(client, file_id, file_stream, log=print, on_upload_progress=None):
+    large_file_path = stream_file_path(file_stream)
+    if large_file_path:
+        uploaded = upload_in_chunks(client, large_file_path, log, on_upload_progress, file_id=file_id)
+        if uploaded:
+            log("データベースファイルがBoxで更新されました。（分割アップロード）")
+        return uploaded
+
+    url = client.upload_url(f'/files/{file_id}/content')
+    files = {
+        'file': (file_stream.name, file_stream)
+    }
+    response = client.post(url, files=files)
+    if response.status_code == 201:
+        log("データベースファイルがBoxで更新されました。")
+        entries = response.json().get('entries', [])
+        return entries[0] if entries else None
+    else:
+        log(f"データベースファイルの更新に失敗しました。ステータスコード: {response.status_code}, レスポンス: {response.text}")
+        return None
+
+
+def insert_images(db_file_path, images, on_chunk=None):
+    # クロール結果をメモリに溜めず、チャンクごとのトランザクションで書き込む
+    with index_db.open_db(db_file_path) as conn:
+        return index_db.upsert_rows(conn, (index_db.image_row(image) for image in images), on_chunk=on_chunk)
+
+
+def create_new_db_file():
+    with tempfile.NamedTemporaryFile(delete=False, suffix='.db') as temp_db:
+        conn = index_db.connect(temp_db.name)
+        index_db.ensure_schema(conn)
+        conn.close()
+        return temp_db.name
+
+
+def generate_db_file_name(base_name="box_files"):
+    date_str = datetime.datetime.now().strftime('%Y%m%d')
+    return f"{base_name}_{date_str}.db"
+
+
+def run_full_crawl(client, db_file_path, max_workers, listing_mode, link_cache, link_stats, folder_id=None,
+                   on_progress=None, log=print, metrics=None):
+    # クロール → 画像の抽出 → 共有リンク作成 → DB書き込みをページ単位で流す。
+    # 読み終えたページはDBに書き込んだ行と同じトランザクションで crawl_frontier に記録し、
+    # 中断した場合は次回その続きから再開する（検索モードは途中の位置を持たないので最初から検索し直す）
+    metrics = metrics or RunMetrics()
+    root_id = folder_id or ROOT_FOLDER_ID
+    search = listing_mode == 'search'
+    frontier = None
+    if not search:
+        with index_db.open_db(db_file_path) as conn:
+            frontier = load_frontier(conn, root_id)
+            if frontier is None:
+                start_frontier(conn, root_id)
+            else:
+                log(f"中断したクロールを再開します。（残りのフォルダ {len(frontier)} 件）")
+    crawl_state = {}
+    finished_pages = []
+    found_folders = []
+
+    def update(progress):
+        crawl_state.update(progress)
+        if on_progress:
+            on_progress(progress)
+
+    def save_checkpoint(conn):
+        # ここまでに読み終えたページのファイルは、すべてこのチャンクまでに書き込まれている
+        checkpoint_pages(conn, root_id, finished_pages)
+        finished_pages.clear()
+        save_folders(conn, found_folders)
+        found_folders.clear()
+
+    files = get_all_files(client, root_id, max_workers=max_workers, on_progress=update,
+                          listing_mode=listing_mode, log=log, frontier=frontier,
+                          on_folder=(lambda *folder: found_folders.append(folder)) if search else None,
+                          on_page=lambda *page: finished_pages.append(page))
+    files = metrics.iterate('crawl', files)
+    images = metrics.iterate('filter', filter_images(files), inner='crawl')
+    images = metrics.iterate('links', attach_shared_links(client, images, link_cache, link_stats, log), inner='filter')
+    with metrics.stage('insert', inner='links'):
+        insert_images(db_file_path, images, on_chunk=save_checkpoint)
+    with metrics.stage('save_folders'), index_db.open_db(db_file_path) as conn:
+        save_checkpoint(conn)
+        clear_frontier(conn, root_id)
+    return crawl_state.get('files_total', 0)
+
+
+def run_incremental_sync(client, db_file_path, stream_position, max_workers, listing_mode,
+                         link_cache, link_stats, on_progress=None, log=print, metrics=None):
+    # 前回の同期位置以降のイベントだけを取得し、box_filesへ追加・更新・削除を反映する
+    metrics = metrics or RunMetrics()
+    try:
+        with metrics.stage('events'):
+            changes = collect_changes(client, stream_position)
+    except RuntimeError as e:
+        log(str(e))
+        return None
+
+    changed_files = list(changes['files'].values())
+    # 画像以外の名前に変わったファイルは一覧から外す
+    removed_ids = changes['deleted_files'] | {file['id'] for file in changed_files if not is_image(file)}
+    with metrics.stage('apply_deletes'), index_db.open_db(db_file_path) as conn:
+        for folder_id in changes['deleted_folders']:
+            delete_folder_subtree(conn, folder_id)
+        delete_files(conn, removed_ids)
+        save_folders(conn, changes['folders'].items())
+        conn.commit()
+
+    images = metrics.iterate('filter', filter_images(changed_files))
+    images = metrics.iterate('links', attach_shared_links(client, images, link_cache, link_stats, log), inner='filter')
+    with metrics.stage('insert', inner='links'):
+        insert_images(db_file_path, images)
+
+    # 新しく現れたフォルダは配下を改めてクロールする
+    # （移動したばかりのファイルは検索のインデックスにまだ反映されていないので、検索モードでもフォルダをたどる）
+    crawl_mode = 'fields' if listing_mode == 'search' else listing_mode
+    files_total = len(changed_files)
+    for folder_id in changes['crawl_folders']:
+        files_total += run_full_crawl(client, db_file_path, max_workers, crawl_mode,
+                                      link_cache, link_stats, folder_id, on_progress, log, metrics)
+
+    log(f"差分同期: 更新 {len(changed_files)} 件、削除 {len(removed_ids)} 件、"
+        f"削除フォルダ {len(changes['deleted_folders'])} 件、再クロールしたフォルダ {len(changes['crawl_folders'])} 件")
+    return changes['stream_position'], files_total
+
+
+def prepare_db(client, sync_mode='full', upload_mode='full', log=print):
+    # 作業用のDBを用意し、同期とアップロードに必要な情報をまとめて返す。
+    # 値はすべてJSONに保存できるので、中断したときはこれを保存しておけば同じDBで再開できる
+    plan = {'db_file_path': None, 'db_file_name': None, 'db_file': None, 'base_file': None, 'delta_files': []}
+    if upload_mode == 'delta':
+        plan['db_file_path'], plan['base_file'], plan['delta_files'] = open_delta_db(client, log)
+    else:
+        plan['db_file_name'] = generate_db_file_name()
+        plan['db_file'] = box_db_exists(client, plan['db_file_name'], log)
+        # 差分同期では、当日分がなければ最新の日付のDBを起点にする
+        base_db_file = plan['db_file']
+        if not base_db_file and sync_mode == 'incremental':
+            base_db_file = find_latest_db(client, log=log)
+
+        if base_db_file:
+            log(f"既存のデータベースを更新します。（{base_db_file['name']}）")
+            plan['db_file_path'] = download_db_file(client, base_db_file, log)
+        if not plan['db_file_path']:
+            log("新しいデータベースを作成します。")
+            plan['db_file_path'] = create_new_db_file()
+
+    with index_db.open_db(plan['db_file_path']) as conn:
+        index_db.ensure_schema(conn)
+        if upload_mode == 'delta':
+            box_delta.install_change_log(conn)
+    return plan
+
+
+def sync_db(client, db_file_path, sync_mode, max_workers, listing_mode, link_stats, log=print,
+            on_crawl_progress=None, metrics=None, folder_id=None):
+    # 差分同期（同期位置がない場合や、中断した全件クロールがある場合は全件クロール）を行い、同期位置を保存する。
+    # folder_id を指定すると、全件クロールはそのフォルダの配下だけを対象にする
+    metrics = metrics or RunMetrics()
+    with index_db.open_db(db_file_path) as conn:
+        watermark = get_watermark(conn)
+        crawl_position = get_crawl_position(conn)
+
+    link_cache = load_shared_links(db_file_path)
+    synced = None
+    if sync_mode == 'incremental' and not crawl_position:
+        if watermark:
+            synced = run_incremental_sync(client, db_file_path, watermark, max_workers, listing_mode,
+                                          link_cache, link_stats, on_crawl_progress, log, metrics)
+        else:
+            log("同期位置が保存されていないため、全件クロールを行います。")
+
+    if synced:
+        next_position, files_total = synced
+    else:
+        # クロール中の変更を取りこぼさないよう、クロール前の同期位置を保存する（再開したときは最初の位置を使う）
+        next_position = crawl_position
+        if not next_position:
+            with metrics.stage('events'):
+                next_position = get_stream_position(client)
+            with index_db.open_db(db_file_path) as conn:
+                set_crawl_position(conn, next_position)
+        files_total = run_full_crawl(client, db_file_path, max_workers, listing_mode, link_cache, link_stats,
+                                     folder_id, on_progress=on_crawl_progress, log=log, metrics=metrics)
+
+    with index_db.open_db(db_file_path) as conn:
+        if next_position:
+            set_watermark(conn, next_position)
+        set_crawl_position(conn, None)
+    return files_total
+
+
+def run_index(client, sync_mode='full', upload_mode='full', max_workers=DEFAULT_MAX_WORKERS, listing_mode='fields',
+              log=print, on_crawl_progress=None, on_upload_progress=None, metrics=None, plan=None, on_plan=None):
+    # DBの用意 → 同期（全件クロールまたは差分） → Boxへのアップロードまでを実行する。
+    # plan に中断した実行の prepare_db の結果を渡すと、そのDBとクロールの途中経過から再開する。
+    # on_plan(plan) はDBを用意した直後と同期が終わった時点で呼ばれる（再開に備えて保存するため）。
+    # アップロードに失敗したときは RuntimeError を送出する（plan を保存していれば、再開時はアップロードからやり直す）。
+    # 戻り値は画面の表示やベンチマークに使う結果（DBのパス・ファイル名・クロールしたファイル数・共有リンクの集計・段階ごとの時間）
+    metrics = metrics or RunMetrics()
+    if plan is None:
+        with metrics.stage('db_fetch'):
+            plan = prepare_db(client, sync_mode, upload_mode, log)
+        if on_plan:
+            on_plan(plan)
+    else:
+        log(f"中断したインデックス作成を再開します。（{plan['db_file_path']}）")
+    db_file_path = plan['db_file_path']
+    db_file_name = plan['db_file_name']
+
+    files_total = 0
+    link_stats = {}
+    if not plan.get('synced'):
+        files_total = sync_db(client, db_file_path, sync_mode, max_workers, listing_mode, link_stats,
+                              log, on_crawl_progress, metrics)
+        # 同期が終わったことを記録し、アップロード中に中断しても再開時にクロールし直さないようにする
+        plan['synced'] = True
+        if on_plan:
+            on_plan(plan)
+
+    if upload_mode == 'delta':
+        with metrics.stage('upload'):
+            db_file_name = publish_delta_db(client, db_file_path, plan['base_file'], plan['delta_files'],
+                                            log, on_upload_progress)
+        if not db_file_name:
+            raise RuntimeError("データベースのアップロードに失敗しました。")
+        with metrics.stage('finalize'):
+            index_db.finalize(db_file_path)
+    else:
+        with metrics.stage('finalize'):
+            index_db.finalize(db_file_path)
+        with metrics.stage('upload'), open(db_file_path, 'rb') as file_stream:
+            if plan['db_file']:
+                uploaded = update_box_db_file(client, plan['db_file']['id'], file_stream, log, on_upload_progress)
+            else:
+                uploaded = upload_db_to_box(client, ROOT_FOLDER_ID, file_stream, db_file_name, log, on_upload_progress)
+        if not uploaded:
+            raise RuntimeError("データベースのアップロードに失敗しました。")
+
+    return {
+        'db_file_path': db_file_path,
+        'db_file_name': db_file_name,
+        'files_total': files_total,
+        'link_stats': link_stats,
+        'metrics': metrics,
+    }
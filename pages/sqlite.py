@@ -1,48 +1,171 @@
 import streamlit as st
-import sqlite3
+import os
 import pandas as pd
 
-def load_data(file_path):
-    conn = sqlite3.connect(file_path)
-    query = "SELECT name FROM sqlite_master WHERE type='table';"
-    tables = pd.read_sql(query, conn)
-    conn.close()
-    return tables
+import db_browser
+import db_profile
 
-def load_table_data(file_path, table_name):
-    conn = sqlite3.connect(file_path)
-    query = f"SELECT * FROM {table_name}"
-    df = pd.read_sql(query, conn)
-    conn.close()
-    return df
+FILTER_SLOTS = 3  # 同時に指定できる列フィルタの数
+
+def get_session_databases():
+    # アップロードしたDBの置き場と接続はセッションごとに持つ（セッションが終わると片付けられる）
+    if 'sqlite_databases' not in st.session_state:
+        st.session_state['sqlite_databases'] = db_browser.SessionDatabases()
+    return st.session_state['sqlite_databases']
+
+def load_data(conn):
+    return db_browser.list_tables(conn)
+
+def query_controls(conn, table_name, db_hash, databases):
+    # 絞り込み・並べ替え・検索の指定を集め、SQLの WHERE 句とパラメータにする
+    columns = db_browser.table_columns(conn, table_name)
+    text_columns = db_browser.text_columns(conn, table_name)
+    with st.expander("絞り込み・並べ替え・検索"):
+        filters = []
+        for slot in range(FILTER_SLOTS):
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                column = st.selectbox("列", [''] + columns, key=f"filter_column_{slot}")
+            with col2:
+                operator = st.selectbox("条件", db_browser.FILTER_OPERATORS, key=f"filter_operator_{slot}")
+            with col3:
+                value = st.text_input("値", key=f"filter_value_{slot}",
+                                      disabled=operator in ('is null', 'is not null'))
+            if column:
+                filters.append((column, operator, value))
+
+        col1, col2 = st.columns(2)
+        with col1:
+            sort_column = st.selectbox("並べ替える列", [''] + columns)
+        with col2:
+            descending = st.radio("順序", ("昇順", "降順"), horizontal=True) == "降順"
+
+        search = st.text_input("検索（スペース区切りですべての語を含む行）")
+        search_columns = st.multiselect("検索する列", text_columns,
+                                        default=[column for column in text_columns if column == 'name'] or text_columns[:1])
+
+        # 全文検索の索引（rowidのあるテーブルのみ）。元のDBとは別のファイルに作る
+        use_fts = False
+        if search_columns and db_browser.has_rowid(conn, table_name):
+            fts_path = databases.fts_path(db_hash, table_name, search_columns)
+            if os.path.exists(fts_path):
+                use_fts = db_browser.attach_fts(conn, fts_path)
+                st.caption("全文検索の索引を使って検索します（3文字以上の語）。")
+            elif st.button(f"全文検索の索引を作成（{', '.join(search_columns)}）"):
+                with st.spinner("索引を作成しています..."):
+                    db_browser.build_fts_index(databases.path(db_hash), table_name, search_columns, fts_path)
+                st.rerun()
+
+    where, params = db_browser.build_where(filters, search, search_columns, use_fts)
+    return where, params, sort_column or None, descending
+
+def show_table_page(conn, db_hash, table_name, page_size, where='', params=(), sort_column=None, descending=False):
+    # ページごとの開始キーだけをセッションに持ち、表示中の1ページ分だけを読み込む
+    # DB・テーブル・行数・条件・並び順のいずれかが変わったら先頭に戻る
+    query = (db_hash, table_name, page_size, where, tuple(params), sort_column, descending)
+    state = st.session_state.setdefault('sqlite_browser', {})
+    if state.get('query') != query:
+        state.update({'query': query, 'starts': [None]})
+    starts = state['starts']
+
+    keys = db_browser.key_columns(conn, table_name)
+    df, next_after = db_browser.fetch_page(conn, table_name, keys, starts[-1], page_size,
+                                           where, params, sort_column, descending)
+
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        if st.button("先頭", disabled=len(starts) == 1):
+            del starts[1:]
+            st.rerun()
+    with col2:
+        if st.button("前へ", disabled=len(starts) == 1):
+            starts.pop()
+            st.rerun()
+    with col3:
+        if st.button("次へ", disabled=next_after is None):
+            starts.append(next_after)
+            st.rerun()
+    with col4:
+        st.write(f"ページ {len(starts)}")
+
+    first_row = (len(starts) - 1) * page_size + 1
+    st.write(f"Data from table: {table_name}（{first_row}〜{first_row + len(df) - 1} 行目）")
+    st.dataframe(df)
+
+def show_row_count(conn, table_name, where='', params=()):
+    # 件数は目安をすぐに出し、正確な件数は必要なときだけ数える（絞り込み中は条件に合う件数）
+    estimate = db_browser.estimate_row_count(conn, table_name)
+    if estimate is not None:
+        st.write(f"行数（目安）: 約 {estimate:,}")
+    if st.button("正確な行数を数える"):
+        st.write(f"行数: {db_browser.count_rows(conn, table_name, where, params):,}")
+
+@st.cache_data(show_spinner="プロファイルを計算しています...")
+def load_profile(_conn, db_hash, table_name, sample_rows):
+    # アップロードの内容とテーブルが同じなら、計算済みの結果を使う（接続はキャッシュのキーに含めない）
+    return db_profile.profile_table(_conn, table_name, sample_rows)
+
+def show_profile(conn, db_hash, table_name):
+    # 行を読み込まずに、集計のSQLだけで列ごとの統計を出す
+    with st.expander("列のプロファイル"):
+        col1, col2 = st.columns(2)
+        with col1:
+            sample = st.toggle("サンプリングする", value=True)
+        with col2:
+            sample_rows = st.number_input("サンプルの行数", min_value=1000, value=db_profile.DEFAULT_SAMPLE_ROWS,
+                                          step=10000, disabled=not sample)
+        if not st.checkbox("プロファイルを計算する"):
+            return
+        profile = load_profile(conn, db_hash, table_name, sample_rows if sample else None)
+
+        if profile['sampled']:
+            st.write(f"{profile['rows']:,} 行をサンプリングして計算しました（全体は約 {profile['table_rows']:,} 行）。")
+        else:
+            st.write(f"行数: {profile['rows']:,}")
+        st.dataframe(pd.DataFrame(
+            [(column['column'], column['type'], column['non_null'], column['nulls'], column['distinct'],
+              str(column['min']), str(column['max'])) for column in profile['columns']],
+            columns=['column', 'type', 'non_null', 'nulls', 'distinct', 'min', 'max']
+        ))
+
+        column_names = [column['column'] for column in profile['columns']]
+        selected = st.selectbox("分布を表示する列", column_names)
+        column = profile['columns'][column_names.index(selected)]
+        if column['histogram']:
+            st.bar_chart(pd.DataFrame(column['histogram'], columns=['range', 'count']).set_index('range'))
+        if column['top']:
+            st.write(f"上位 {len(column['top'])} 件の値")
+            st.table(pd.DataFrame(column['top'], columns=['value', 'count']))
+        elif not column['histogram']:
+            st.write("すべて異なる値です。" if column['non_null'] else "値がありません。")
 
 def main():
     st.title("SQLite Database Viewer")
-    
+
     file_path = st.file_uploader("Choose an SQLite file", type="db")
-    
+    databases = get_session_databases()
+
     if file_path:
-        # バイナリストリームからSQLiteファイルのパスを作成
-        with open("temp.db", "wb") as f:
-            f.write(file_path.read())
-        
+        # アップロードごとに1回だけディスクへ書き出し、読み取り専用の接続を再実行をまたいで使い回す
+        conn, db_hash = databases.connection(file_path)
+
         # データベース内のテーブルを取得
-        tables = load_data("temp.db")
-        
+        table_names = load_data(conn)
+
         st.write("Tables in the database:")
-        table_names = tables['name'].tolist()
         selected_table = st.selectbox("Select a table to view", table_names)
 
         st.write("table number",len(table_names))
-        
+
         if selected_table:
-            df = load_table_data("temp.db", selected_table)
-            st.write(f"Data from table: {selected_table}")
-            st.dataframe(df)
-        
-        # 一時ファイルの削除
-        import os
-        os.remove("temp.db")
+            page_size = st.selectbox("1ページの行数", db_browser.PAGE_SIZES,
+                                     index=db_browser.PAGE_SIZES.index(db_browser.DEFAULT_PAGE_SIZE))
+            where, params, sort_column, descending = query_controls(conn, selected_table, db_hash, databases)
+            show_profile(conn, db_hash, selected_table)
+            show_row_count(conn, selected_table, where, params)
+            show_table_page(conn, db_hash, selected_table, page_size, where, params, sort_column, descending)
+    else:
+        databases.release()
 
 if __name__ == "__main__":
     main()
@@ -1,60 +1,201 @@
+import base64
+import hashlib
+import html
+import os
+from contextlib import closing
+
+import numpy as np
 import streamlit as st
 from PIL import Image
 
+from image_render import render_viewport, viewport_box, zoomed_size, ENCODE_FORMATS, DEFAULT_QUALITY
+from tile_pyramid import TilePyramid, PYRAMID_MIN_PIXELS
+from render_cache import ViewerCache
+from chart_render import ChartCache, chart_data
+import thumbnails
+
+ZOOM_MULTIPLIERS = (0.5, 1.0, 2.0, 4.0)  # パネルごとの倍率（共通のズームに掛ける）
+PANEL_COUNT = 3
+
 st.title("Streamlit Image Viewer with Zoom and Pan")
 
-# 画像のアップロード
-uploaded_file = st.file_uploader("Choose an image...", type=["jpg", "jpeg", "png"])
+# 画像のアップロード（複数の画像を並べて比較できる）
+uploaded_files = st.file_uploader("Choose an image...", type=["jpg", "jpeg", "png"], accept_multiple_files=True)
+
+@st.cache_resource
+def get_tile_pyramid():
+    # タイルは全セッションで共有し、同じ画像なら2回目以降は作り直さない
+    return TilePyramid()
+
+@st.cache_resource
+def get_viewer_cache():
+    # デコード済み画像と描画済みの表示範囲を再実行をまたいで使い回す（メモリ上限つきのLRU）
+    return ViewerCache()
+
+def load_image(img):
+    # Image.open は遅延読み込みなので、キャッシュに入れる前に画素をデコードしておく
+    img.load()
+    return img
+
+def show_cache_stats(stats):
+    with st.expander("キャッシュ"):
+        st.table([
+            {
+                'キャッシュ': name,
+                '件数': level['items'],
+                'ヒット': level['hits'],
+                'ミス': level['misses'],
+                '追い出し': level['evictions'],
+                '使用量(MB)': round(level['bytes'] / 1024 / 1024, 1),
+                '上限(MB)': round(level['max_bytes'] / 1024 / 1024, 1),
+            }
+            for name, level in (
+                ('デコード済み画像', stats['decoded']),
+                ('表示範囲', stats['viewports']),
+                ('圧縮済み表示範囲', stats['encoded']),
+            )
+        ])
+
+def open_source(uploaded_file):
+    # 画像の読み込み（ヘッダーだけを読み、画素のデコードは必要になるまで行わない）
+    img = Image.open(uploaded_file)
+    image_hash = hashlib.sha1(uploaded_file.getvalue()).hexdigest()
+    # 大きな画像はタイルピラミッドから表示する（初回だけ全体をデコードしてタイルを作る）
+    use_pyramid = img.width * img.height >= PYRAMID_MIN_PIXELS
+    if use_pyramid:
+        pyramid = get_tile_pyramid()
+        if not pyramid.info(image_hash):
+            with st.spinner(f"タイルを作成しています... {uploaded_file.name}"):
+                pyramid.build(image_hash, img)
+    return {'name': uploaded_file.name, 'img': img, 'hash': image_hash, 'use_pyramid': use_pyramid}
+
+def render_panel(cache, source, zoom, x_position, y_position, image_format, quality):
+    # 位置は割合で共有し、画像ごとのズーム後のサイズに合わせてオフセットに直す
+    img = source['img']
+    image_hash = source['hash']
+    width, height = img.size
+    new_width, new_height = zoomed_size(img.size, zoom)
+    x_offset = y_offset = 0
+    if zoom > 1.0:
+        x_offset = round(x_position * max(0, new_width - width))
+        y_offset = round(y_position * max(0, new_height - height))
+
+    # 表示範囲に対応する元画像の部分だけをリサンプリングする（ズームが1.0以下の場合は全体を縮小）
+    # 同じ画像・ズーム・位置の表示範囲はキャッシュから返し、小さな画像はデコードも1回だけにする
+    if source['use_pyramid']:
+        def render():
+            return get_tile_pyramid().render(image_hash, zoom, x_offset, y_offset)
+    else:
+        def render():
+            return render_viewport(cache.decoded_image(image_hash, lambda: load_image(img)), zoom, x_offset, y_offset)
+    data = cache.encoded_viewport(image_hash, zoom, x_offset, y_offset, image_format, quality, render)
+    return {
+        'key': (image_hash, zoom, x_offset, y_offset),
+        'data': data,
+        'size': viewport_box(img.size, zoom, x_offset, y_offset)[1],
+        'caption': f"{source['name']} ×{zoom:g} ({len(data) / 1024:.0f} KB)",
+    }
+
+def show_panels(panels, image_format):
+    # st.image はパネルごとに画像を圧縮し直して送るので、同じ表示範囲は1回だけ埋め込み、
+    # 各パネルからはCSSのクラスで参照する（WebPもそのまま送れる）
+    payloads = {}
+    for panel in panels:
+        payloads.setdefault(panel['key'], panel['data'])
+    classes = {key: f'viewport-{index}' for index, key in enumerate(payloads)}
+    mimetype = f'image/{image_format.lower()}'
+    styles = ''.join(
+        f".{classes[key]}{{background-image:url(data:{mimetype};base64,{base64.b64encode(data).decode('ascii')})}}"
+        for key, data in payloads.items()
+    )
+    cells = ''.join(
+        f'<figure style="flex:1;margin:0">'
+        f'<div class="{classes[panel["key"]]}" style="aspect-ratio:{panel["size"][0]}/{panel["size"][1]};'
+        f'background-size:contain;background-repeat:no-repeat"></div>'
+        f'<figcaption style="text-align:center;font-size:0.8rem">{html.escape(panel["caption"])}</figcaption>'
+        f'</figure>'
+        for panel in panels
+    )
+    st.html(f'<style>{styles}</style><div style="display:flex;gap:1rem">{cells}</div>')
 
 def zoom():
-    if uploaded_file is not None:
-        # 画像の読み込み
-        img = Image.open(uploaded_file)
+    if uploaded_files:
+        cache = get_viewer_cache()
+        sources = [open_source(uploaded_file) for uploaded_file in uploaded_files]
+        names = [source['name'] for source in sources]
+
+        # パネルごとに表示する画像と倍率を選ぶ（ズームと位置は全パネルで連動する）
+        panel_settings = []
+        for index, column in enumerate(st.columns(PANEL_COUNT)):
+            with column:
+                source_index = st.selectbox(f"Image {index + 1}", range(len(sources)), index=index % len(sources),
+                                            format_func=lambda i: names[i], key=f"panel_source_{index}")
+                multiplier = st.selectbox(f"Zoom multiplier {index + 1}", ZOOM_MULTIPLIERS,
+                                          index=ZOOM_MULTIPLIERS.index(1.0), key=f"panel_zoom_{index}")
+                panel_settings.append((sources[source_index], multiplier))
+
         col1,col2,col3=st.columns(3)
 
         with col1:
             # ズームレベルをスライダーで設定
-            zoom = st.slider("Zoom(times)", 0.1, 10.0, 1.0)  # 最小0.1倍から最大3倍まで
-            # 画像のズーム後のサイズを計算
-            width, height = img.size
-            new_width = int(width * zoom)
-            new_height = int(height * zoom)
-            resized_img = img.resize((new_width, new_height))
-    
-        # スクロールバーの位置を設定（ズームが1.0以下の場合はオフセットをリセット）
-        if zoom > 1.0:
-            with col2:
-                x_offset = st.slider("Horizontal position", 0, max(0, new_width - width), 0)
-            with col3:
-                y_offset = st.slider("Vertical position", 0, max(0, new_height - height), 0)
-            right = min(new_width, x_offset + width)
-            bottom = min(new_height, y_offset + height)
-            cropped_img = resized_img.crop((x_offset, y_offset, right, bottom))
-        else:
-            cropped_img = resized_img  # ズームが1.0以下の場合はクロップせずにそのまま表示
-    
-        # 画像の表示
-        coll1,coll2,coll3=st.columns(3)
-        with coll1:
-            st.image(cropped_img, caption="Uploaded Image", use_column_width=True)
-        with coll2:
-            st.image(cropped_img, caption="Uploaded Image", use_column_width=True)
-        with coll3:
-            st.image(cropped_img, caption="Uploaded Image", use_column_width=True)
+            zoom = st.slider("Zoom(times)", 0.1, 10.0, 1.0)  # 最小0.1倍から最大10倍まで
+
+        # スクロールバーの位置を割合で設定（どのパネルも1.0倍以下の場合は使わない）
+        panned = any(zoom * multiplier > 1.0 for _, multiplier in panel_settings)
+        with col2:
+            x_position = st.slider("Horizontal position", 0.0, 1.0, 0.0, disabled=not panned)
+        with col3:
+            y_position = st.slider("Vertical position", 0.0, 1.0, 0.0, disabled=not panned)
+
+        col4,col5=st.columns(2)
+        with col4:
+            image_format = st.radio("表示形式", ENCODE_FORMATS, horizontal=True)
+        with col5:
+            quality = st.slider("画質", 10, 100, DEFAULT_QUALITY, disabled=image_format == 'PNG')
+
+        # 画像の表示（各表示範囲は1回だけ圧縮し、同じものを表示するパネルでは使い回す）
+        panels = [
+            render_panel(cache, source, zoom * multiplier, x_position, y_position, image_format, quality)
+            for source, multiplier in panel_settings
+        ]
+        show_panels(panels, image_format)
+        show_cache_stats(cache.stats())
     return "fin"
 
 #########
+@st.cache_resource
+def get_chart_cache():
+    # 描画済みのグラフは全セッションで共有する（データが同じなら描き直さない）
+    return ChartCache()
+
 def allview():
-    import streamlit as st
-    import matplotlib.pyplot as plt
-    import numpy as np
-    
     # タイトル
     st.title("Image and Graph Grid")
     
     # 4x6のグリッド作成
     rows = 4
     cols = 6
+    chart_cache = get_chart_cache()
+    # グラフのデータはセッションごとに固定し、再実行ではキャッシュ済みのPNGを使う
+    if 'allview_seed' not in st.session_state:
+        st.session_state['allview_seed'] = int(np.random.default_rng().integers(2 ** 32))
+    seed = st.session_state['allview_seed']
+    charts = [
+        (*chart_data(seed, i * cols + j), f"Graph {i*cols + j + 1}")
+        for i in range(rows) for j in range(cols) if j % 2 == 1
+    ]
+    single_figure = st.toggle("グラフを1枚にまとめて描く", value=False)
+
+    # 画像のセルには、start.pyで作成したサムネイルをSQLiteから1ページ分だけ読んで表示する
+    images_per_page = rows * (cols - cols // 2)
+    page_images = []
+    if os.path.exists(thumbnails.THUMBNAIL_DB):
+        with closing(thumbnails.connect()) as conn:
+            total = thumbnails.count_thumbnails(conn)
+            if total:
+                pages = -(-total // images_per_page)
+                page = st.number_input(f"ページ（全{pages}ページ、{total}枚）", min_value=1, max_value=pages, value=1)
+                page_images = thumbnails.thumbnail_page(conn, images_per_page, (page - 1) * images_per_page)
     
     # グリッドに表示する内容
     for i in range(rows):
@@ -62,16 +203,21 @@ def allview():
         for j in range(cols):
             with cols_layout[j]:
                 if j % 2 == 0:
-                    # 画像を表示
-                    st.image("https://placekitten.com/200/150", caption=f"Image {i*cols + j + 1}")
-                else:
+                    # 画像を表示（サムネイルが無い場合は従来のプレースホルダー）
+                    image_index = i * (cols - cols // 2) + j // 2
+                    if not page_images:
+                        st.image("https://placekitten.com/200/150", caption=f"Image {i*cols + j + 1}")
+                    elif image_index < len(page_images):
+                        name, data = page_images[image_index]
+                        st.image(data, caption=name)
+                elif not single_figure:
                     # グラフを表示
-                    fig, ax = plt.subplots()
-                    x = np.linspace(0, 10, 100)
-                    y = np.sin(x) + np.random.normal(0, 0.1, x.size)
-                    ax.plot(x, y)
-                    ax.set_title(f"Graph {i*cols + j + 1}")
-                    st.pyplot(fig)
+                    st.image(chart_cache.chart(*charts[i * (cols // 2) + j // 2]))
+    if single_figure:
+        # 全グラフをサブプロットにした1枚のPNGを表示
+        st.image(chart_cache.grid(charts, cols // 2))
+    stats = chart_cache.stats()
+    st.caption(f"グラフのキャッシュ: ヒット {stats['hits']} / ミス {stats['misses']} / {stats['bytes'] / 1024:.0f} KB")
     return "fin"
 
 tab1,tab2 =st.tabs(["allveiw","zoom"])
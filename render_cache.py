@@ -0,0 +1,92 @@
+import threading
+from collections import OrderedDict
+
+from image_render import encode_image
+
+DECODED_CACHE_BYTES = 512 * 1024 * 1024  # デコード済み画像のキャッシュ上限
+VIEWPORT_CACHE_BYTES = 256 * 1024 * 1024  # 描画済み表示範囲のキャッシュ上限
+ENCODED_CACHE_BYTES = 64 * 1024 * 1024  # 圧縮済み表示範囲のキャッシュ上限
+
+
+def image_nbytes(img):
+    return img.width * img.height * len(img.getbands())
+
+
+class LRUCache:
+    # 合計サイズの上限を超えたら、最も長く使われていないものから捨てる
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return self._items[key][0]
+
+    def put(self, key, value, size):
+        with self._lock:
+            if key in self._items:
+                self.bytes -= self._items.pop(key)[1]
+            # 上限より大きいものはキャッシュしない
+            if size > self.max_bytes:
+                return
+            self._items[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def get_or_create(self, key, create, sizeof):
+        value = self.get(key)
+        if value is None:
+            value = create()
+            self.put(key, value, sizeof(value))
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {
+                'items': len(self._items),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+class ViewerCache:
+    # 1段目: アップロード内容のハッシュ → デコード済み画像
+    # 2段目: (ハッシュ, ズーム, 横位置, 縦位置) → 描画済みの表示範囲
+    # 表示用に圧縮したバイト列も (2段目のキー, 形式, 品質) ごとに保持する
+    def __init__(self, decoded_max_bytes=DECODED_CACHE_BYTES, viewport_max_bytes=VIEWPORT_CACHE_BYTES,
+                 encoded_max_bytes=ENCODED_CACHE_BYTES):
+        self.decoded = LRUCache(decoded_max_bytes)
+        self.viewports = LRUCache(viewport_max_bytes)
+        self.encoded = LRUCache(encoded_max_bytes)
+
+    def decoded_image(self, image_hash, load):
+        return self.decoded.get_or_create(image_hash, load, image_nbytes)
+
+    def viewport(self, image_hash, zoom, x_offset, y_offset, render):
+        return self.viewports.get_or_create((image_hash, zoom, x_offset, y_offset), render, image_nbytes)
+
+    def encoded_viewport(self, image_hash, zoom, x_offset, y_offset, image_format, quality, render):
+        return self.encoded.get_or_create(
+            (image_hash, zoom, x_offset, y_offset, image_format, quality),
+            lambda: encode_image(self.viewport(image_hash, zoom, x_offset, y_offset, render), image_format, quality),
+            len
+        )
+
+    def stats(self):
+        return {'decoded': self.decoded.stats(), 'viewports': self.viewports.stats(), 'encoded': self.encoded.stats()}
@@ -0,0 +1,145 @@
+import datetime
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from box_client import LATENCY_BUCKETS_MS
+
+REPORT_DIR = os.path.join(tempfile.gettempdir(), 'box_index_reports')  # 実行ごとのレポートの置き場
+
+
+class RunMetrics:
+    # インデックス作成の段階ごとの所要時間を記録する。
+    # クロール → 抽出 → 共有リンク → DB書き込みはジェネレーターでつながっていて同時に進むので、
+    # 各段階は「その段階自身に掛かった時間」（inner に指定した上流の段階の時間を除いたもの）で数える。
+    # on_stage(段階の名前) は各段階を始める前に呼ばれる（例外を送出すればその段階に入らずに止められる）
+    def __init__(self, on_stage=None):
+        self.on_stage = on_stage
+        self.run_id = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        self.started_at = datetime.datetime.now().astimezone().isoformat(timespec='seconds')
+        self._origin = time.perf_counter()
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def _record(self, name, started, ended, items=0, inner=None, error=None):
+        with self._lock:
+            stage = self._stages.setdefault(name, {'start': started, 'end': ended, 'seconds': 0.0,
+                                                   'items': 0, 'inner': inner, 'error': None})
+            stage['start'] = min(stage['start'], started)
+            stage['end'] = max(stage['end'], ended)
+            stage['seconds'] += ended - started
+            stage['items'] += items
+            stage['inner'] = inner or stage['inner']
+            if error:
+                stage['error'] = error
+
+    @contextmanager
+    def stage(self, name, inner=None):
+        if self.on_stage:
+            self.on_stage(name)
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self._record(name, started, time.perf_counter(), inner=inner, error=repr(e))
+            raise
+        self._record(name, started, time.perf_counter(), inner=inner)
+
+    def iterate(self, name, iterable, inner=None):
+        # 要素を1つ取り出すたびに掛かった時間を name の段階に加える
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self._record(name, started, time.perf_counter(), inner=inner)
+                return
+            self._record(name, started, time.perf_counter(), items=1, inner=inner)
+            yield item
+
+    def stages(self):
+        # 開始順の一覧。start / end は実行開始からの秒数、seconds は上流の段階を除いた時間
+        with self._lock:
+            stages = {name: dict(stage) for name, stage in self._stages.items()}
+        rows = []
+        for name, stage in sorted(stages.items(), key=lambda item: item[1]['start']):
+            inner = stages.get(stage['inner'])
+            rows.append({
+                'stage': name,
+                'start': stage['start'] - self._origin,
+                'end': stage['end'] - self._origin,
+                'seconds': max(0.0, stage['seconds'] - (inner['seconds'] if inner else 0.0)),
+                'items': stage['items'],
+                'error': stage['error'],
+            })
+        return rows
+
+    def report(self, api_stats=None):
+        return {
+            'run_id': self.run_id,
+            'started_at': self.started_at,
+            'duration': time.perf_counter() - self._origin,
+            'stages': self.stages(),
+            'latency_buckets_ms': list(LATENCY_BUCKETS_MS),
+            'endpoints': api_stats.snapshot() if api_stats else {},
+        }
+
+
+def prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(report):
+    # Prometheusのテキスト形式（node_exporterのtextfileコレクターなどで読み込める）
+    lines = [
+        '# HELP box_index_run_seconds インデックス作成全体の所要時間',
+        '# TYPE box_index_run_seconds gauge',
+        f'box_index_run_seconds {report["duration"]:.6f}',
+        '# HELP box_index_stage_seconds 段階ごとの所要時間（上流の段階を除く）',
+        '# TYPE box_index_stage_seconds gauge',
+    ]
+    lines += [f'box_index_stage_seconds{{stage="{prometheus_label(stage["stage"])}"}} {stage["seconds"]:.6f}'
+              for stage in report['stages']]
+    lines += ['# HELP box_index_stage_items 段階ごとに処理した件数', '# TYPE box_index_stage_items gauge']
+    lines += [f'box_index_stage_items{{stage="{prometheus_label(stage["stage"])}"}} {stage["items"]}'
+              for stage in report['stages']]
+
+    endpoints = sorted(report['endpoints'].items())
+    for metric, key, help_text in (
+        ('box_api_requests_total', 'calls', 'エンドポイントごとのAPI呼び出し回数'),
+        ('box_api_retries_total', 'retries', '再試行した呼び出しの回数'),
+        ('box_api_errors_total', 'errors', 'エラーになった呼び出しの回数'),
+        ('box_api_sent_bytes_total', 'bytes_sent', '送信した本文のバイト数'),
+        ('box_api_received_bytes_total', 'bytes_received', '受信した本文のバイト数'),
+    ):
+        lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} counter']
+        lines += [f'{metric}{{endpoint="{prometheus_label(endpoint)}"}} {stats[key]}' for endpoint, stats in endpoints]
+
+    lines += ['# HELP box_api_request_duration_seconds API呼び出しのレイテンシ',
+              '# TYPE box_api_request_duration_seconds histogram']
+    for endpoint, stats in endpoints:
+        label = prometheus_label(endpoint)
+        cumulative = 0
+        for bound, count in zip(report['latency_buckets_ms'], stats['buckets']):
+            cumulative += count
+            lines.append(f'box_api_request_duration_seconds_bucket{{endpoint="{label}",le="{bound / 1000:g}"}} {cumulative}')
+        lines.append(f'box_api_request_duration_seconds_bucket{{endpoint="{label}",le="+Inf"}} {stats["calls"]}')
+        lines.append(f'box_api_request_duration_seconds_sum{{endpoint="{label}"}} {stats["total_ms"] / 1000:.6f}')
+        lines.append(f'box_api_request_duration_seconds_count{{endpoint="{label}"}} {stats["calls"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_report(report, directory=REPORT_DIR):
+    # 実行ごとに <run_id>.json と <run_id>.prom を書き出し、そのパスを返す
+    os.makedirs(directory, exist_ok=True)
+    json_path = os.path.join(directory, f'{report["run_id"]}.json')
+    prom_path = os.path.join(directory, f'{report["run_id"]}.prom')
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    with open(prom_path, 'w', encoding='utf-8') as f:
+        f.write(prometheus_text(report))
+    return json_path, prom_path
@@ -0,0 +1,211 @@
+import datetime
+import glob
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import closing
+
+import box_auth
+import index_db
+import indexer
+from box_crawler import DEFAULT_MAX_WORKERS, LISTING_FIELDS, iter_folder_items
+from box_sync import get_crawl_position, get_stream_position, save_folders, set_crawl_position, set_watermark
+
+# ルート直下のフォルダごとにシャード（別々のSQLiteファイル）を作り、最後に1つのDBへまとめる。
+# シャードは複数のプロセスで並列に作れるうえ、--shard i/N で複数のマシンに分けることもできる。
+# 各シャードの中では indexer と同じクロール・書き込み処理を使うので、中断しても続きから再開できる。
+# シャードは実行ID（既定は日付）ごとのディレクトリに作る。同じ実行IDで再実行したときだけ作成済みのシャードを使い、
+# まとめ終わったら消す（翌日の実行は改めて全件をクロールする）
+
+SHARD_DIR = os.path.join(tempfile.gettempdir(), 'box_shards')
+ROOT_SHARD = 'root'  # ルート直下のファイルとフォルダ階層の先頭だけを持つシャード
+DEFAULT_PROCESSES = 4
+COMPLETE_KEY = 'shard_complete'  # sync_state に書く作成済みの印
+
+
+def default_run_id():
+    # 複数のマシンで同じ日に実行すれば同じ値になる
+    return datetime.datetime.now().strftime('%Y%m%d')
+
+
+def run_dir(shard_dir, run_id):
+    return os.path.join(shard_dir, run_id)
+
+
+def remove_shards(paths):
+    # まとめ終わったシャード（ファイルまたはディレクトリ）を消す
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def shard_path(shard_dir, shard_id):
+    return os.path.join(shard_dir, f'shard_{shard_id}.db')
+
+
+def list_top_folders(client, log=print):
+    items = iter_folder_items(client, indexer.ROOT_FOLDER_ID, fields='type,id,name', on_error=log)
+    return [item['id'] for item in items if item['type'] == 'folder']
+
+
+def assign_shards(folder_ids, shard_index=0, shard_count=1):
+    # どのマシンでも同じ割り当てになるよう、IDの順に並べて shard_index 番目から shard_count 個おきに取る。
+    # ルート直下のファイルは最初のマシンが受け持つ
+    folder_ids = sorted(folder_ids, key=lambda folder_id: (len(folder_id), folder_id))
+    shards = folder_ids[shard_index::shard_count]
+    return ([ROOT_SHARD] if shard_index == 0 else []) + shards
+
+
+def shard_complete(path):
+    # クロールが最後まで終わったときに書く印で判定する（同期位置の有無には頼らない）
+    if not os.path.exists(path):
+        return False
+    with closing(sqlite3.connect(path)) as conn:
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        if 'sync_state' not in tables:
+            return False
+        row = conn.execute('SELECT value FROM sync_state WHERE key = ?', (COMPLETE_KEY,)).fetchone()
+        return row is not None and not get_crawl_position(conn)
+
+
+def mark_complete(path):
+    with index_db.open_db(path) as conn:
+        conn.execute('INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)', (COMPLETE_KEY, '1'))
+
+
+def start_position(client, path, shard_id):
+    # クロール前の同期位置を保存しておく（再開したときは最初の位置を使う）。
+    # 同期位置がないシャードはまとめたDBの差分同期の起点にできないので、クロールを始める前に失敗させる
+    with index_db.open_db(path) as conn:
+        stream_position = get_crawl_position(conn)
+    if stream_position:
+        return stream_position
+    stream_position = get_stream_position(client)
+    if not stream_position:
+        raise RuntimeError(f"シャード {shard_id} の同期位置を取得できませんでした。")
+    with index_db.open_db(path) as conn:
+        set_crawl_position(conn, stream_position)
+    return stream_position
+
+
+def index_root_files(client, db_file_path, stream_position, link_stats, log=print):
+    # ルート直下は1階層だけ読み、ファイルとフォルダ階層の先頭を書き込む
+    items = list(iter_folder_items(client, indexer.ROOT_FOLDER_ID, fields=LISTING_FIELDS, on_error=log))
+    files = [item for item in items if item['type'] == 'file']
+    link_cache = indexer.load_shared_links(db_file_path)
+    indexer.insert_images(db_file_path, indexer.attach_shared_links(
+        client, indexer.filter_images(files), link_cache, link_stats, log
+    ))
+    with index_db.open_db(db_file_path) as conn:
+        save_folders(conn, [(item['id'], indexer.ROOT_FOLDER_ID) for item in items if item['type'] == 'folder'])
+        set_watermark(conn, stream_position)
+        set_crawl_position(conn, None)
+    return len(files)
+
+
+def crawl_shard(auth_settings, client_options, shard_id, path, max_workers=DEFAULT_MAX_WORKERS, listing_mode='fields'):
+    # ワーカープロセスで実行する。クライアントとトークンはプロセスごとに用意する
+    started = time.time()
+    summary = {'shard': shard_id, 'path': path, 'skipped': False, 'files': 0, 'link_stats': {}, 'api_calls': 0}
+    if shard_complete(path):
+        summary['skipped'] = True
+        return summary
+
+    def log(*messages):
+        print(f'[{shard_id}]', *messages, flush=True)
+
+    client = box_auth.make_client(auth_settings, **client_options)
+    if not os.path.exists(path):
+        with closing(index_db.connect(path)) as conn:
+            index_db.ensure_schema(conn)
+    stream_position = start_position(client, path, shard_id)
+    if shard_id == ROOT_SHARD:
+        summary['files'] = index_root_files(client, path, stream_position, summary['link_stats'], log)
+    else:
+        # 保存した同期位置から続けるので、sync_db が改めて同期位置を取得することはない
+        summary['files'] = indexer.sync_db(client, path, 'full', max_workers, listing_mode, summary['link_stats'],
+                                           log, folder_id=shard_id)
+    mark_complete(path)
+    summary['api_calls'] = client.stats.total
+    summary['seconds'] = time.time() - started
+    return summary
+
+
+def run_shards(auth_settings, client_options, shard_ids, shard_dir=SHARD_DIR, processes=DEFAULT_PROCESSES,
+               max_workers=DEFAULT_MAX_WORKERS, listing_mode='fields', on_result=None, log=print):
+    # シャードごとに1タスクとしてプロセスプールで実行する（大きなフォルダがあっても他のプロセスは次へ進める）。
+    # 失敗したシャードは途中経過が残るので、もう一度実行すれば続きから作成する
+    os.makedirs(shard_dir, exist_ok=True)
+    results = []
+    failed = []
+    with ProcessPoolExecutor(max_workers=max(1, int(processes))) as pool:
+        futures = {
+            pool.submit(crawl_shard, auth_settings, client_options, shard_id, shard_path(shard_dir, shard_id),
+                        max_workers, listing_mode): shard_id
+            for shard_id in shard_ids
+        }
+        for future in as_completed(futures):
+            shard_id = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                log(f"シャード {shard_id} の作成に失敗しました: {e!r}")
+                failed.append(shard_id)
+                continue
+            results.append(result)
+            if on_result:
+                on_result(result)
+    return results, failed
+
+
+def find_shards(paths):
+    # ファイルはそのまま、ディレクトリはその中の shard_*.db をすべて対象にする
+    shards = []
+    for path in paths:
+        if os.path.isdir(path):
+            shards.extend(sorted(glob.glob(os.path.join(path, 'shard_*.db'))))
+        else:
+            shards.append(path)
+    return shards
+
+
+def merge_shards(shard_paths, db_file_path, log=print):
+    # 各シャードをATTACHしてテーブルごとINSERT ... SELECTで取り込む（行をPythonに読み込まない）。
+    # 索引は取り込んだあとにまとめて作り、同期位置はもっとも古いシャードのものを使う
+    # （それ以降の変更は次回の差分同期で拾える）
+    if not shard_paths:
+        raise ValueError("まとめるシャードがありません。")
+    incomplete = [path for path in shard_paths if not shard_complete(path)]
+    if incomplete:
+        raise ValueError(f"作成が終わっていないシャードがあります: {', '.join(incomplete)}")
+
+    building_path = db_file_path + '.building'
+    if os.path.exists(building_path):
+        os.remove(building_path)
+    columns = ', '.join(index_db.BOX_FILES_COLUMNS)
+    positions = []
+    with closing(index_db.connect(building_path)) as conn:
+        index_db.ensure_schema(conn)
+        for path in shard_paths:
+            conn.execute('ATTACH DATABASE ? AS shard', (path,))
+            with conn:
+                count = conn.execute(
+                    f'INSERT OR REPLACE INTO box_files ({columns}) SELECT {columns} FROM shard.box_files'
+                ).rowcount
+                conn.execute('INSERT OR REPLACE INTO box_folders (id, parent_id) '
+                             'SELECT id, parent_id FROM shard.box_folders')
+            positions.append(conn.execute(
+                "SELECT value FROM shard.sync_state WHERE key = 'stream_position'"
+            ).fetchone()[0])
+            conn.execute('DETACH DATABASE shard')
+            log(f"{os.path.basename(path)}: {count} 行")
+        with conn:
+            set_watermark(conn, min(positions, key=int))
+    index_db.finalize(building_path)
+    os.replace(building_path, db_file_path)
+    return db_file_path
@@ -249,13 +249,18 @@
 #     main()
 
 import streamlit as st
-import requests
 import sqlite3
-from io import BytesIO
 import pandas as pd
-import tempfile
-import datetime
-import os
+import json
+import threading
+import time
+
+from box_client import BoxClient
+from box_crawler import DEFAULT_MAX_WORKERS, LISTING_MODES
+from box_sync import SYNC_MODES
+import box_delta
+import index_job
+import run_metrics
 
 # OAuth 2.0設定
 client_id = st.secrets["CLIENT_ID"]
@@ -264,12 +269,14 @@ redirect_uri = 'https://kgkgkg.streamlit.app/'  # あなたのStreamlitアプリ
 
 auth_url = 'https://account.box.com/api/oauth2/authorize'
 token_url = 'https://api.box.com/oauth2/token'
-root_folder_id = '0'  # ルートフォルダのID（「0」はルートフォルダを意味する）
+
+JOB_POLL_SECONDS = 1.0  # 実行中のジョブの状態を読み直す間隔
 
 def get_auth_url():
     return f"{auth_url}?response_type=code&client_id={client_id}&redirect_uri={redirect_uri}"
 
-def get_access_token(auth_code):
+def get_access_token(client, auth_code):
+    # トークンの応答（access_token と expires_in）を返す
     data = {
         'grant_type': 'authorization_code',
         'code': auth_code,
@@ -277,137 +284,124 @@ def get_access_token(auth_code):
         'client_secret': client_secret,
         'redirect_uri': redirect_uri
     }
-    response = requests.post(token_url, data=data)
+    response = client.post(token_url, data=data)
     
     if response.status_code != 200:
         st.write("アクセストークンの取得に失敗しました。")
         st.write(f"エラーメッセージ: {response.json().get('error_description')}")
         return None
     
-    return response.json().get('access_token')
-
-def get_all_files(access_token, folder_id='0'):
-    files = []
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    url = f'https://api.box.com/2.0/folders/{folder_id}/items'
-    params = {'limit': 1000}
-    response = requests.get(url, headers=headers, params=params)
-    
-    if response.status_code == 200:
-        items = response.json().get('entries', [])
-        for item in items:
-            if item['type'] == 'file':
-                file_info = get_file_info(access_token, item['id'])
-                if file_info:
-                    files.append(file_info)
-            elif item['type'] == 'folder':
-                files.extend(get_all_files(access_token, item['id']))
-    else:
-        st.write("ファイルの取得に失敗しました。")
-    
-    return files
-
-def get_file_info(access_token, file_id):
-    url = f'https://api.box.com/2.0/files/{file_id}'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    response = requests.get(url, headers=headers)
-    
-    if response.status_code == 200:
-        return response.json()
-    else:
-        st.write(f"ファイル情報の取得に失敗しました。ファイルID: {file_id}")
-        return None
+    return response.json()
 
-def filter_images(files):
-    image_extensions = ['.jpg', '.jpeg', '.png', '.gif']
-    return [file for file in files if any(file['name'].lower().endswith(ext) for ext in image_extensions)]
-
-def create_shared_link(access_token, file_id):
-    url = f"https://api.box.com/2.0/files/{file_id}"
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
-    data = {
-        "shared_link": {
-            "access": "open"
-        }
-    }
-    response = requests.put(url, headers=headers, json=data)
-    
-    if response.status_code == 200:
-        return response.json()['shared_link']['url']
-    else:
-        st.write(f"共有リンクの作成に失敗しました。ファイルID: {file_id}")
-        return None
-
-def box_db_exists(access_token, db_file_name):
-    url = f'https://api.box.com/2.0/search?query={db_file_name}&file_extensions=db'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        files = response.json().get('entries', [])
-        return files[0] if files else None
-    else:
-        st.write("Box内のデータベースファイルの検索に失敗しました。")
+def get_current_user(client):
+    response = client.get(client.api_url('/users/me'), params={'fields': 'id,name,login'})
+    if response.status_code != 200:
+        st.write("ユーザー情報の取得に失敗しました。")
         return None
-
-def upload_db_to_box(access_token, folder_id, file_stream, db_file_name):
-    url = f'https://upload.box.com/api/2.0/files/content'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    files = {
-        'attributes': (None, '{"name":"' + db_file_name + '","parent":{"id":"' + folder_id + '"}}'),
-        'file': (db_file_name, file_stream)
-    }
-    response = requests.post(url, headers=headers, files=files)
-    if response.status_code == 201:
-        st.write("データベースファイルがBoxにアップロードされました。")
-    else:
-        st.write(f"データベースファイルのアップロードに失敗しました。ステータスコード: {response.status_code}, レスポンス: {response.text}")
-
-def update_box_db_file(access_token, file_id, file_stream):
-    url = f'https://upload.box.com/api/2.0/files/{file_id}/content'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    files = {
-        'file': (file_stream.name, file_stream)
-    }
-    response = requests.post(url, headers=headers, files=files)
-    if response.status_code == 201:
-        st.write("データベースファイルがBoxで更新されました。")
-    else:
-        st.write(f"データベースファイルの更新に失敗しました。ステータスコード: {response.status_code}, レスポンス: {response.text}")
-
-def create_new_db_file():
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.db') as temp_db:
-        conn = sqlite3.connect(temp_db.name)
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS box_files (
-                id TEXT PRIMARY KEY,
-                name TEXT,
-                folder_id TEXT,
-                created_at TEXT,
-                shared_link TEXT
-            )
-        ''')
-        conn.commit()
-        conn.close()
-        return temp_db.name
-
-def get_temp_db_file(db_stream):
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.db') as temp_db:
-        temp_db.write(db_stream.read())
-        return temp_db.name
+    return response.json()
+
+@st.cache_resource
+def get_job_registry():
+    # 再実行・ブラウザの再読み込み・セッションをまたいで、サーバープロセスに1つだけ持つ。
+    # ジョブは開始したユーザー（owner）のセッションにだけ表示する。アクセストークンはここには置かない
+    return {'job': None, 'owner': None, 'lock': threading.Lock()}
+
+def authenticate(auth_code):
+    # 認可コードはこのセッションで1回だけアクセストークンに交換し、トークンとユーザーはセッションにだけ持つ。
+    # 別のセッションが同じURL（?code=）を開いても、使用済みのコードの交換は失敗する
+    auth = st.session_state.get('box_auth')
+    if auth_code and (auth is None or auth['code'] != auth_code):
+        auth = None
+        st.session_state.pop('box_auth', None)
+        client = BoxClient()
+        token_info = get_access_token(client, auth_code)
+        if token_info:
+            client.access_token = token_info['access_token']
+            user = get_current_user(client)
+            if user:
+                auth = {
+                    'code': auth_code,
+                    'token': token_info['access_token'],
+                    'expires_at': time.time() + token_info.get('expires_in', 3600),
+                    'user': user,
+                }
+                st.session_state['box_auth'] = auth
+    if auth and auth['token'] and auth['expires_at'] <= time.time():
+        # 期限切れのトークンは捨てる（開始済みのジョブの表示は続ける）
+        auth['token'] = None
+    return auth
+
+def show_progress(status):
+    crawl = status['crawl']
+    if crawl:
+        st.write(
+            f"フォルダ: {crawl['folders_done']}/{crawl['folders_total']}　"
+            f"ページ: {crawl['pages']}　"
+            f"ファイル情報: {crawl['files_done']}/{crawl['files_total']}"
+        )
+    if status['upload']:
+        done, total = status['upload']
+        st.progress(done / total if total else 1.0, text=f"分割アップロード: {done}/{total} パート")
+    if status['thumbnails']:
+        progress = status['thumbnails']
+        finished = progress['done'] + progress['failed']
+        st.progress(finished / progress['total'],
+                    text=f"サムネイル: {finished}/{progress['total']}（失敗 {progress['failed']}）")
+
+def show_api_calls(stats, files_total):
+    snapshot = stats.snapshot()
+    st.write(f"API呼び出し回数: {stats.total}")
+    st.table(pd.DataFrame(
+        [(endpoint, s['calls'], s['retries'], s['errors'], round(s['avg_ms'], 1), round(s['max_ms'], 1),
+          round(s['bytes_sent'] / 1024, 1), round(s['bytes_received'] / 1024, 1))
+         for endpoint, s in sorted(snapshot.items())],
+        columns=['endpoint', 'calls', 'retries', 'errors', 'avg_ms', 'max_ms', 'sent_kb', 'received_kb']
+    ))
+    # ファイルごとに GET /files/{id} を呼ぶ従来方式との比較
+    saved = files_total - snapshot.get('GET /files/{id}', {}).get('calls', 0)
+    if saved > 0:
+        st.write(f"従来方式と比べて削減されたAPI呼び出し: {saved}")
+
+def show_link_stats(link_stats):
+    reused = link_stats.get('reused_listing', 0) + link_stats.get('reused_db', 0)
+    st.write(
+        f"共有リンク: 作成 {link_stats.get('created', 0)} 件、失敗 {link_stats.get('failed', 0)} 件、"
+        f"再利用 {reused} 件（一覧 {link_stats.get('reused_listing', 0)} 件、DB {link_stats.get('reused_db', 0)} 件）"
+    )
+    st.write(f"共有リンク作成のAPI呼び出しを {reused} 回削減しました。")
+
+def show_run_metrics(report, report_paths):
+    # 段階ごとの所要時間（表とタイムライン）と、エンドポイントごとのレイテンシの分布
+    st.write(f"実行時間: {report['duration']:.1f} 秒（実行ID: {report['run_id']}）")
+    stages = pd.DataFrame(report['stages'])
+    stages['share'] = (stages['seconds'] / report['duration'] * 100).round(1)
+    st.table(stages[['stage', 'seconds', 'share', 'items', 'error']].round({'seconds': 2}))
+    # クロール〜DB書き込みは同時に進むので、タイムライン上では重なって表示される
+    st.vega_lite_chart(stages[['stage', 'start', 'end']], {
+        'mark': 'bar',
+        'encoding': {
+            'y': {'field': 'stage', 'type': 'nominal', 'sort': None, 'title': None},
+            'x': {'field': 'start', 'type': 'quantitative', 'title': '経過時間（秒）'},
+            'x2': {'field': 'end'},
+        },
+    }, width='stretch')
+
+    labels = [f"≤{bound}ms" for bound in report['latency_buckets_ms']] + [f">{report['latency_buckets_ms'][-1]}ms"]
+    st.write("レイテンシの分布（呼び出し回数）")
+    st.table(pd.DataFrame(
+        [[endpoint] + s['buckets'] for endpoint, s in sorted(report['endpoints'].items())],
+        columns=['endpoint'] + labels
+    ))
+
+    json_path, prom_path = report_paths
+    st.write(f"レポートを保存しました: {json_path}, {prom_path}")
+    col1, col2 = st.columns(2)
+    with col1:
+        st.download_button("レポート（JSON）", json.dumps(report, ensure_ascii=False, indent=2),
+                           file_name=f"{report['run_id']}.json", mime='application/json')
+    with col2:
+        st.download_button("レポート（Prometheus）", run_metrics.prometheus_text(report),
+                           file_name=f"{report['run_id']}.prom", mime='text/plain')
 
 def show_db_content(db_file_path):
     conn = sqlite3.connect(db_file_path)
@@ -416,9 +410,35 @@ def show_db_content(db_file_path):
     conn.close()
     return df
 
-def generate_db_file_name(base_name="box_files"):
-    date_str = datetime.datetime.now().strftime('%Y%m%d')
-    return f"{base_name}_{date_str}.db"
+def show_job(job):
+    # ジョブのスレッドが更新した状態を読んで表示するだけ（画面の再実行はジョブに影響しない）
+    status = job.status()
+    elapsed = (status['finished'] or time.time()) - status['started']
+    labels = {'running': "実行中", 'done': "完了", 'failed': "失敗", 'cancelled': "中断"}
+    st.write(f"インデックス作成: {labels[status['state']]}（{elapsed:.0f} 秒）"
+             + ("　前回の続きから再開しました。" if status['resumed'] else ""))
+    show_progress(status)
+    with st.expander("メッセージ", expanded=status['state'] != 'done'):
+        for message in status['messages']:
+            st.write(message)
+
+    if status['state'] == 'running':
+        if st.button("中断する（次回は続きから再開します）"):
+            job.cancel()
+    elif status['state'] == 'done':
+        result = status['result']
+        show_api_calls(job.client.stats, result['files_total'])
+        show_link_stats(result['link_stats'])
+        show_run_metrics(result['report'], result['report_paths'])
+        st.write(f"使用されたDBファイル名: {result['db_file_name']}")
+        st.write(show_db_content(result['db_file_path']))
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def poll_job(job):
+    show_job(job)
+    if not job.running:
+        # 終わったら画面全体を描き直し、開始ボタンを戻す
+        st.rerun()
 
 def main():
     st.title("Box内の画像ファイルをSQLiteに保存")
@@ -430,63 +450,52 @@ def main():
     query_params = st.experimental_get_query_params()
     auth_code = query_params.get('code', [None])[0]
 
-    if auth_code:
-        access_token = get_access_token(auth_code)
-
-        if access_token:
-            st.write("認証成功！")
-
-            files = get_all_files(access_token, root_folder_id)
-            images = filter_images(files)
-
-            for image in images:
-                shared_link = create_shared_link(access_token, image['id'])
-                if shared_link:
-                    image['shared_link'] = shared_link
-                else:
-                    image['shared_link'] = 'リンク作成失敗'
-
-            db_file_name = generate_db_file_name()
-            db_file = box_db_exists(access_token, db_file_name)
-
-            if db_file:
-                st.write("既存のデータベースを更新します。")
-                url = f'https://api.box.com/2.0/files/{db_file["id"]}/content'
-                headers = {
-                    'Authorization': f'Bearer {access_token}'
-                }
-                response = requests.get(url, headers=headers)
-                db_stream = BytesIO(response.content)
-                db_file_path = get_temp_db_file(db_stream)
-            else:
-                st.write("新しいデータベースを作成します。")
-                db_file_path = create_new_db_file()
-
-            with sqlite3.connect(db_file_path) as conn:
-                cursor = conn.cursor()
-                for image in images:
-                    cursor.execute('''
-                        INSERT OR REPLACE INTO box_files (id, name, folder_id, created_at, shared_link)
-                        VALUES (?, ?, ?, ?, ?)
-                    ''', (
-                        image['id'],
-                        image['name'],
-                        image['parent']['id'],
-                        image['created_at'],
-                        image['shared_link']
-                    ))
-                conn.commit()
-
-            if db_file:
-                with open(db_file_path, 'rb') as file_stream:
-                    update_box_db_file(access_token, db_file['id'], file_stream)
-            else:
-                with open(db_file_path, 'rb') as file_stream:
-                    upload_db_to_box(access_token, root_folder_id, file_stream, db_file_name)
-
-            st.write(f"使用されたDBファイル名: {db_file_name}")
-            df = show_db_content(db_file_path)
-            st.write(df)
+    auth = authenticate(auth_code)
+    registry = get_job_registry()
+    job = registry['job']
+    owned = bool(auth and job and registry['owner'] == auth['user']['id'])
+    if job and job.running:
+        if owned:
+            poll_job(job)
+        else:
+            st.info("ほかのユーザーがインデックス作成を実行中です。終わってからもう一度開いてください。")
+        return
+
+    max_workers = st.number_input("同時接続数", min_value=1, max_value=32, value=DEFAULT_MAX_WORKERS)
+    listing_mode = st.radio(
+        "一覧取得モード", LISTING_MODES, horizontal=True,
+        help="search: フォルダをたどらず、検索APIで画像ファイルだけを取得します（画像の少ないフォルダが多い場合に速い）。"
+             "検索のインデックスは更新が数分遅れるため、直前に追加・移動したファイルは含まれないことがあります。"
+    )
+    sync_mode = st.radio("同期モード", SYNC_MODES, horizontal=True)
+    upload_mode = st.radio("アップロード方式", box_delta.UPLOAD_MODES, horizontal=True)
+    make_thumbnails = st.checkbox("サムネイルを作成する（ビューアの一覧表示に使う）")
+    options = {'sync_mode': sync_mode, 'upload_mode': upload_mode,
+               'max_workers': int(max_workers), 'listing_mode': listing_mode}
+
+    if auth and auth['token']:
+        st.write(f"認証成功！（{auth['user']['name']}）")
+        saved = index_job.load_job_state(auth['user']['id'])
+        if saved:
+            st.info(f"中断したインデックス作成があります（{saved['options']}）。"
+                    "同じ設定で開始すると続きから再開します。")
+        if st.button("再開する" if saved and saved['options'] == options else "インデックス作成を開始"):
+            # すべてのBox API呼び出しで接続・再試行・流量制限を共有する
+            client = BoxClient(access_token=auth['token'])
+            with registry['lock']:
+                # 別のセッションが先に開始していれば、そちらを優先する
+                if not (registry['job'] and registry['job'].running):
+                    registry['job'] = index_job.IndexJob(client, options, make_thumbnails,
+                                                         owner=auth['user']['id']).start()
+                    registry['owner'] = auth['user']['id']
+                    # トークンはジョブのクライアントだけが持つ。次に開始するときは認証し直す
+                    auth['token'] = None
+            st.rerun()
+    elif auth:
+        st.write("もう一度開始するには、上のリンクから認証し直してください。")
+
+    if owned:
+        show_job(job)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,54 @@
+import os
+import sys
+
+import pytest
+from PIL import Image, ImageChops, ImageStat
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_render import render_viewport, zoomed_size  # noqa: E402
+from tile_pyramid import TilePyramid  # noqa: E402
+
+
+def make_image(size):
+    # 明るいグラデーション（端が黒ずむとすぐに差が出る）
+    width, height = size
+    img = Image.new('RGB', size)
+    img.putdata([(200 + x * 55 // width, 200 + y * 55 // height, 230) for y in range(height) for x in range(width)])
+    return img
+
+
+@pytest.fixture
+def pyramid(tmp_path):
+    pyramid = TilePyramid(str(tmp_path / 'tiles.db'), tile_size=64)
+    yield pyramid
+    pyramid._conn.close()
+
+
+def edge_difference(expected, actual):
+    # 右端と下端の2画素幅での平均の差
+    assert expected.size == actual.size
+    width, height = expected.size
+    diff = ImageChops.difference(expected, actual)
+    strips = [diff.crop((width - 2, 0, width, height)), diff.crop((0, height - 2, width, height))]
+    return max(max(ImageStat.Stat(strip).mean) for strip in strips)
+
+
+@pytest.mark.parametrize('zoom', [0.3, 0.5, 1.0])
+def test_render_matches_viewport_at_image_edge_when_zoomed_out(pyramid, zoom):
+    # 縮小表示では常に画像全体（右端・下端を含む）が表示範囲になる。
+    # 大きさが 64 の倍数でないので、端のタイルは小さい
+    img = make_image((300, 170))
+    pyramid.build('hash', img)
+    assert edge_difference(render_viewport(img, zoom), pyramid.render('hash', zoom)) < 4
+
+
+@pytest.mark.parametrize('zoom', [1.5, 3.0])
+def test_render_matches_viewport_at_image_edge_when_zoomed_in(pyramid, zoom):
+    # 拡大表示で、表示範囲が右下の角に届くところまで移動する
+    img = make_image((300, 170))
+    pyramid.build('hash', img)
+    new_width, new_height = zoomed_size(img.size, zoom)
+    x_offset, y_offset = new_width - img.size[0], new_height - img.size[1]
+    expected = render_viewport(img, zoom, x_offset, y_offset)
+    assert edge_difference(expected, pyramid.render('hash', zoom, x_offset, y_offset)) < 4
@@ -0,0 +1,155 @@
+import io
+import os
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from PIL import Image
+
+THUMBNAIL_DB = os.path.join(tempfile.gettempdir(), 'box_thumbnails.db')
+THUMBNAIL_SIZE = 256  # 長辺のピクセル数
+THUMBNAIL_QUALITY = 75
+DEFAULT_DOWNLOAD_WORKERS = 8
+WRITE_BATCH = 100  # まとめて書き込むサムネイルの数
+
+
+def connect(db_file_path=THUMBNAIL_DB):
+    # サムネイルは索引DBとは別のファイルに置く（Boxへアップロードする索引DBを大きくしないため）
+    conn = sqlite3.connect(db_file_path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS thumbnails (
+            file_id TEXT,
+            version TEXT,
+            name TEXT,
+            created_at TEXT,
+            width INTEGER,
+            height INTEGER,
+            data BLOB,
+            PRIMARY KEY (file_id, version)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_thumbnails_created_at ON thumbnails (created_at, file_id)')
+    conn.commit()
+    return conn
+
+
+def pending_files(conn, index_db_path):
+    # 索引DBのファイルのうち、同じバージョンのサムネイルがまだ無いもの
+    conn.execute('ATTACH DATABASE ? AS idx', (index_db_path,))
+    try:
+        # 索引から消えたファイルのサムネイルは消す
+        with conn:
+            conn.execute('DELETE FROM thumbnails WHERE file_id NOT IN (SELECT id FROM idx.box_files)')
+        return conn.execute('''
+            SELECT f.id, COALESCE(f.file_version, ''), f.name, f.created_at
+            FROM idx.box_files f
+            LEFT JOIN thumbnails t ON t.file_id = f.id AND t.version = COALESCE(f.file_version, '')
+            WHERE t.file_id IS NULL
+            ORDER BY f.id
+        ''').fetchall()
+    finally:
+        conn.execute('DETACH DATABASE idx')
+
+
+def save_thumbnails(conn, thumbnails):
+    # 古いバージョンのサムネイルを消してから書き込む
+    with conn:
+        conn.executemany(
+            'DELETE FROM thumbnails WHERE file_id = ? AND version != ?',
+            ((thumbnail[0], thumbnail[1]) for thumbnail in thumbnails)
+        )
+        conn.executemany('INSERT OR REPLACE INTO thumbnails VALUES (?, ?, ?, ?, ?, ?, ?)', thumbnails)
+
+
+def count_thumbnails(conn):
+    return conn.execute('SELECT COUNT(*) FROM thumbnails').fetchone()[0]
+
+
+def thumbnail_page(conn, limit, offset=0):
+    # 作成日時の新しい順に1ページ分を返す（画像は名前・バイト列の組）
+    return conn.execute(
+        'SELECT name, data FROM thumbnails ORDER BY created_at DESC, file_id LIMIT ? OFFSET ?',
+        (limit, offset)
+    ).fetchall()
+
+
+def download_original(client, file_id):
+    response = client.get(client.api_url(f'/files/{file_id}/content'))
+    if response.status_code != 200:
+        raise RuntimeError(f"ファイルのダウンロードに失敗しました。ファイルID: {file_id}, ステータスコード: {response.status_code}")
+    return response.content
+
+
+def make_thumbnail(data, max_size=THUMBNAIL_SIZE, quality=THUMBNAIL_QUALITY):
+    # プロセスプールで実行する。JPEGはdraftで縮小しながらデコードするので全画素を展開しない
+    img = Image.open(io.BytesIO(data))
+    img.draft('RGB', (max_size, max_size))
+    img.thumbnail((max_size, max_size))
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+    buffer = io.BytesIO()
+    img.save(buffer, format='WEBP', quality=quality)
+    return buffer.getvalue(), img.width, img.height
+
+
+def build_thumbnails(client, conn, files, max_workers=DEFAULT_DOWNLOAD_WORKERS, processes=None,
+                     max_size=THUMBNAIL_SIZE, quality=THUMBNAIL_QUALITY, on_progress=None, on_error=None):
+    # ダウンロードはスレッド、デコードと縮小はプロセスで並列に行い、結果はまとめてSQLiteへ書き込む。
+    # 同時に扱うファイル数を一定に保つので、原画像のバイト列がメモリにたまり続けることはない。
+    # コールバックはすべて呼び出し元のスレッドで実行する（on_progress が例外を送出すると、そこで止める）
+    files = iter(files)
+    window = max(1, int(max_workers)) * 2
+    progress = {'done': 0, 'failed': 0, 'started': time.time()}
+    batch = []
+    pending = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as downloads, \
+            ProcessPoolExecutor(max_workers=processes) as workers:
+
+        def start_next():
+            file = next(files, None)
+            if file:
+                pending[downloads.submit(download_original, client, file[0])] = ('download', file)
+
+        for _ in range(window):
+            start_next()
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, file = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as error:
+                    progress['failed'] += 1
+                    if on_error:
+                        on_error(file, error)
+                    start_next()
+                    continue
+
+                if stage == 'download':
+                    pending[workers.submit(make_thumbnail, result, max_size, quality)] = ('thumbnail', file)
+                else:
+                    data, width, height = result
+                    file_id, version, name, created_at = file
+                    batch.append((file_id, version, name, created_at, width, height, data))
+                    progress['done'] += 1
+                    start_next()
+
+            if len(batch) >= WRITE_BATCH:
+                save_thumbnails(conn, batch)
+                batch = []
+            if on_progress:
+                try:
+                    on_progress(progress)
+                except Exception:
+                    # 呼び出し元が止めた場合も、作成済みの分は書き込んでおく
+                    save_thumbnails(conn, batch)
+                    raise
+
+    if batch:
+        save_thumbnails(conn, batch)
+    return progress
@@ -0,0 +1,166 @@
+import io
+import math
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from PIL import Image
+
+from image_render import viewport_box
+
+TILE_SIZE = 256
+TILE_FORMAT = 'PNG'
+DEFAULT_TILE_DB = os.path.join(tempfile.gettempdir(), 'viewer_tiles.db')
+PYRAMID_MIN_PIXELS = 4096 * 4096  # これ以上の画素数の画像はタイルから表示する
+MAX_PYRAMIDS = 20  # 保存しておくピラミッドの数（古いものから消す）
+
+
+def level_size(size, level):
+    # Image.reduce(2) を繰り返したときの大きさ（端数は切り上げ）
+    width, height = size
+    scale = 2 ** level
+    return math.ceil(width / scale), math.ceil(height / scale)
+
+
+def level_count(size, tile_size=TILE_SIZE):
+    # 最も粗いレベルが1タイルに収まるまで半分にしていく
+    return 1 + max(0, math.ceil(math.log2(max(size) / tile_size)))
+
+
+def encode_tile(tile):
+    buffer = io.BytesIO()
+    tile.save(buffer, format=TILE_FORMAT)
+    return buffer.getvalue()
+
+
+class TilePyramid:
+    # 画像の内容ハッシュごとに、2の累乗で縮小したレベルの固定サイズタイルをSQLiteに保存する。
+    # 表示範囲に近いレベルのタイルだけを読んで組み立てるので、パンやズームのたびに全体をデコードしない。
+    def __init__(self, db_path=DEFAULT_TILE_DB, tile_size=TILE_SIZE):
+        self.tile_size = tile_size
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS pyramids (
+                image_hash TEXT PRIMARY KEY,
+                width INTEGER,
+                height INTEGER,
+                mode TEXT,
+                levels INTEGER,
+                tile_size INTEGER,
+                created_at REAL
+            )
+        ''')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS tiles (
+                image_hash TEXT,
+                level INTEGER,
+                col INTEGER,
+                row INTEGER,
+                data BLOB,
+                PRIMARY KEY (image_hash, level, col, row)
+            ) WITHOUT ROWID
+        ''')
+        self._conn.commit()
+
+    def info(self, image_hash):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT width, height, mode, levels, tile_size FROM pyramids WHERE image_hash = ?', (image_hash,)
+            ).fetchone()
+        if not row:
+            return None
+        width, height, mode, levels, tile_size = row
+        return {'size': (width, height), 'mode': mode, 'levels': levels, 'tile_size': tile_size}
+
+    def build(self, image_hash, img):
+        # 元画像のデコードはここでの1回だけ。レベルごとに半分へ縮小しながらタイルに切り分ける
+        mode = 'RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB'
+        level_img = img.convert(mode)
+        size = level_img.size
+        levels = level_count(size, self.tile_size)
+        tile_size = self.tile_size
+
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM tiles WHERE image_hash = ?', (image_hash,))
+            for level in range(levels):
+                if level > 0:
+                    level_img = level_img.reduce(2)
+                width, height = level_img.size
+                self._conn.executemany(
+                    'INSERT INTO tiles (image_hash, level, col, row, data) VALUES (?, ?, ?, ?, ?)',
+                    (
+                        (image_hash, level, col, row, encode_tile(level_img.crop((
+                            col * tile_size, row * tile_size,
+                            min(width, (col + 1) * tile_size), min(height, (row + 1) * tile_size)
+                        ))))
+                        for row in range(math.ceil(height / tile_size))
+                        for col in range(math.ceil(width / tile_size))
+                    )
+                )
+            self._conn.execute(
+                'INSERT OR REPLACE INTO pyramids VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (image_hash, size[0], size[1], mode, levels, tile_size, time.time())
+            )
+            self._evict()
+        return self.info(image_hash)
+
+    def _evict(self):
+        old_hashes = [row[0] for row in self._conn.execute(
+            'SELECT image_hash FROM pyramids ORDER BY created_at DESC LIMIT -1 OFFSET ?', (MAX_PYRAMIDS,)
+        )]
+        for old_hash in old_hashes:
+            self._conn.execute('DELETE FROM tiles WHERE image_hash = ?', (old_hash,))
+            self._conn.execute('DELETE FROM pyramids WHERE image_hash = ?', (old_hash,))
+
+    def choose_level(self, info, box, size):
+        # 出力1画素あたりの元画像の画素数から、解像度が足りる範囲で最も粗いレベルを選ぶ
+        source_per_output = (box[2] - box[0]) / max(1, size[0])
+        if source_per_output <= 1:
+            return 0
+        return min(info['levels'] - 1, int(math.floor(math.log2(source_per_output))))
+
+    def render(self, image_hash, zoom, x_offset=0, y_offset=0):
+        # image_render.render_viewport と同じ表示範囲を、タイルから組み立てて返す
+        info = self.info(image_hash)
+        box, size = viewport_box(info['size'], zoom, x_offset, y_offset)
+        level = self.choose_level(info, box, size)
+        scale = 2 ** level
+        tile_size = info['tile_size']
+        level_width, level_height = level_size(info['size'], level)
+
+        level_box = [coordinate / scale for coordinate in box]
+        first_col = int(level_box[0] // tile_size)
+        first_row = int(level_box[1] // tile_size)
+        last_col = min(math.ceil(level_width / tile_size), math.ceil(level_box[2] / tile_size)) - 1
+        last_row = min(math.ceil(level_height / tile_size), math.ceil(level_box[3] / tile_size)) - 1
+
+        canvas = Image.new(info['mode'], (
+            (last_col - first_col + 1) * tile_size,
+            (last_row - first_row + 1) * tile_size
+        ))
+        with self._lock:
+            tiles = self._conn.execute('''
+                SELECT col, row, data FROM tiles
+                WHERE image_hash = ? AND level = ? AND col BETWEEN ? AND ? AND row BETWEEN ? AND ?
+            ''', (image_hash, level, first_col, last_col, first_row, last_row)).fetchall()
+        for col, row, data in tiles:
+            canvas.paste(Image.open(io.BytesIO(data)), ((col - first_col) * tile_size, (row - first_row) * tile_size))
+        # 右端・下端のタイルは小さいので、余った黒い部分を切り落としてからリサンプリングする
+        # （残しておくと、画像の端を表示したときに縮小フィルタが黒を拾って縁が暗くなる）
+        canvas = canvas.crop((
+            0, 0,
+            min(level_width, (last_col + 1) * tile_size) - first_col * tile_size,
+            min(level_height, (last_row + 1) * tile_size) - first_row * tile_size,
+        ))
+
+        canvas_box = (
+            level_box[0] - first_col * tile_size,
+            level_box[1] - first_row * tile_size,
+            min(level_box[2], level_width) - first_col * tile_size,
+            min(level_box[3], level_height) - first_row * tile_size,
+        )
+        return canvas.resize(size, box=canvas_box)